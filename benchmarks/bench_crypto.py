@@ -0,0 +1,84 @@
+"""
+Benchmark throughput of hashing, encryption and decryption of a file.
+
+Every size is measured with each buffer size, so the cost of small
+blocks is visible. Small files are processed many times to get a
+stable figure.
+
+Usage::
+
+    python -m benchmarks.bench_crypto --sizes 1K 1M 1G --buffers 4K 1M --workers 1 4
+"""
+import argparse
+import os
+from pathlib import Path
+import tempfile
+import time
+
+from git_privacy_manager.gpm import checksum
+from git_privacy_manager.utils.crypto import Crypto
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# Minimal amount of data processed for each measurement
+MIN_TOTAL = 64 * 1024 ** 2
+
+
+def parse_size(value: str) -> int:
+    if value[-1:].upper() in UNITS:
+        return int(value[:-1]) * UNITS[value[-1:].upper()]
+    return int(value)
+
+
+def make_file(path: Path, size: int):
+    block = os.urandom(min(size, UNITS['M']))
+    with open(path, 'wb') as f:
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+
+
+def throughput(func, size: int) -> float:
+    repeat = max(1, MIN_TOTAL // size)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return size * repeat / (time.perf_counter() - start) / UNITS['M']
+
+
+def measure(directory: Path, size: int, buffer_size: int, workers: int, use_mmap: bool):
+    plain = directory / 'plain'
+    encrypted = directory / 'encrypted'
+    decrypted = directory / 'decrypted'
+    make_file(plain, size)
+    crypto = Crypto(Crypto.generate_key(), buffer_size, workers)
+    try:
+        hashing = throughput(lambda: checksum(plain, buffer_size=buffer_size, use_mmap=use_mmap), size)
+        encryption = throughput(lambda: crypto.encrypt_file(plain, encrypted), size)
+        decryption = throughput(lambda: crypto.decrypt_file(encrypted, decrypted), size)
+        return hashing, encryption, decryption
+    finally:
+        for f in (plain, encrypted, decrypted):
+            if f.exists():
+                f.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', nargs='+', default=['1K', '1M', '1G'])
+    parser.add_argument('--buffers', nargs='+', default=['4K', '1M'])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1],
+                        help='Numbers of threads to encrypt and decrypt a file')
+    parser.add_argument('--mmap', help='Hash files mapped into memory', action='store_true')
+    args = parser.parse_args()
+
+    print(f'{"size":>6} {"buffer":>7} {"workers":>8} {"hash, MB/s":>11} {"encrypt, MB/s":>14} {"decrypt, MB/s":>14}')
+    with tempfile.TemporaryDirectory() as d:
+        for size in args.sizes:
+            for buffer_size in args.buffers:
+                for workers in args.workers:
+                    hashing, encryption, decryption = measure(
+                        Path(d), parse_size(size), parse_size(buffer_size), workers, args.mmap)
+                    print(f'{size:>6} {buffer_size:>7} {workers:>8} {hashing:>11.0f} {encryption:>14.0f} {decryption:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
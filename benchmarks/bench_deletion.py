@@ -0,0 +1,61 @@
+"""
+Benchmark how encrypt after removal of files scales with number of files.
+
+A share of files of a tree is removed and the next encrypt is timed, so
+the time is spent on finding removed entries and dropping them. Time per
+removed file must stay flat as the tree grows. With --debug the debug
+logs are formatted and written to the null device, so their cost is
+measured too.
+
+Usage::
+
+    python -m benchmarks.bench_deletion --files 2000 4000 8000 16000 --removed 0.1
+"""
+import argparse
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from git_privacy_manager import GPM
+
+from benchmarks.trees import make_tree, tree_file
+
+
+def measure(files: int, share: float) -> float:
+    directory = Path(tempfile.mkdtemp())
+    try:
+        make_tree(directory, files)
+        GPM(directory, '123', kdf_iterations=1000).encrypt()
+        removed = int(files * share)
+        for i in range(removed):
+            tree_file(directory, i).unlink()
+        gpm = GPM(directory, '123')
+        start = time.perf_counter()
+        gpm.encrypt()
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--files', type=int, nargs='+', default=[2000, 4000, 8000, 16000])
+    parser.add_argument('--removed', type=float, default=0.1, help='Share of files to remove')
+    parser.add_argument('--debug', help='Format debug logs', action='store_true')
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, filename=os.devnull)
+
+    print(f'{"files":>8} {"removed":>8} {"encrypt, s":>11} {"us/removed file":>16}')
+    for files in args.files:
+        removed = int(files * args.removed)
+        elapsed = measure(files, args.removed)
+        print(f'{files:>8} {removed:>8} {elapsed:>11.3f} {elapsed / max(removed, 1) * 1e6:>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark hash algorithms which detect changes of files.
+
+The files are either a real tree, so its own distribution of file sizes
+is measured, or a generated tree with given numbers of files by size.
+Each file is hashed the way encrypt does when its stats have changed.
+
+Usage::
+
+    python -m benchmarks.bench_hash --mix 4K:2000 64K:500 1M:100 64M:4
+    python -m benchmarks.bench_hash --directory ~/projects/secrets
+"""
+import argparse
+import os
+from pathlib import Path
+import tempfile
+import time
+
+from git_privacy_manager.gpm import checksum
+from git_privacy_manager.utils import hashing
+from git_privacy_manager.utils.walk import walk
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value: str) -> int:
+    if value[-1:].upper() in UNITS:
+        return int(value[:-1]) * UNITS[value[-1:].upper()]
+    return int(value)
+
+
+def make_tree(directory: Path, mix):
+    block = os.urandom(UNITS['M'])
+    i = 0
+    for size, files in mix:
+        for _ in range(files):
+            subdir = directory / f'd{i % 32:02}'
+            subdir.mkdir(exist_ok=True)
+            with open(subdir / f'f{i:06}', 'wb') as f:
+                for offset in range(0, size, len(block)):
+                    f.write(block[:size - offset])
+            i += 1
+
+
+def measure(files, algorithm: str) -> float:
+    start = time.perf_counter()
+    for file in files:
+        checksum(file, algorithm)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mix', nargs='+', default=['4K:2000', '64K:500', '1M:100', '64M:4'],
+                        help='Numbers of files by size as SIZE:FILES')
+    parser.add_argument('--directory', type=Path, help='Hash files of this tree instead')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        directory = args.directory
+        if directory is None:
+            directory = Path(d)
+            make_tree(directory, [(parse_size(size), int(files))
+                                  for size, files in (m.split(':') for m in args.mix)])
+        files = [directory / key for key, _ in walk(directory, [])]
+        total = sum(f.stat().st_size for f in files)
+        print(f'{len(files)} files, {total / UNITS["M"]:.0f} MiB')
+        print(f'{"algorithm":>10} {"MB/s":>8} {"us/file":>8}')
+        for algorithm in hashing.ALGORITHMS:
+            try:
+                hashing.check(algorithm)
+            except RuntimeError as e:
+                print(f'{algorithm:>10} {e}')
+                continue
+            # The first run reads files into page cache, so disk speed is not measured
+            elapsed = min(measure(files, algorithm) for _ in range(args.repeat))
+            print(f'{algorithm:>10} {total / elapsed / UNITS["M"]:>8.0f} {elapsed / len(files) * 1e6:>8.0f}')
+
+
+if __name__ == '__main__':
+    main()
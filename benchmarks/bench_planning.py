@@ -0,0 +1,55 @@
+"""
+Benchmark how encrypt and decrypt planning scales with number of files.
+
+The files are tiny so time is spent on listing, indexing and metadata,
+not on crypto. Time per file must stay flat as the tree grows.
+
+Usage::
+
+    python -m benchmarks.bench_planning --files 1000 2000 4000 8000 16000
+"""
+import argparse
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from git_privacy_manager import GPM
+
+from benchmarks.trees import make_tree
+
+
+def measure(files: int):
+    directory = Path(tempfile.mkdtemp())
+    try:
+        make_tree(directory, files)
+        gpm = GPM(directory, '123')
+        start = time.perf_counter()
+        gpm.encrypt()
+        initial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gpm.encrypt()
+        encrypt = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gpm.decrypt()
+        decrypt = time.perf_counter() - start
+        return initial, encrypt, decrypt
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--files', type=int, nargs='+', default=[1000, 2000, 4000, 8000, 16000])
+    args = parser.parse_args()
+
+    print(f'{"files":>8} {"initial, us/file":>17} {"no-op encrypt, us/file":>23} {"no-op decrypt, us/file":>23}')
+    for files in args.files:
+        initial, encrypt, decrypt = measure(files)
+        print(f'{files:>8} {initial / files * 1e6:>17.0f} {encrypt / files * 1e6:>23.0f} {decrypt / files * 1e6:>23.0f}')
+
+
+if __name__ == '__main__':
+    main()
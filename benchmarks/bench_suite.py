@@ -0,0 +1,293 @@
+"""
+Benchmark the whole encrypt and decrypt pipeline on synthetic trees.
+
+Trees are generated in several shapes. On each of them encrypt and
+decrypt are timed cold, i.e. without local metadata, warm with nothing
+to do, after a change of a single file and, for trees with renames, after
+renames. A fresh GPM is made for every run, as the command line does, so
+metadata I/O is part of the time. Walking the tree and loading and saving
+local metadata are timed on their own too. So are hashing and encrypting
+and decrypting streams, the inner loops of the pipeline.
+
+The page cache is not dropped, so cold runs read files from memory too.
+Each run is repeated and the best time is kept.
+
+Results are written as JSON. Given the results of a previous run as a
+baseline, the runs which got slower than the threshold are reported and
+the exit status is 1, so an upgrade could be gated on it.
+
+Usage::
+
+    python -m benchmarks.bench_suite --output baseline.json
+    python -m benchmarks.bench_suite --shapes tiny deep --baseline baseline.json --output results.json
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, NamedTuple
+
+from git_privacy_manager import GPM, __version__
+from git_privacy_manager.gpm import checksum, get_all_files
+from git_privacy_manager.utils.crypto import Crypto
+from git_privacy_manager.utils.metadata import open_store
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+PASSPHRASE = '123'
+# Cheap key derivation, so it does not hide the rest
+KDF_ITERATIONS = 1000
+# Slower runs than this share of the baseline are regressions
+THRESHOLD = 0.2
+# Differences shorter than this many seconds are noise
+MIN_DIFFERENCE = 0.005
+# Size of data hashed, encrypted and decrypted by the pipeline runs
+STREAM_SIZE = 64 * UNITS['M']
+
+Result = Dict[str, Any]
+
+
+class Shape(NamedTuple):
+    # Number of files at scale 1
+    files: int
+    # Size of each file
+    size: int
+    # Levels of directories files are nested in
+    depth: int
+    # Subdirectories of each directory
+    fanout: int
+    # Share of files renamed between runs
+    renamed: float
+
+
+SHAPES = {
+    'tiny': Shape(10000, 64, 1, 64, 0.0),
+    'huge': Shape(4, 64 * UNITS['M'], 0, 1, 0.0),
+    'deep': Shape(2000, 1024, 12, 2, 0.0),
+    'renames': Shape(2000, 16 * UNITS['K'], 2, 8, 0.5),
+}
+
+
+def file_path(i: int, shape: Shape) -> Path:
+    parts = []
+    n = i
+    for _ in range(shape.depth):
+        parts.append(f'd{n % shape.fanout}')
+        n //= shape.fanout
+    return Path(*parts, f'f{i:06}')
+
+
+def make_tree(directory: Path, shape: Shape, files: int):
+    """
+    Generate a tree of files with random content
+    """
+    block = os.urandom(min(shape.size, UNITS['M']))
+    for i in range(files):
+        path = directory / file_path(i, shape)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            # Files differ even if they are smaller than the prefix
+            f.write((b'%d ' % i)[:shape.size])
+            for offset in range(len(b'%d ' % i), shape.size, len(block)):
+                f.write(block[:shape.size - offset])
+
+
+def rename_files(directory: Path, shape: Shape, files: int) -> int:
+    """
+    Rename a share of files of a tree in place
+
+    The last files are renamed, so the first one is kept for changes.
+
+    Returns
+    -------
+    int
+        Number of renamed files.
+    """
+    renamed = int(files * shape.renamed)
+    for i in range(files - renamed, files):
+        path = directory / file_path(i, shape)
+        path.rename(path.with_name(f'r{i:06}'))
+    return renamed
+
+
+def modify_file(directory: Path, shape: Shape):
+    path = directory / file_path(0, shape)
+    with open(path, 'r+b') as f:
+        f.write(os.urandom(min(shape.size, 16)))
+
+
+def timed(func: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run_shape(shape: Shape, files: int) -> Dict[str, Result]:
+    """
+    Time encrypt and decrypt runs on a tree of a shape
+    """
+    top = Path(tempfile.mkdtemp())
+    try:
+        working_dir = top / 'work'
+        clone_dir = top / 'clone'
+        working_dir.mkdir()
+        clone_dir.mkdir()
+        make_tree(working_dir, shape, files)
+        output_dir = working_dir / '.gpm' / 'data'
+        size = files * shape.size
+        results = {}
+
+        def encrypt():
+            GPM(working_dir, PASSPHRASE, kdf_iterations=KDF_ITERATIONS).encrypt()
+
+        def decrypt():
+            GPM(clone_dir, PASSPHRASE, output_dir).decrypt()
+
+        results['cold_encrypt'] = result(timed(encrypt), files, size)
+        results['noop_encrypt'] = result(timed(encrypt), files, size)
+        modify_file(working_dir, shape)
+        results['change_encrypt'] = result(timed(encrypt), 1, shape.size)
+        if shape.renamed:
+            renamed = rename_files(working_dir, shape, files)
+            results['rename_encrypt'] = result(timed(encrypt), renamed, renamed * shape.size)
+
+        results['cold_decrypt'] = result(timed(decrypt), files, size)
+        results['noop_decrypt'] = result(timed(decrypt), files, size)
+        modify_file(clone_dir, shape)
+        results['change_decrypt'] = result(timed(decrypt), 1, shape.size)
+
+        exclude = [working_dir / '.gpm']
+        results['walk'] = result(timed(lambda: get_all_files(working_dir, exclude)), files, 0)
+        store = open_store(working_dir / '.gpm')
+        metadata: Dict[str, Any] = {}
+        results['metadata_load'] = result(timed(lambda: metadata.update(store.load())), files, 0)
+        results['metadata_save'] = result(
+            timed(lambda: store.commit(metadata, set(metadata), set(), set())), files, 0)
+        store.close()
+        return results
+    finally:
+        shutil.rmtree(top)
+
+
+def run_pipeline(size: int) -> Dict[str, Result]:
+    """
+    Time hashing, encryption and decryption of a stream
+    """
+    directory = Path(tempfile.mkdtemp())
+    try:
+        plain = directory / 'plain'
+        data = os.urandom(size)
+        plain.write_bytes(data)
+        crypto = Crypto(Crypto.generate_key())
+        blocks = [data[offset:offset + UNITS['M']] for offset in range(0, size, UNITS['M'])]
+        encrypted: List[bytes] = []
+
+        def encrypt():
+            encrypted[:] = [bytes(c) for c in crypto.encrypt_stream(iter(blocks))]
+
+        def decrypt():
+            for _ in crypto.decrypt_stream(iter(encrypted)):
+                pass
+
+        return {
+            'checksum': result(timed(lambda: checksum(plain)), 1, size),
+            'encrypt_stream': result(timed(encrypt), 1, size),
+            'decrypt_stream': result(timed(decrypt), 1, size),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+def result(seconds: float, files: int, size: int) -> Result:
+    return {'seconds': seconds, 'files': files, 'bytes': size}
+
+
+def best(runs: List[Dict[str, Result]]) -> Dict[str, Result]:
+    return {name: min((run[name] for run in runs), key=lambda r: r['seconds']) for name in runs[0]}
+
+
+def compare(results: Dict[str, Result], baseline: Dict[str, Result],
+            threshold: float = THRESHOLD) -> Dict[str, Dict[str, Any]]:
+    """
+    Compare times of runs with the baseline
+
+    Returns
+    -------
+    dict
+        Baseline and current seconds, their ratio and whether it is a
+        regression by name of every run found in both.
+    """
+    comparison = {}
+    for name in sorted(results.keys() & baseline.keys()):
+        seconds = results[name]['seconds']
+        base = baseline[name]['seconds']
+        ratio = seconds / base if base > 0 else float('inf')
+        comparison[name] = {
+            'baseline': base, 'seconds': seconds, 'ratio': ratio,
+            'regression': ratio > 1 + threshold and seconds - base > MIN_DIFFERENCE,
+        }
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shapes', nargs='+', choices=sorted(SHAPES), default=sorted(SHAPES))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply numbers of files by this')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs is reported')
+    parser.add_argument('--no-pipeline', dest='pipeline', action='store_false',
+                        help='Do not time hashing and encryption of streams')
+    parser.add_argument('--output', type=Path, help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=Path, help='Compare with results of a previous run')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Slower runs than this share of the baseline fail the comparison')
+    args = parser.parse_args()
+
+    results: Dict[str, Result] = {}
+    for name in args.shapes:
+        shape = SHAPES[name]
+        files = max(1, round(shape.files * args.scale))
+        for run, timing in best([run_shape(shape, files) for _ in range(args.repeat)]).items():
+            results[f'{name}/{run}'] = timing
+    if args.pipeline:
+        size = max(UNITS['M'], round(STREAM_SIZE * args.scale))
+        for run, timing in best([run_pipeline(size) for _ in range(args.repeat)]).items():
+            results[f'pipeline/{run}'] = timing
+
+    report: Dict[str, Any] = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'results': results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare(results, json.load(f)['results'], args.threshold)
+        report['comparison'] = comparison
+        regressions = [name for name, c in comparison.items() if c['regression']]
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print(f'{"run":<28} {"seconds":>9} {"files/s":>10} {"MB/s":>8} {"baseline":>9} {"ratio":>6}')
+    for name, timing in results.items():
+        seconds = max(timing['seconds'], 1e-9)
+        line = (f'{name:<28} {seconds:>9.3f} {timing["files"] / seconds:>10.0f} '
+                f'{timing["bytes"] / seconds / UNITS["M"]:>8.0f}')
+        c = report.get('comparison', {}).get(name)
+        if c:
+            line += f' {c["baseline"]:>9.3f} {c["ratio"]:>6.2f}{" !" if c["regression"] else ""}'
+        print(line)
+    if regressions:
+        print(f'{len(regressions)} runs are slower than baseline: {", ".join(regressions)}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
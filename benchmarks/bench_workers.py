@@ -0,0 +1,72 @@
+"""
+Benchmark scaling of encryption and decryption with number of workers.
+
+Usage::
+
+    python -m benchmarks.bench_workers --files 3000 --size 65536
+"""
+import argparse
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+
+from git_privacy_manager import GPM
+
+
+def make_tree(directory: Path, files: int, size: int):
+    for i in range(files):
+        subdir = directory / f'd{i % 32:02}'
+        subdir.mkdir(exist_ok=True)
+        with open(subdir / f'f{i:06}', 'wb') as f:
+            f.write(os.urandom(size))
+
+
+def run(directory: Path, workers: int):
+    output = Path(tempfile.mkdtemp())
+    try:
+        shutil.rmtree(directory / '.gpm', ignore_errors=True)
+        gpm = GPM(directory, '123', output, workers=workers)
+        start = time.perf_counter()
+        gpm.encrypt()
+        encrypt = time.perf_counter() - start
+
+        # Force every file to be re-hashed and decrypted
+        gpm.paranoid = True
+        for key in gpm._all_files:
+            (directory / key).unlink()
+        start = time.perf_counter()
+        gpm.decrypt()
+        decrypt = time.perf_counter() - start
+        return encrypt, decrypt
+    finally:
+        shutil.rmtree(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--files', type=int, default=3000)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    directory = Path(tempfile.mkdtemp())
+    try:
+        make_tree(directory, args.files, args.size)
+        total = args.files * args.size / 2**20
+        print(f'{args.files} files, {total:.1f} MiB')
+        print(f'{"workers":>8} {"encrypt, s":>11} {"decrypt, s":>11} {"speedup":>8}')
+        base = None
+        workers = 1
+        while workers <= args.max_workers:
+            encrypt, decrypt = run(directory, workers)
+            base = base or encrypt + decrypt
+            print(f'{workers:>8} {encrypt:>11.2f} {decrypt:>11.2f} {base / (encrypt + decrypt):>8.2f}')
+            workers *= 2
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+"""
+Trees of tiny files shared by the benchmarks.
+
+Files are spread over 64 directories, so time is spent on listing,
+indexing and metadata, not on crypto.
+"""
+from pathlib import Path
+
+
+def tree_file(directory: Path, i: int) -> Path:
+    return directory / f'd{i % 64:02}' / f'f{i:06}'
+
+
+def make_tree(directory: Path, files: int):
+    for i in range(files):
+        file = tree_file(directory, i)
+        file.parent.mkdir(exist_ok=True)
+        file.write_bytes(b'%d' % i)
@@ -0,0 +1,261 @@
+"""
+Agent which keeps derived master keys in memory.
+
+Like ssh-agent, ``gpm agent`` is a long running process listening on a
+Unix socket. It runs encrypt and decrypt for clients, so neither master
+key derivation nor imports are paid on every call. A master key is kept
+for a while after its last use and then forgotten.
+
+Requests and replies are JSON objects, one per line. A request has
+*command* and its arguments:
+
+* *encrypt*, *decrypt*, *repack* and *gc* take *directory*, *output*,
+  *options* of :class:`GPM`, keyword *args* of the command and an optional
+  *passphrase*. If the agent has no master
+  key for the output directory and no passphrase is given, the reply
+  asks for it. A key is kept only if it decrypts the encrypted
+  manifest. The reply of a dry run has the plan as *result*. If
+  *stats* is true, the reply has stats of the command too (see
+  :class:`Stats`).
+* *status* lists output directories with known keys and seconds until
+  they are forgotten.
+* *stop* stops the agent.
+
+A reply has *ok* and either the result or *error*.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import socketserver
+import stat
+import tempfile
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from .gpm import GPM, WrongKeyError
+from .utils import kdf
+from .utils.stats import Stats
+
+SOCKET_ENV = 'GPM_AGENT_SOCK'
+DEFAULT_TTL = 3600
+
+Message = Dict[str, Any]
+
+# Unix sockets and user IDs are missing on Windows, so there is no agent
+AVAILABLE = hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
+
+
+def socket_path() -> Path:
+    """
+    Get path of the agent socket
+
+    Returns
+    -------
+    Path
+        Path from *GPM_AGENT_SOCK* environment variable or a path in
+        the user's runtime directory.
+    """
+    if os.environ.get(SOCKET_ENV):
+        return Path(os.environ[SOCKET_ENV])
+    runtime = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return Path(runtime) / f'gpm-{os.getuid()}' / 'agent.sock'
+
+
+def check_directory(directory: Path):
+    """
+    Check that directory of the socket is private to the user
+
+    Otherwise another user could listen on the socket and get passphrases.
+
+    Raises
+    ------
+    RuntimeError
+        If directory is a symlink, is owned by another user or is
+        accessible by other users.
+    """
+    st = os.lstat(directory)
+    if stat.S_ISLNK(st.st_mode) or not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError(f'Agent directory "{directory}" is not a directory')
+    if st.st_uid != os.getuid():
+        raise RuntimeError(f'Agent directory "{directory}" is owned by another user')
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        raise RuntimeError(f'Agent directory "{directory}" must have mode 0700, '
+                           f'not {stat.S_IMODE(st.st_mode):04o}')
+
+
+def request(message: Message, path: Optional[Path] = None) -> Optional[Message]:
+    """
+    Send a request to the agent
+
+    Parameters
+    ----------
+    message : dict
+        Request.
+    path : Path
+        Socket of the agent. Default is :func:`socket_path`.
+
+    Returns
+    -------
+    dict
+        Reply or None if no agent is running or agents are not supported.
+
+    Raises
+    ------
+    RuntimeError
+        If directory of the socket is not private (see
+        :func:`check_directory`).
+    """
+    if not AVAILABLE:
+        return None
+    path = path or socket_path()
+    try:
+        check_directory(path.parent)
+    except FileNotFoundError:
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(str(path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        with s.makefile('rwb') as f:
+            f.write(json.dumps(message).encode() + b'\n')
+            f.flush()
+            return json.loads(f.readline())
+
+
+class Agent:
+    """
+    Serves requests of clients with cached master keys.
+    """
+
+    def __init__(self, path: Optional[Path] = None, ttl: float = DEFAULT_TTL):
+        """
+        Parameters
+        ----------
+        path : Path
+            Socket to listen on. Default is :func:`socket_path`.
+        ttl : float
+            Seconds a master key is kept after its last use.
+        """
+        self.path = path or socket_path()
+        self.ttl = ttl
+        # Derivation parameters, master key and expiration time by output directory
+        self._keys: Dict[str, Tuple[kdf.Params, bytes, float]] = {}
+        self._running = False
+
+    def serve(self):
+        """
+        Serve requests until *stop* is received.
+
+        Raises
+        ------
+        RuntimeError
+            If agents are not supported, another agent listens on the
+            socket or directory of the socket is not private.
+        """
+        if not AVAILABLE:
+            raise RuntimeError('Agent needs Unix sockets')
+        if request({'command': 'status'}, self.path) is not None:
+            raise RuntimeError(f'Agent is already running on "{self.path}"')
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        check_directory(self.path.parent)
+        if os.path.lexists(self.path):
+            # Left by an agent which has not stopped cleanly
+            self.path.unlink()
+
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    reply = agent.handle(json.loads(self.rfile.readline()))
+                except ValueError as e:
+                    reply = {'ok': False, 'error': f'Malformed request: {e}'}
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        old_umask = os.umask(0o177)
+        try:
+            server = socketserver.UnixStreamServer(str(self.path), Handler)
+        finally:
+            os.umask(old_umask)
+        logging.info('Agent listens on "%s"', self.path)
+        self._running = True
+        with server:
+            # Wake up regularly to forget expired keys
+            server.timeout = 1
+            try:
+                while self._running:
+                    server.handle_request()
+                    self._expire()
+            finally:
+                self._keys.clear()
+                self.path.unlink()
+
+    def handle(self, message: Message) -> Message:
+        """
+        Handle a single request.
+        """
+        self._expire()
+        command = message.get('command')
+        if command == 'status':
+            now = time.monotonic()
+            return {'ok': True, 'pid': os.getpid(),
+                    'keys': {output: round(expires - now)
+                             for output, (_, _, expires) in self._keys.items()}}
+        if command == 'stop':
+            self._running = False
+            return {'ok': True}
+        if command in ('encrypt', 'decrypt', 'repack', 'gc'):
+            return self._run(command, message)
+        return {'ok': False, 'error': f'Unknown command "{command}"'}
+
+    def _run(self, command: str, message: Message) -> Message:
+        try:
+            directory = Path(message['directory'])
+            output = Path(message['output']) if message.get('output') else None
+            stats = Stats() if message.get('stats') else None
+            gpm = GPM(directory, message.get('passphrase'), output,
+                      stats=stats, **message.get('options', {}))
+            output_dir = str(gpm.output_dir.resolve())
+            if not message.get('passphrase'):
+                if output_dir in self._keys:
+                    params, master_key, _ = self._keys[output_dir]
+                    try:
+                        gpm.unlock(master_key, params)
+                    except WrongKeyError:
+                        # The manifest is sealed with another key since
+                        self._keys.pop(output_dir)
+                try:
+                    params = gpm.kdf_params
+                except RuntimeError:
+                    # No key or derivation parameters have changed
+                    self._keys.pop(output_dir, None)
+                    return {'ok': False, 'error': 'Passphrase is required', 'passphrase': True}
+            result = getattr(gpm, command)(**message.get('args', {}))
+            # Only a key which decrypts the manifest is kept
+            if gpm.check_key():
+                self._keys[output_dir] = (
+                    gpm.kdf_params, gpm.key, time.monotonic() + self.ttl)
+        except WrongKeyError as e:
+            self._keys.pop(output_dir, None)
+            logging.error('Failed to %s "%s": %s', command, message.get('directory'), e)
+            return {'ok': False, 'error': str(e)}
+        except Exception as e:
+            logging.error('Failed to %s "%s": %s', command, message.get('directory'), e)
+            return {'ok': False, 'error': str(e)}
+        reply: Message = {'ok': True}
+        if result is not None:
+            reply['result'] = result.to_dict()
+        if stats is not None:
+            reply['stats'] = stats.to_dict()
+        return reply
+
+    def _expire(self):
+        now = time.monotonic()
+        for output, (_, _, expires) in list(self._keys.items()):
+            if expires <= now:
+                logging.info('Forget master key of "%s"', output)
+                del self._keys[output]
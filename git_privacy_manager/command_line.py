@@ -1,6 +1,12 @@
 import click
 from getpass import getpass
 from git_privacy_manager import GPM
+from git_privacy_manager import agent as gpm_agent
+from git_privacy_manager import watch as gpm_watch
+from git_privacy_manager.utils import hashing, kdf
+from git_privacy_manager.utils.plan import Plan
+from git_privacy_manager.utils.stats import Stats, format_report
+import json
 import os
 from pathlib import Path
 
@@ -10,37 +16,244 @@ from pathlib import Path
 @click.option('--directory', '-d', help='Path to working directory (default: current)', type=click.Path(), default=os.getcwd())
 @click.option('--output', '-o', help='Path to output directory', type=click.Path(), default=None)
 @click.option('--passphrase', '-p', help='Passphrase for symmetric encryption', type=str, default=None)
-def main(ctx, directory, output, passphrase):
+@click.option('--paranoid', help='Re-hash every file instead of trusting cached file stats', is_flag=True)
+@click.option('--jobs', '-j', help='Number of threads to hash, encrypt and decrypt files', type=click.IntRange(min=1), default=1)
+@click.option('--chunking', help='Split large files into content-defined chunks to re-encrypt only changed parts', is_flag=True)
+@click.option('--dedup', help='Store files with the same content in a single blob', is_flag=True)
+@click.option('--metadata', help='Backend of local metadata', type=click.Choice(['json', 'sqlite']), default='json')
+@click.option('--kdf-iterations', help='Cost of master key derivation for a new output directory', type=click.IntRange(min=1), default=kdf.ITERATIONS)
+@click.option('--compress', help='Compress files before encryption unless they do not shrink', type=click.Choice(['zlib', 'zstd']), default=None)
+@click.option('--compress-level', help='Level of compression', type=int, default=None)
+@click.option('--hash', 'hash_algorithm', help='Hash to detect changes of files', type=click.Choice(hashing.ALGORITHMS), default=hashing.DEFAULT)
+@click.option('--pack', help='Store small files in packs instead of a blob per file', is_flag=True)
+@click.option('--progress', help='Report progress of encrypt', is_flag=True)
+@click.option('--stats', 'show_stats', help='Report time, files and bytes by phase to standard error', is_flag=True)
+@click.option('--stats-json', help='Write time, files and bytes by phase as JSON to this file', type=click.Path(), default=None)
+@click.option('--agent/--no-agent', help='Run commands in gpm agent if it is running (default: yes)', default=True)
+def main(ctx, directory, output, passphrase, paranoid, jobs, chunking, dedup, metadata, kdf_iterations,
+         compress, compress_level, hash_algorithm, pack, progress, show_stats, stats_json, agent):
     #    args.function(git_privacy_manager.GPM(Path(args.path), pswd, Path(args.output)))
-    directory = Path(directory)
-    if output:
-        output = Path(output)
-
-    gpm = GPM(directory, passphrase, output)
-
     ctx.obj = {
-        'gpm': gpm,
+        'directory': Path(directory),
+        'output': Path(output) if output else None,
         'passphrase': passphrase,
+        'options': {
+            'paranoid': paranoid,
+            'workers': jobs,
+            'chunking': chunking,
+            'dedup': dedup,
+            'metadata': metadata,
+            'kdf_iterations': kdf_iterations,
+            'compression': compress,
+            'compression_level': compress_level,
+            'hash_algorithm': hash_algorithm,
+            'pack': pack,
+            'progress': progress,
+        },
+        'agent': agent,
+        'stats': show_stats,
+        'stats_json': Path(stats_json) if stats_json else None,
     }
 
 
+def _run(ctx, command: str, **kwargs):
+    obj = ctx.obj
+    # Dry runs leave output and metadata directories as they are
+    options = dict(obj['options'], read_only=True) if kwargs.get('dry_run') else obj['options']
+    if obj['agent']:
+        message = {
+            'command': command,
+            'directory': str(obj['directory'].resolve()),
+            'output': str(obj['output'].resolve()) if obj['output'] else None,
+            'options': options,
+            'args': kwargs,
+            'passphrase': obj['passphrase'],
+            'stats': _stats_on(obj),
+        }
+        try:
+            reply = gpm_agent.request(message)
+            if reply is not None and reply.get('passphrase'):
+                message['passphrase'] = getpass(prompt='Enter a passphrase:')
+                reply = gpm_agent.request(message)
+                if reply is None:
+                    raise click.ClickException('Agent has stopped')
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        if reply is not None:
+            if not reply['ok']:
+                raise click.ClickException(reply['error'])
+            if 'stats' in reply:
+                _report_stats(obj, reply['stats'])
+            return reply.get('result')
+
+    stats = Stats() if _stats_on(obj) else None
+    gpm = _gpm(obj, stats, options)
+    try:
+        result = getattr(gpm, command)(**kwargs)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    finally:
+        if stats is not None:
+            _report_stats(obj, stats.to_dict())
+    return result.to_dict() if result is not None else None
+
+
+def _stats_on(obj) -> bool:
+    return obj['stats'] or obj['stats_json'] is not None
+
+
+def _report_stats(obj, stats):
+    if obj['stats']:
+        click.echo(format_report(stats), err=True)
+    if obj['stats_json'] is not None:
+        with open(obj['stats_json'], 'w') as f:
+            json.dump(stats, f, indent=2)
+
+
+def _gpm(obj, stats=None, options=None) -> GPM:
+    gpm = GPM(obj['directory'], obj['passphrase'], obj['output'], stats=stats,
+              **(options or obj['options']))
+    if not obj['passphrase']:
+        passphrase = getpass(prompt='Enter a passphrase:')
+        gpm.key = passphrase
+    return gpm
+
+
+def _patterns(directory: Path, paths) -> list:
+    # Paths are given relative to current directory, but GPM needs them
+    # relative to working directory
+    patterns = []
+    for path in paths:
+        pattern = os.path.relpath(os.path.abspath(path), directory.resolve())
+        if pattern == '..' or pattern.startswith('..' + os.sep):
+            raise click.BadParameter(f'"{path}" is not in working directory')
+        patterns.append(pattern)
+    return patterns
+
+
+def _plan(obj, command: str, **kwargs):
+    # Plan of encrypt needs no master key, so neither agent nor passphrase
+    gpm = GPM(obj['directory'], obj['passphrase'], obj['output'], read_only=True, **obj['options'])
+    try:
+        return getattr(gpm, command)(**kwargs).to_dict()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+def _echo_plan(plan, as_json: bool):
+    if as_json:
+        click.echo(json.dumps(plan, indent=2))
+    else:
+        click.echo(str(Plan.from_dict(plan)))
+
+
 @main.command()
+@click.argument('paths', nargs=-1)
+@click.option('--dry-run', '-n', help='Only show what would be encrypted', is_flag=True)
+@click.option('--json', 'as_json', help='Show the plan of a dry run as JSON', is_flag=True)
 @click.pass_context
-def encrypt(ctx):
-    """Encrypt working directory."""
-    if not ctx.obj['passphrase']:
-        passphrase = getpass(prompt='Enter a passphrase:')
-        ctx.obj['gpm'].set_passphrase(passphrase)
+def encrypt(ctx, paths, dry_run, as_json):
+    """Encrypt working directory.
 
-    ctx.obj['gpm'].encrypt()
+    If PATHS are given only the matching files are encrypted. A path may
+    be a file, a directory or a glob like "config/prod/**".
+    """
+    patterns = _patterns(ctx.obj['directory'], paths) if paths else None
+    if dry_run:
+        _echo_plan(_plan(ctx.obj, 'encrypt', paths=patterns, dry_run=True), as_json)
+        return
+    _run(ctx, 'encrypt', paths=patterns)
 
 
 @main.command()
+@click.argument('paths', nargs=-1)
+@click.option('--dry-run', '-n', help='Only show what would be decrypted', is_flag=True)
+@click.option('--json', 'as_json', help='Show the plan of a dry run as JSON', is_flag=True)
 @click.pass_context
-def decrypt(ctx):
-    """Decrypt working directory."""
-    if not ctx.obj['passphrase']:
-        passphrase = getpass(prompt='Enter a passphrase:')
-        ctx.obj['gpm'].set_passphrase(passphrase)
+def decrypt(ctx, paths, dry_run, as_json):
+    """Decrypt working directory.
+
+    If PATHS are given only the matching files are decrypted. A path may
+    be a file, a directory or a glob like "config/prod/**".
+    """
+    patterns = _patterns(ctx.obj['directory'], paths) if paths else None
+    if dry_run:
+        _echo_plan(_run(ctx, 'decrypt', paths=patterns, dry_run=True), as_json)
+        return
+    _run(ctx, 'decrypt', paths=patterns)
+
+
+@main.command()
+@click.argument('paths', nargs=-1)
+@click.option('--json', 'as_json', help='Show changes as JSON', is_flag=True)
+@click.pass_context
+def status(ctx, paths, as_json):
+    """Show changes of working directory since the last encrypt.
+
+    Files are compared by cached stats only, so it is fast, but a touched
+    file is shown as modified. If PATHS are given only the matching files
+    are shown.
+    """
+    _echo_plan(_plan(ctx.obj, 'plan', paths=_patterns(ctx.obj['directory'], paths) if paths else None), as_json)
+
+
+@main.command()
+@click.option('--debounce', help='Seconds without changes before they are encrypted', type=click.FloatRange(min=0), default=gpm_watch.DEBOUNCE)
+@click.option('--poll', help='Walk working directory instead of using inotify', is_flag=True)
+@click.pass_context
+def watch(ctx, debounce, poll):
+    """Encrypt working directory as it changes.
+
+    Changes are collected until none come for a while, then only the
+    changed files are encrypted.
+    """
+    stats = Stats() if _stats_on(ctx.obj) else None
+    gpm = _gpm(ctx.obj, stats)
+    try:
+        gpm_watch.watch(gpm, debounce, poll)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    finally:
+        if stats is not None:
+            _report_stats(ctx.obj, stats.to_dict())
+
+
+@main.command()
+@click.pass_context
+def repack(ctx):
+    """Compact packs with removed or replaced files."""
+    _run(ctx, 'repack')
+
+
+@main.command()
+@click.pass_context
+def gc(ctx):
+    """Compact packs and remove unreferenced blobs."""
+    _run(ctx, 'gc')
+
+
+@main.command()
+@click.option('--ttl', help='Seconds to keep a master key after its last use', type=click.IntRange(min=1), default=gpm_agent.DEFAULT_TTL)
+@click.option('--status', 'show_status', help='Show status of running agent', is_flag=True)
+@click.option('--stop', help='Stop running agent', is_flag=True)
+def agent(ttl, show_status, stop):
+    """Keep master keys in memory and run commands for clients.
+
+    The agent listens on $GPM_AGENT_SOCK or a socket in the user's runtime
+    directory.
+    """
+    if show_status or stop:
+        try:
+            reply = gpm_agent.request({'command': 'stop' if stop else 'status'})
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        if reply is None:
+            raise click.ClickException('Agent is not running')
+        if show_status:
+            click.echo(json.dumps(reply, indent=2))
+        return
 
-    ctx.obj['gpm'].decrypt()
+    try:
+        gpm_agent.Agent(ttl=ttl).serve()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
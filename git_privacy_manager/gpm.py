@@ -1,18 +1,51 @@
 import base64
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from contextlib import contextmanager, nullcontext
 import hashlib
+import io
+import itertools
 import json
 import logging
+import os
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+import threading
+from typing import Any, Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 from uuid import uuid4
 
-from .utils.crypto import Crypto
+from .utils import atomic, chunking, compression as _compression, hashing, kdf, lock, packs
+from .utils.atomic import atomic_write
+from .utils.buffers import BUFFER_SIZE, Buffer, hash_file, read_blocks
+from .utils.crypto import Crypto, InvalidToken
+from .utils.journal import Journal
+from .utils.metadata import open_store
+from .utils.parallel import imap
+from .utils.plan import Plan
+from .utils.progress import Progress
+from .utils.stats import Stats
+from .utils.walk import PathFilter, walk
 
 # TODO Fix type
 DataBase = Dict[str, Dict[str, Any]]
+# Size, mtime (ns), inode and ctime (ns) of a file
+FileStat = List[int]
+
+_MANIFEST_VERSION = 3
+# Times to read a file which changes while it is hashed and encrypted
+_READ_ATTEMPTS = 3
+# Files smaller than this are stored in packs if packing is on
+_PACK_MEMBER_SIZE = 64 * 1024
+# Packs with less live data than this share are compacted by repack
+_PACK_MIN_LIVE = 0.5
+# Encrypted files are committed after this many files or bytes
+CHECKPOINT_FILES = 1000
+CHECKPOINT_SIZE = 1024 * 1024 * 1024
+# Phase of disabled stats
+_NO_PHASE = nullcontext()
+
+
+class WrongKeyError(RuntimeError):
+    """
+    Master key does not decrypt the encrypted manifest.
+    """
 
 
 class GPM:
@@ -28,10 +61,25 @@ class GPM:
     -----
 
     In a code by "blob" the "encrypted file" is ment.
+
+    Blobs are never overwritten in place. Encrypt writes them under
+    temporary names and journals every encrypted file, then replaces the
+    old blobs and commits metadata. The encrypted manifest is written
+    only after that, and old blobs are removed only after the manifest
+    no longer refers to them. An interrupted encrypt is recovered from
+    the journal by the next one.
     """
 
     # TODO Add callback function to receive a passphrase
-    def __init__(self, directory: Path, key: str = None, output: Path = None):
+    def __init__(self, directory: Path, key: Optional[str] = None, output: Optional[Path] = None,
+                 paranoid: bool = False, workers: int = 1, chunking: bool = False,
+                 dedup: bool = False, metadata: str = 'json',
+                 kdf_iterations: int = kdf.ITERATIONS,
+                 compression: Optional[str] = None, compression_level: Optional[int] = None,
+                 buffer_size: int = BUFFER_SIZE, mmap: bool = False,
+                 hash_algorithm: str = hashing.DEFAULT, pack: bool = False,
+                 checkpoint_files: int = CHECKPOINT_FILES, checkpoint_size: int = CHECKPOINT_SIZE,
+                 progress: bool = False, stats: Optional[Stats] = None, read_only: bool = False):
         """
         Parameters
         ----------
@@ -40,50 +88,225 @@ class GPM:
             Path to working directory with files to encrypt
         key : str
             Password for symmetric encryption
+        paranoid : bool
+            Ignore cached file stats and re-hash every file
+        workers : int
+            Number of threads to hash, encrypt and decrypt files
+        chunking : bool
+            Split large files into content-defined chunks which are
+            encrypted into separate blobs
+        dedup : bool
+            Store files with the same content in a single blob
+        metadata : str
+            Backend of local metadata: *json* or *sqlite*
+        kdf_iterations : int
+            Cost of master key derivation for a new output directory
+        compression : str
+            Compress files with *zlib* or *zstd* before encryption unless
+            they do not shrink
+        compression_level : int
+            Level of compression
+        buffer_size : int
+            Size of blocks files are read, hashed and encrypted by
+        mmap : bool
+            Hash files mapped into memory instead of reading them
+        hash_algorithm : str
+            Hash to detect changes of files: *sha256*, *blake2b*,
+            *blake3* or *md5*. Files hashed by another one are hashed
+            by it when they are hashed next time.
+        pack : bool
+            Store small files in packs instead of a blob per file
+        checkpoint_files : int
+            Commit encrypted files to local metadata after this many
+            files, so an interrupted encrypt resumes from there
+        checkpoint_size : int
+            Commit encrypted files after this many bytes
+        progress : bool
+            Report progress of encrypt to standard error
+        stats : Stats
+            Stats to count time, files and bytes of phases of encrypt and
+            decrypt into
+        read_only : bool
+            Only plan encrypt and decrypt. No directory is created and
+            nothing is written, not even recovery of an interrupted
+            encrypt: files it journaled are planned as encrypted.
 
         Notes
         -----
 
         The *.gpm* folder will be created to store metadata.
         The *.gpm/data* folder will be created to store encrypted blobs.
+        The master key is derived from passphrase on first use with
+        parameters from *kdf.json* in output directory.
         """
-        if key:
-            self._crypto_key : bytes = self._safe_key(key)
+        self._passphrase = key
+        self._crypto_key = b''
+        # Parameters the master key is derived with
+        self._kdf: Optional[kdf.Params] = None
+        self._new_kdf: Optional[kdf.Params] = None
+        self._kdf_iterations = kdf_iterations
 
         self._working_dir = directory.resolve()
         self._metadata_dir = self._working_dir / '.gpm'
-        self._metafile = self._metadata_dir / 'metafile'
         if not output:
             self._output_dir = self._metadata_dir / 'data'
         else:
             self._output_dir = output
         self._metafile_blob = self._output_dir / 'meta.gpg'
+        self._kdf_file = self._output_dir / 'kdf.json'
+        self.paranoid = paranoid
+        self._workers = workers
+        self.chunking = chunking
+        self.dedup = dedup
+        self.compression = compression
+        self.compression_level = compression_level
+        self.buffer_size = buffer_size
+        self.mmap = mmap
+        self.hash_algorithm = hash_algorithm
+        self.pack = pack
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_size = checkpoint_size
+        self.progress = progress
+        self.stats = stats
+        self.read_only = read_only
+        # Whether the lock of output directory is held
+        self._locked = False
 
-        self._metadata_dir.mkdir(exist_ok=True, parents=True)
-        self._output_dir.mkdir(exist_ok=True, parents=True)
+        if not read_only:
+            self._metadata_dir.mkdir(exist_ok=True, parents=True)
+            self._output_dir.mkdir(exist_ok=True, parents=True)
+        self._store = open_store(self._metadata_dir, metadata, read_only)
 
-        self._all_files: List[Path] = []
+        # Stats of files in working directory by relative path
+        self._all_files: Dict[str, FileStat] = {}
         self._metadata: DataBase = {}
-        self._metadata_dirty = False
+        # Keys changed since metadata was saved: published changes,
+        # removals and changes of local stats only
+        self._changed: Set[str] = set()
+        self._removed: Set[str] = set()
+        self._restat: Set[str] = set()
+        # Keys of metadata by UUID
+        self._uuids: Dict[str, str] = {}
+        # Passphrases and compression of chunks by chunk ID
+        self._chunk_keys: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._chunk_keys_lock = threading.Lock()
+        # Chunks being written by other workers, set once a chunk is written or failed
+        self._chunk_writes: Dict[str, threading.Event] = {}
+        # Blobs being written by hash and encrypt in a single read
+        self._temporaries: List[Path] = []
+        self._packs = packs.PackWriter(self._output_dir)
+        self._journal = Journal(self._metadata_dir / 'journal')
+        # Temporary blobs to replace the old ones at the next checkpoint
+        self._renames: List[Tuple[Path, Path]] = []
+        # Old blobs to remove once the manifest is published
+        self._garbage: List[Path] = []
+        # Previous entries of files which are not encrypted yet, None for new files
+        self._unsealed: Dict[str, Optional[Dict[str, Any]]] = {}
+        # Files and bytes encrypted since the last checkpoint
+        self._uncommitted = [0, 0]
+        self._progress: Optional[Progress] = None
 
+        if compression:
+            _compression.check(compression)
+        hashing.check(hash_algorithm)
         self._read_metadata()
-
-    def __del__(self):
-        self._write_metadata()
+        if read_only:
+            for record in self._journal.replay():
+                self._metadata[record['key']] = record['entry']
+        else:
+            with self._exclusive():
+                self._recover()
 
     @property
-    def key(self):
+    def key(self) -> bytes:
+        """
+        Master key derived from passphrase.
+        """
+        self._unlock()
         return self._crypto_key
 
     @key.setter
     def key(self, key: str):
         # TODO Check passphrase complexity
-        self._crypto_key = self._safe_key(key)
+        self._passphrase = key
+        self._kdf = None
+
+    @property
+    def working_dir(self) -> Path:
+        return self._working_dir
+
+    @property
+    def metadata_dir(self) -> Path:
+        return self._metadata_dir
+
+    @property
+    def output_dir(self) -> Path:
+        return self._output_dir
+
+    @property
+    def kdf_params(self) -> kdf.Params:
+        """
+        Parameters the master key is derived with.
+        """
+        self._unlock()
+        return dict(self._kdf or {})
+
+    def unlock(self, master_key: bytes, params: kdf.Params):
+        """
+        Use an already derived master key instead of passphrase.
+
+        The key is used while derivation parameters in output directory
+        are the same.
+
+        Raises
+        ------
+        WrongKeyError
+            If the key does not decrypt the encrypted manifest.
+        """
+        self._check_key(master_key)
+        self._crypto_key = master_key
+        self._kdf = params
+
+    def check_key(self) -> bool:
+        """
+        Check that master key decrypts the encrypted manifest.
+
+        Returns
+        -------
+        bool
+            Whether there is a manifest to check the key against.
+
+        Raises
+        ------
+        WrongKeyError
+            If the key does not decrypt the manifest.
+        """
+        if not self._metafile_blob.is_file():
+            return False
+        self._check_key(self.key)
+        return True
 
-    def decrypt(self):
+    def decrypt(self, paths: Optional[Iterable[str]] = None, dry_run: bool = False) -> Optional[Plan]:
         """
         Decrypt blobs from data directory into working directory.
 
+        Parameters
+        ----------
+        paths : list
+            Patterns of paths relative to working directory to decrypt
+            (see :class:`PathFilter`). Only the manifest shards and the
+            blobs of matching files are read and only matching files in
+            working directory are changed. Then metadata is partial and
+            encrypt is refused until everything is decrypted.
+        dry_run : bool
+            Only read the encrypted manifest and plan the decrypt (see
+            :meth:`_plan_decrypt`). Nothing is written.
+
+        Returns
+        -------
+        Plan
+            The plan if it is a dry run.
+
         Warnings
         --------
         The files from working directory are not removed!
@@ -93,135 +316,1097 @@ class GPM:
         RuntimeError
             If no metafile encrypted blob found.
             If file not in working directory.
+            If GPM is read-only and it is not a dry run.
         """
-        self._read_metadata_blob()
+        path_filter = PathFilter(paths) if paths is not None else None
+        self._unlock()
+        if dry_run:
+            return self._plan_decrypt(path_filter)
+        self._check_writable()
+        self._read_metadata_blob(path_filter)
+        self._list_files()
+        if path_filter is None:
+            selected = list(self._metadata)
+        else:
+            selected = [key for key in self._metadata if path_filter.match(key)]
+
+        # Hash only present files whose stats differ from the cached ones
+        files_to_hash = []
+        for key in selected:
+            if key in self._all_files:
+                if self.paranoid or not self._stat_unchanged(key, self._all_files[key]):
+                    files_to_hash.append((self._working_dir / key, _hash_algorithm(self._metadata[key])))
+        checksums: Dict[Path, str] = dict(zip(
+            (file for file, _ in files_to_hash),
+            imap(self._timed('hash', self._checksum), files_to_hash, self._workers)))
 
         files_to_decrypt = []
-        for key in self._metadata:
+        for key in selected:
             file = self._working_dir / key
-            if not file.is_file() or checksum(file) != self._metadata[key]['checksum']:
-                blob = self._blob(key)
-                passphrase = self._metadata[key]['passphrase'].encode()
-                files_to_decrypt.append((file, blob, passphrase))
+            file_checksum = checksums.get(file, self._metadata[key]['checksum'])
+            if key not in self._all_files or self._differ(file, file_checksum):
+                files_to_decrypt.append((file, key))
 
-        for file, blob, passphrase in files_to_decrypt:
-            self._decrypt_file(blob, file, passphrase)
+        decrypted = imap(self._timed('decrypt', self._decrypt_entry), files_to_decrypt, self._workers)
+        for (file, key), _ in zip(files_to_decrypt, decrypted):
+            # Remember stats of the fresh file so it is not re-hashed later
+            self._all_files[key] = self._metadata[key]['stat'] = stat(file)
+            self._restat.add(key)
 
-        self._remove_remains_in_working_dir()
-        self._remove_ramains_in_output_dir()
+        self._write_metadata()
+        self._remove_remains_in_working_dir(path_filter)
+        if path_filter is None:
+            self._remove_ramains_in_output_dir()
+        return None
 
-    def encrypt(self):
+    def encrypt(self, paths: Optional[Iterable[str]] = None, dry_run: bool = False) -> Optional[Plan]:
         """
         Encrypts files from working directory into data directory.
 
+        Parameters
+        ----------
+        paths : list
+            Patterns of paths relative to working directory to encrypt
+            (see :class:`PathFilter`). Only the matching files are walked
+            and only matching entries are removed if their files are
+            gone. Other entries are kept as they are.
+        dry_run : bool
+            Only plan the encrypt (see :meth:`plan`). Nothing is hashed
+            or written.
+
+        Returns
+        -------
+        Plan
+            The plan if it is a dry run.
+
         Raises
         ------
         RuntimeError
             If fails to generate UUID for a file.
             If file not in working directory.
+            If metadata is partial after selective decrypt.
+            If GPM is read-only and it is not a dry run.
         """
-        self._remove_ramains_in_output_dir()
+        if self._store.settings.get('partial'):
+            raise RuntimeError('Metadata is partial after selective decrypt: decrypt all files first.')
+        if dry_run:
+            return self.plan(paths)
+        self._check_writable()
+        with self._exclusive():
+            self._encrypt(paths)
+        return None
+
+    def _encrypt(self, paths: Optional[Iterable[str]]):
+        self._unlock()
+        # Leftovers of an interrupted run. Journaled blobs are recovered
+        # already and other runs do not write while the lock is held.
+        for temporary in self._output_dir.glob(f'*{atomic.SUFFIX}'):
+            temporary.unlink()
+        if self._kdf and self._kdf['salt'] is not None and not self._kdf_file.is_file():
+            kdf.write_params(self._kdf_file, self._kdf)
+        # Chunks of removed files could be reused by new files
+        self._chunk_keys = self._index_chunks()
+        chunks_before = set(self._chunk_keys)
+        packs_before = self._pack_ids()
+        path_filter = PathFilter(paths) if paths is not None else None
+        self._list_files(path_filter)
+        # Files removed since last commit could be renamed
+        deleted_keys = set(self._deleted_keys(path_filter))
+        renamed_by_stat, renamed_by_checksum = self._index_renames(deleted_keys)
+
+        # Sizes of removed files. A new file of other size is not a renamed one.
+        deleted_sizes = {self._metadata[key].get('stat', [None])[0] for key in deleted_keys}
+
+        # Stat before hashing so a write during hashing is seen next time
+        files_to_hash = []
+        files_to_fuse = []
+        for key, file_stat in self._all_files.items():
+            file = self._working_dir / key
+            if key not in self._metadata and not self.paranoid:
+                old_key = _pop_renamed(renamed_by_stat, _identity(file_stat), deleted_keys)
+                if old_key:
+                    self._rename(old_key, file, file_stat)
+                    continue
+            if key in self._metadata and not self.paranoid and self._stat_unchanged(key, file_stat):
+                logging.debug('Skip file "%s" (%s)', key, self._metadata[key]['uuid'])
+            elif self._likely_modified(key, file_stat, deleted_sizes):
+                files_to_fuse.append((file,))
+            else:
+                files_to_hash.append((file, file_stat))
+
+        self._temporaries = []
+        self._unsealed = {}
+        self._uncommitted = [0, 0]
+        if self.progress:
+            self._progress = Progress(
+                len(files_to_fuse) + len(files_to_hash),
+                sum(self._all_files[self._key(file)][0] for file, in files_to_fuse) +
+                sum(file_stat[0] for _, file_stat in files_to_hash))
+        try:
+            self._commit_fused(files_to_fuse)
+        except (RuntimeError, KeyboardInterrupt):
+            # Encrypted files are committed, the rest are not
+            self._packs.close()
+            self._checkpoint()
+            self._remove_temporaries()
+            raise
 
         files_to_encrypt = []
-        for file in self._all_files:
+        new_keys = set()
+        checksums = imap(self._timed('hash', self._fingerprint), ((file,) for file, _ in files_to_hash), self._workers)
+        for (file, file_stat), (file_checksum, old_checksum, content_id) in zip(files_to_hash, checksums):
             key = self._key(file)
-            file_checksum = checksum(file)
+            old_key = None
             if not self._contains(file):
-                files_to_encrypt.append(self._add(file, file_checksum))
-            elif self._differ(file, file_checksum):
-                files_to_encrypt.append(self._update_checksum(file, file_checksum))
+                old_key = _pop_renamed(
+                    renamed_by_checksum, (self.hash_algorithm, file_checksum), deleted_keys)
+            if old_key:
+                self._rename(old_key, file, file_stat)
+            elif not self._contains(file):
+                self._unsealed[key] = None
+                self._add(file, file_checksum, file_stat)
+                files_to_encrypt.append((file, key, content_id))
+                new_keys.add(key)
+                continue
+            elif self._differ(file, old_checksum):
+                self._unsealed[key] = dict(self._metadata[key])
+                self._update_checksum(file, file_checksum, file_stat)
+                files_to_encrypt.append((file, key, content_id))
+                continue
             else:
-                logging.info(
-                    f'Skip file "{key}" (%s)' % self._metadata[key]['uuid'])
+                # Touched but not modified
+                self._metadata[key]['stat'] = file_stat
+                self._restat.add(key)
+                if file_checksum != old_checksum:
+                    self._migrate_checksum(key, file_checksum)
+                logging.debug('Skip file "%s" (%s)', key, self._metadata[key]['uuid'])
+            if self._progress:
+                self._progress.advance(file_stat[0])
+
+        self._remove_entries(sorted(deleted_keys))
+
+        done = 0
+        try:
+            encrypted = imap(self._timed('encrypt', self._encrypt_entry), files_to_encrypt, self._workers)
+            for (_, key, _), (fields, sealed) in zip(files_to_encrypt, encrypted):
+                entry = self._metadata[key]
+                entry.pop('compression', None)
+                entry.pop('pack', None)
+                entry.update(fields)
+                self._commit_blob(key, sealed)
+                done += 1
+        except (RuntimeError, KeyboardInterrupt):
+            # Failed and cancelled files must be encrypted again next time
+            self._rollback(
+                [file for file, _, _ in files_to_encrypt[done:]], new_keys)
+            self._unsealed = {}
+            self._packs.close()
+            self._checkpoint()
+            self._remove_temporaries()
+            raise
+
+        self._packs.close()
+        self._checkpoint()
+        if self._progress:
+            self._progress.finish()
+            self._progress = None
+        self._write_metadata_blob()
+        atomic.sync_directory(self._output_dir)
+        self._remove_garbage()
+        self._remove_chunks(chunks_before - self._chunk_ids())
+        self._remove_packs(packs_before - self._pack_ids())
 
-        for file, blob, passphrase in files_to_encrypt:
-            self._encrypt_file(file, blob, passphrase)
+    def plan(self, paths: Optional[Iterable[str]] = None) -> Plan:
+        """
+        Plan encrypt of working directory.
+
+        The plan is made from a walk of working directory, cached file
+        stats and local metadata. Nothing is hashed, decrypted or written,
+        so it takes about as long as the walk. A file with other stats
+        than cached is planned as modified even if encrypt would find its
+        content the same, and a new file is planned as renamed only if it
+        has the size, mtime and inode of a removed one.
+
+        Parameters
+        ----------
+        paths : list
+            Patterns of paths relative to working directory to plan
+            encrypt of (see :class:`PathFilter`).
 
+        Returns
+        -------
+        Plan
+            Sizes of files in working directory, and of the removed ones
+            when they were encrypted.
+        """
+        path_filter = PathFilter(paths) if paths is not None else None
+        self._list_files(path_filter)
+        deleted_keys = set(self._deleted_keys(path_filter))
+        renamed_by_stat, _ = self._index_renames(deleted_keys)
+        plan = Plan('encrypt')
+        for key, file_stat in sorted(self._all_files.items()):
+            if key in self._metadata:
+                plan.add('unchanged' if self._stat_unchanged(key, file_stat) else 'modified',
+                         key, file_stat[0])
+                continue
+            old_key = _pop_renamed(renamed_by_stat, _identity(file_stat), deleted_keys)
+            if old_key:
+                plan.add('renamed', key, file_stat[0], old_key)
+            else:
+                plan.add('added', key, file_stat[0])
+        for key in sorted(deleted_keys):
+            plan.add('deleted', key, self._metadata[key].get('stat', [0])[0])
+        return plan
+
+    def repack(self, min_live: float = _PACK_MIN_LIVE):
+        """
+        Compact packs with removed or replaced members.
+
+        Live members of packs with less than *min_live* share of live
+        data are copied into new packs as they are, without re-encryption.
+        The old packs are removed once the manifest is written.
+
+        Raises
+        ------
+        RuntimeError
+            If metadata is partial after selective decrypt.
+            If GPM is read-only.
+        """
+        if self._store.settings.get('partial'):
+            raise RuntimeError('Metadata is partial after selective decrypt: decrypt all files first.')
+        self._check_writable()
+        self._unlock()
+        with self._exclusive():
+            self._repack(min_live)
+
+    def _repack(self, min_live: float):
+        live: Dict[str, int] = {}
+        for entry in self._metadata.values():
+            if 'pack' in entry:
+                pack_id, _, length = entry['pack']
+                live[pack_id] = live.get(pack_id, 0) + length
+        sparse = set()
+        for pack in self._output_dir.glob(f'*{packs.SUFFIX}'):
+            pack_id = pack.name[:-len(packs.SUFFIX)]
+            if live.get(pack_id, 0) < min_live * pack.stat().st_size:
+                sparse.add(pack_id)
+        for key, entry in sorted(self._metadata.items()):
+            if 'pack' in entry and entry['pack'][0] in sparse:
+                entry['pack'] = self._packs.append(packs.read_member(self._output_dir, entry['pack']))
+                self._touch(key)
+        self._packs.close()
+        atomic.sync_directory(self._output_dir)
         self._write_metadata()
         self._write_metadata_blob()
+        self._remove_packs(sparse)
+
+    def gc(self):
+        """
+        Compact packs and remove blobs which are referenced neither by
+        local metadata nor by encrypted manifest.
+
+        Leftovers of interrupted runs are removed too.
+
+        Raises
+        ------
+        RuntimeError
+            If metadata is partial after selective decrypt.
+            If GPM is read-only.
+        """
+        self._check_writable()
+        with self._exclusive():
+            self.repack()
+            referenced = self._referenced_blobs(self._metadata)
+            if self._metafile_blob.is_file():
+                referenced |= self._referenced_blobs(self._read_manifest()[0])
+            for blob in self._output_dir.iterdir():
+                if blob.suffix in ('.gpg', packs.SUFFIX, '.tmp') and not blob.name.startswith('meta.') \
+                        and blob.name not in referenced and blob.is_file():
+                    logging.info('Remove unreferenced blob "%s"', blob.name)
+                    blob.unlink()
+
+    def _likely_modified(self, key: str, file_stat: FileStat, deleted_sizes: Set[Optional[int]]) -> bool:
+        """
+        Check if a file is new or modified without hashing it.
+
+        Such a file is hashed while it is encrypted. The rest are hashed
+        first, so a touched or renamed file is not encrypted at all.
+        """
+        if self._content_addressed(file_stat):
+            # Needs content ID to reuse chunks
+            return False
+        if key in self._metadata:
+            if _hash_algorithm(self._metadata[key]) != self.hash_algorithm:
+                # Checksum by another hash could be compared only after hashing
+                # by both, so an unmodified file is rehashed in place
+                return False
+            if 'stat' not in self._metadata[key]:
+                # No cached stats, so it costs a hash rather than encryption.
+                # Entries to encrypt again have no checksum, so they differ.
+                return False
+            # Content of other size differs
+            return self._metadata[key]['stat'][0] != file_stat[0]
+        return None not in deleted_sizes and file_stat[0] not in deleted_sizes
+
+    def _commit_fused(self, files: List[Tuple[Path]]):
+        """
+        Hash and encrypt files in a single read and commit them.
+
+        Raises
+        ------
+        RuntimeError
+            If fails to hash or encrypt any file.
+        """
+        fused = imap(self._timed('hash+encrypt', self._hash_and_encrypt), files, self._workers)
+        for (file,), (file_checksum, file_stat, sealed, passphrase, compression) in zip(files, fused):
+            key = self._key(file)
+            if not self._contains(file):
+                self._add(file, file_checksum, file_stat)
+            elif self._differ(file, file_checksum):
+                self._update_checksum(file, file_checksum, file_stat)
+            else:
+                # Rewritten with the same content
+                if isinstance(sealed, Path):
+                    sealed.unlink()
+                    self._temporaries.remove(sealed)
+                self._metadata[key]['stat'] = file_stat
+                self._restat.add(key)
+                if self._progress:
+                    self._progress.advance(file_stat[0])
+                continue
+            entry = self._metadata[key]
+            entry.pop('chunks', None)
+            entry.pop('compression', None)
+            entry.pop('pack', None)
+            entry['passphrase'] = passphrase
+            if compression:
+                entry['compression'] = compression
+            self._commit_blob(key, sealed)
+
+    def _hash_and_encrypt(self, file: Path) -> Tuple[str, FileStat, Union[Path, bytes], str, Optional[str]]:
+        """
+        Hash a file and encrypt it into a temporary blob in a single read.
+
+        A file to store in a pack is encrypted into memory instead. If the
+        file changes during the read, it is read again. If it keeps
+        changing, the last read is kept and the file is encrypted again
+        next time since its stats differ.
+
+        Returns
+        -------
+        tuple
+            Checksum, stats of file before the read, temporary blob or
+            member of a pack, its passphrase and compression if any.
+        """
+        passphrase = Crypto.generate_key()
+        temporary = self._temporary()
+        for _ in range(_READ_ATTEMPTS):
+            file_hash = hashing.new(self.hash_algorithm)
+            with open(file, 'rb') as f:
+                file_stat = _file_stat(os.fstat(f.fileno()))
+                packed = self._packed(file_stat)
+                with (io.BytesIO() if packed else open(temporary, 'wb')) as d:
+                    blocks = read_blocks(f, self.buffer_size)
+                    first = next(blocks, memoryview(b''))
+                    compression = self._compression_for(bytes(first[:_compression.SAMPLE_SIZE]))
+                    Crypto(passphrase, self.buffer_size, stats=self.stats).encrypt_blocks(
+                        _hashed(itertools.chain([first], blocks), file_hash), d,
+                        compression, self.compression_level)
+                    if not packed:
+                        atomic.sync(d)
+                    sealed: Union[Path, bytes] = d.getvalue() if packed else temporary  # type: ignore
+                if _file_stat(os.fstat(f.fileno())) == file_stat:
+                    break
+            logging.warning('File "%s" has changed while being encrypted', file)
+        if isinstance(sealed, bytes) and temporary.is_file():
+            # Grown too large to pack and shrunk back while being read
+            temporary.unlink()
+        if isinstance(sealed, bytes):
+            self._temporaries.remove(temporary)
+        return file_hash.hexdigest(), file_stat, sealed, passphrase.decode(), compression
+
+    def _temporary(self) -> Path:
+        """
+        Get a new temporary blob which is removed if encrypt fails.
+        """
+        temporary = atomic.temporary_path(self._output_dir / 'blob')
+        # Appending to a list is atomic, so workers may call it
+        self._temporaries.append(temporary)
+        return temporary
+
+    def _remove_temporaries(self):
+        for temporary in self._temporaries:
+            if temporary.is_file():
+                temporary.unlink()
+        self._temporaries = []
+
+    def _commit_blob(self, key: str, sealed: Union[Path, bytes, None]):
+        """
+        Journal an encrypted file.
+
+        Parameters
+        ----------
+        sealed : Path or bytes
+            Temporary blob which replaces the old one at the next
+            checkpoint, member to append to a pack or nothing if the
+            file is stored as chunks.
+        """
+        blob = None
+        if isinstance(sealed, Path):
+            self._renames.append((sealed, self._blob(key)))
+            blob = sealed.name
+        elif sealed is not None:
+            self._pack_member(key, sealed)
+        self._journal.record(key, self._metadata[key], blob)
+        self._unsealed.pop(key, None)
+        self._touch(key)
+
+        size = self._metadata[key]['stat'][0]
+        if self._progress:
+            self._progress.advance(size)
+        self._uncommitted[0] += 1
+        self._uncommitted[1] += size
+        if self._uncommitted[0] >= self.checkpoint_files or self._uncommitted[1] >= self.checkpoint_size:
+            self._checkpoint(commit=self._store.incremental)
+
+    def _checkpoint(self, commit: bool = True):
+        """
+        Make encrypted files durable and commit them to local metadata.
+
+        New blobs, chunks and packs are synced before the journal, so
+        every journaled file could be recovered. Temporary blobs are
+        renamed only after the journal is synced. Files which are not
+        encrypted yet keep their previous entries, so they are encrypted
+        again if the run is interrupted.
+
+        Parameters
+        ----------
+        commit : bool
+            Commit journaled files to local metadata and clear the
+            journal. Otherwise they stay in the journal, which is enough
+            to resume. Stores which are rewritten as a whole are committed
+            only at the end of encrypt, so the cost of checkpoints does
+            not grow with the number of files.
+        """
+        self._uncommitted = [0, 0]
+        with self._phase('checkpoint'):
+            self._packs.flush()
+            atomic.sync_directory(self._output_dir)
+            self._journal.flush()
+            for temporary, blob in self._renames:
+                os.replace(temporary, blob)
+            self._renames = []
+            atomic.sync_directory(self._output_dir)
+            if commit:
+                self._write_metadata()
+                atomic.sync_directory(self._metadata_dir)
+                self._journal.clear()
+
+    def _recover(self):
+        """
+        Commit files journaled by an interrupted encrypt.
+
+        Their temporary blobs replace the old ones unless it is done
+        already. Files which were not journaled are encrypted again.
+        """
+        records = self._journal.replay()
+        for record in records:
+            key = record['key']
+            self._metadata[key] = record['entry']
+            temporary = self._output_dir / record['blob'] if record['blob'] else None
+            if temporary and temporary.is_file():
+                os.replace(temporary, self._blob(key))
+            self._touch(key)
+        if records:
+            logging.warning('Recover %d files encrypted by an interrupted run', len(records))
+            atomic.sync_directory(self._output_dir)
+            self._index_uuids()
+            self._write_metadata()
+            atomic.sync_directory(self._metadata_dir)
+        self._journal.clear()
+
+    def _remove_garbage(self):
+        # Old blobs are removed once the manifest does not refer to them
+        for blob in self._garbage:
+            if blob.is_file():
+                blob.unlink()
+        self._garbage = []
 
     def _read_metadata(self):
-        # Load metadata if present
-        if self._metafile.is_file():
-            with open(self._metafile, 'r') as f:
-                self._metadata = json.load(f)
-                logging.debug(
-                    f'Read metadata from {self._metafile}: f{self._metadata}')
+        with self._phase('metadata'):
+            self._metadata = self._store.load()
+        self._index_uuids()
+        logging.debug('Read metadata of %d files from %s', len(self._metadata), self._store.path)
 
     def _write_metadata(self):
-        if self._metadata_dirty:
-            with open(self._metafile, 'w+') as f:
-                json.dump(self._metadata, f)
-                logging.debug(
-                    f'Write metadata to {self._metafile}: f{self._metadata}')
-            self._metadata_dirty = False
-
-    def _read_metadata_blob(self):
+        # Only changed entries are written
+        if self._changed or self._removed or self._restat:
+            metadata = self._metadata
+            unsealed = set(self._unsealed)
+            if unsealed:
+                # Entries of files which are not encrypted yet are left as they were
+                metadata = dict(metadata)
+                for key, entry in self._unsealed.items():
+                    if entry is None:
+                        del metadata[key]
+                    else:
+                        metadata[key] = entry
+            with self._phase('metadata'):
+                self._store.commit(
+                    metadata, self._changed - unsealed, self._removed, self._restat - unsealed)
+            logging.debug('Write metadata to %s: %d changed, %d removed',
+                          self._store.path, len(self._changed), len(self._removed))
+            self._changed, self._removed, self._restat = self._changed & unsealed, set(), self._restat & unsealed
+
+    def _touch(self, key: str):
+        self._changed.add(key)
+        self._removed.discard(key)
+
+    def _forget(self, key: str):
+        self._removed.add(key)
+        self._changed.discard(key)
+        self._restat.discard(key)
+
+    def _read_metadata_blob(self, path_filter: Optional[PathFilter] = None):
+        """
+        Read encrypted manifest: the root index and its shards.
+
+        Only the entries which differ from local metadata are saved.
+
+        Parameters
+        ----------
+        path_filter : PathFilter
+            Read only the shards with directories which may contain
+            selected files. Local entries of other shards are kept.
+
+        Raises
+        ------
+        RuntimeError
+            If no metafile encrypted blob found.
+        """
+        metadata, shards, skipped = self._read_manifest(path_filter)
+        self._write_metadata()
+        if skipped:
+            for key, entry in self._metadata.items():
+                if self._shard(os.path.dirname(key)) in skipped:
+                    metadata[key] = entry
+        for key, entry in metadata.items():
+            local = self._metadata.get(key)
+            if local is not None and _published(local) == _published(entry):
+                # Cached stats are local and still valid
+                metadata[key] = local
+            else:
+                self._touch(key)
+        for key in self._metadata:
+            if key not in metadata:
+                self._forget(key)
+        self._metadata = metadata
+        self._index_uuids()
+        self._write_metadata()
+        # Local metadata is the published one now unless shards are skipped
+        self._store.publish(self._metadata, {'shards': shards, 'partial': bool(skipped)})
+
+    def _read_manifest(self, path_filter: Optional[PathFilter] = None) \
+            -> Tuple[Dict[str, Any], Optional[Dict[str, list]], Set[str]]:
+        """
+        Returns
+        -------
+        tuple
+            Entries of encrypted manifest, its shards and the shards
+            skipped by path filter.
+
+        Raises
+        ------
+        RuntimeError
+            If no metafile encrypted blob found.
+        """
         if not self._metafile_blob.is_file():
             raise RuntimeError('Malformed output directory: no metafile encrypted blob found.')
-        self._decrypt_file(self._metafile_blob, self._metafile)
-        with open(self._metafile, 'r') as f:
-            self._metadata = json.load(f)
+        root = self._read_json_blob(self._metafile_blob)
+        skipped: Set[str] = set()
+        if root.get('version') != _MANIFEST_VERSION:
+            # Manifest of older versions is a plain dictionary of entries
+            return root, None, skipped
+        metadata = {}
+        for shard, dirs in root['shards'].items():
+            if path_filter is None or any(path_filter.may_contain(d) for d in dirs):
+                metadata.update(self._read_json_blob(self._shard_blob(shard)))
+            else:
+                skipped.add(shard)
+        return metadata, root['shards'], skipped
+
+    def _plan_decrypt(self, path_filter: Optional[PathFilter] = None) -> Plan:
+        """
+        Plan decrypt from encrypted manifest.
+
+        Only the manifest is read. A file is planned as unchanged if its
+        cached stats are valid and its local entry is the published one.
+        Other present files are planned as modified even if decrypt would
+        find their content the same after hashing.
+
+        Returns
+        -------
+        Plan
+            Sizes of encrypted data to read for files decrypt would write
+            and sizes of files in working directory for the rest.
+
+        Raises
+        ------
+        RuntimeError
+            If no metafile encrypted blob found.
+        """
+        manifest, _, _ = self._read_manifest(path_filter)
+        self._list_files()
+        plan = Plan('decrypt')
+        for key, entry in sorted(manifest.items()):
+            if path_filter is not None and not path_filter.match(key):
+                continue
+            if key not in self._all_files:
+                plan.add('added', key, self._stored_size(entry))
+                continue
+            local = self._metadata.get(key)
+            if local is not None and _published(local) == _published(entry) \
+                    and self._stat_unchanged(key, self._all_files[key]):
+                plan.add('unchanged', key, self._all_files[key][0])
+            else:
+                plan.add('modified', key, self._stored_size(entry))
+        # Decrypt removes them, see _remove_remains_in_working_dir
+        for key, file_stat in sorted(self._all_files.items()):
+            if key not in manifest and (path_filter is None or path_filter.match(key)):
+                plan.add('deleted', key, file_stat[0])
+        return plan
+
+    def _stored_size(self, entry: Dict[str, Any]) -> int:
+        # Size of encrypted data of an entry
+        if 'pack' in entry:
+            return entry['pack'][2]
+        if 'chunks' in entry:
+            blobs = {self._chunk_blob(chunk[0]) for chunk in entry['chunks']}
+        else:
+            blobs = {(self._output_dir / entry['uuid']).with_suffix('.gpg')}
+        return sum(blob.stat().st_size for blob in blobs if blob.is_file())
 
     def _write_metadata_blob(self):
-        self._encrypt_file(self._metafile, self._metafile_blob)
+        """
+        Publish changes since the last encrypt into encrypted manifest.
+
+        Entries are split into shards by keyed hash of their directory.
+        Only the shards with changed entries are written. The root index
+        lists directories of every shard and is written only if they
+        change. If the manifest was sealed with another key, every shard
+        is written, so all of them are sealed with the same key.
+        """
+        changed, removed = self._store.pending()
+        published = self._store.settings.get('shards')
+        key_id = self._key_id()
+        rekeyed = self._store.settings.get('key') != key_id
+        if published is not None and self._metafile_blob.is_file() \
+                and not changed and not removed and not rekeyed:
+            return
+
+        entries: Dict[str, DataBase] = {}
+        dirs: Dict[str, Set[str]] = {}
+        shard_of: Dict[str, str] = {}
+        for key, entry in self._metadata.items():
+            directory = os.path.dirname(key)
+            if directory not in shard_of:
+                shard_of[directory] = self._shard(directory)
+            shard = shard_of[directory]
+            entries.setdefault(shard, {})[key] = _published(entry)
+            dirs.setdefault(shard, set()).add(directory)
+        shards = {shard: sorted(d) for shard, d in sorted(dirs.items())}
+
+        if published is None or not self._metafile_blob.is_file():
+            # Manifest of older versions or no manifest at all
+            for blob in self._output_dir.glob('meta.*.gpg'):
+                blob.unlink()
+            dirty = set(shards)
+        elif rekeyed:
+            # Shards are named by keyed hash too, so the old ones are removed
+            dirty = set(shards) | {blob.name.split('.')[1] for blob in self._output_dir.glob('meta.*.gpg')}
+        else:
+            dirty = {self._shard(os.path.dirname(key)) for key in changed | removed}
+        for shard in sorted(dirty):
+            blob = self._shard_blob(shard)
+            if shard in entries:
+                self._write_json_blob(blob, entries[shard])
+                logging.info('Write manifest shard "%s"', shard)
+            elif blob.is_file():
+                blob.unlink()
+        if shards != published or not self._metafile_blob.is_file() or rekeyed:
+            self._write_json_blob(self._metafile_blob, {
+                'version': _MANIFEST_VERSION, 'shards': shards})
+        self._store.publish(self._metadata, {'shards': shards, 'key': key_id})
+
+    def _shard(self, directory: str) -> str:
+        shard_hash = hashlib.blake2b(
+            directory.encode(), digest_size=1, person=b'gpm-shard',
+            key=base64.urlsafe_b64decode(self._crypto_key))
+        return shard_hash.hexdigest()
+
+    def _shard_blob(self, shard: str) -> Path:
+        return self._output_dir / f'meta.{shard}.gpg'
+
+    def _read_json_blob(self, blob: Path) -> Any:
+        with self._phase('manifest', blob), open(blob, 'rb') as f:
+            plaintext = Crypto(self._crypto_key, stats=self.stats).decrypt_stream(read_blocks(f))
+            return json.loads(b''.join(plaintext))
+
+    def _write_json_blob(self, blob: Path, data: Any):
+        with self._phase('manifest', blob), atomic_write(blob) as f:
+            for c in Crypto(self._crypto_key, stats=self.stats).encrypt_stream(
+                    iter([json.dumps(data).encode()])):
+                f.write(c)
 
     def _remove_ramains_in_output_dir(self):
-        self._all_files = get_all_files(
-            self._working_dir, [self._metadata_dir])
-        self._read_metadata()
         # Some files have been removed since last commit
         # so remove them
+        self._remove_entries(self._deleted_keys())
+        self._write_metadata()
+        self._remove_garbage()
+
+    def _deleted_keys(self, path_filter: Optional[PathFilter] = None) -> List[str]:
         deleted_files = []
 
         for key in self._metadata:
-            file = self._working_dir / key
-            if file not in self._all_files:
-                logging.debug(
-                    f'Delete file {key}. All files: {self._all_files}. Metadata: {self._metadata}')
+            if key not in self._all_files and (path_filter is None or path_filter.match(key)):
                 deleted_files.append(key)
 
+        # A summary, since entries hold passphrases and there could be many
+        logging.debug('%d of %d files have been removed', len(deleted_files), len(self._metadata))
+        return deleted_files
+
+    def _remove_entries(self, deleted_files: List[str]):
         for key in deleted_files:
-            logging.info(
-                f'File "{key}" have been removed since last commit')
-            blob = self._blob(key)
-            if blob.is_file():
-                blob.unlink()
+            logging.info('File "%s" have been removed since last commit', key)
+            self._garbage.append(self._blob(key))
+            del self._uuids[self._metadata[key]['uuid']]
             del self._metadata[key]
-            self._metadata_dirty = True
+            self._forget(key)
 
-        self._write_metadata()
+    def _index_renames(self, deleted_keys: Set[str]) -> Tuple[Dict[Any, List[str]], Dict[Any, List[str]]]:
+        """
+        Index removed files by stat identity and by checksum.
 
-    def _remove_remains_in_working_dir(self):
+        Returns
+        -------
+        tuple
+            Keys by size, mtime and inode and keys by hash algorithm and
+            checksum.
         """
+        by_stat: Dict[Any, List[str]] = {}
+        by_checksum: Dict[Any, List[str]] = {}
+        for key in sorted(deleted_keys):
+            entry = self._metadata[key]
+            if 'stat' in entry:
+                by_stat.setdefault(_identity(entry['stat']), []).append(key)
+            if entry['checksum']:
+                by_checksum.setdefault(
+                    (_hash_algorithm(entry), entry['checksum']), []).append(key)
+        return by_stat, by_checksum
+
+    def _rename(self, old_key: str, file: Path, file_stat: FileStat):
+        """
+        Move an entry to a new path keeping its UUID and blob.
+
         Raises
         ------
         RuntimeError
             If file not in working directory.
         """
-        self._all_files = get_all_files(
-            self._working_dir, [self._metadata_dir])
+        key = self._key(file)
+        self._metadata[key] = self._metadata.pop(old_key)
+        self._uuids[self._metadata[key]['uuid']] = key
+        self._metadata[key]['stat'] = file_stat
+        self._forget(old_key)
+        self._touch(key)
+        logging.info('Commit renamed file "%s" as "%s"', old_key, key)
 
-        for file in self._all_files:
-            key = self._key(file)
-            if key not in self._metadata:
-                file.unlink()
+    def _list_files(self, path_filter: Optional[PathFilter] = None):
+        # The only walk of working directory during encrypt or decrypt
+        with self._phase('walk'):
+            self._all_files = {
+                key: _file_stat(st) for key, st in
+                walk(self._working_dir, [self._metadata_dir, self._output_dir], path_filter=path_filter)}
+        if self.stats:
+            self.stats.add('walk', files=len(self._all_files))
+
+    def _index_uuids(self):
+        self._uuids = {entry['uuid']: key for key, entry in self._metadata.items()}
+
+    def _remove_remains_in_working_dir(self, path_filter: Optional[PathFilter] = None):
+        for key in list(self._all_files):
+            if key not in self._metadata and (path_filter is None or path_filter.match(key)):
+                (self._working_dir / key).unlink()
+                del self._all_files[key]
+
+    def _decrypt_entry(self, file: Path, key: str):
+        entry = self._metadata[key]
+        if 'chunks' in entry:
+            self._decrypt_chunks(entry['chunks'], file)
+        elif 'pack' in entry:
+            self._decrypt_member(entry, file)
+        else:
+            self._decrypt_file(self._blob(key), file, entry['passphrase'].encode(),
+                               entry.get('compression'))
+
+    def _encrypt_entry(self, file: Path, key: str,
+                       content_id: Optional[str] = None) -> Tuple[Dict[str, Any], Union[Path, bytes, None]]:
+        """
+        Returns
+        -------
+        tuple
+            Fields of metadata entry: chunks of file or compression of
+            the file encrypted as a whole if any. And the temporary blob
+            or the member of a pack with the encrypted file unless it is
+            stored as chunks.
+        """
+        entry = self._metadata[key]
+        if 'passphrase' in entry:
+            compression = self._compression_for(file)
+            fields = {'compression': compression} if compression else {}
+            if self._packed(entry['stat']):
+                member = io.BytesIO()
+                with open(file, 'rb') as f:
+                    Crypto(entry['passphrase'].encode(), self.buffer_size, stats=self.stats).encrypt_blocks(
+                        read_blocks(f, self.buffer_size), member, compression, self.compression_level)
+                return fields, member.getvalue()
+            temporary = self._temporary()
+            self._encrypt_file(file, temporary, entry['passphrase'].encode(), compression)
+            return fields, temporary
+        if content_id and not self._chunked(entry['stat']):
+            # Whole file is a single chunk
+            return {'chunks': [self._encrypt_chunk(content_id, file, entry['stat'][0])]}, None
+        return {'chunks': self._encrypt_chunks(file)}, None
+
+    def _decrypt_member(self, entry: Dict[str, Any], dst: Path):
+        member = packs.read_member(self._output_dir, entry['pack'])
+        plaintext = Crypto(entry['passphrase'].encode(), stats=self.stats).decrypt_stream(iter([member]))
+        if 'compression' in entry:
+            plaintext = _compression.decompress(plaintext, entry['compression'])
+        dst.parent.mkdir(exist_ok=True, parents=True)
+        with open(dst, 'wb') as d:
+            for data in plaintext:
+                d.write(data)
+
+    def _pack_member(self, key: str, member: bytes):
+        # Blob of the previous version is not needed
+        self._garbage.append(self._blob(key))
+        self._metadata[key]['pack'] = self._packs.append(member)
+
+    def _pack_ids(self) -> Set[str]:
+        return {entry['pack'][0] for entry in self._metadata.values() if 'pack' in entry}
+
+    def _remove_packs(self, pack_ids: Set[str]):
+        for pack_id in sorted(pack_ids):
+            logging.info('Remove pack "%s"', pack_id)
+            pack = packs.pack_path(self._output_dir, pack_id)
+            if pack.is_file():
+                pack.unlink()
+
+    def _referenced_blobs(self, metadata: Dict[str, Any]) -> Set[str]:
+        """
+        Get names of blobs, chunks and packs referenced by metadata.
+        """
+        names = set()
+        for entry in metadata.values():
+            if 'pack' in entry:
+                names.add(packs.pack_path(self._output_dir, entry['pack'][0]).name)
+            elif 'chunks' in entry:
+                names.update(self._chunk_blob(chunk[0]).name for chunk in entry['chunks'])
+            else:
+                names.add(f'{entry["uuid"]}.gpg')
+        return names
+
+    def _packed(self, file_stat: FileStat) -> bool:
+        return self.pack and not self._content_addressed(file_stat) and file_stat[0] < _PACK_MEMBER_SIZE
+
+    def _decrypt_chunks(self, chunks: List[list], dst: Path):
+        dst.parent.mkdir(exist_ok=True, parents=True)
+        with open(dst, 'wb') as d:
+            for chunk in chunks:
+                chunk_id, passphrase = chunk[:2]
+                with open(self._chunk_blob(chunk_id), 'rb') as s:
+                    plaintext = Crypto(passphrase.encode(), stats=self.stats).decrypt_stream(
+                        read_blocks(s, self.buffer_size))
+                    if len(chunk) > 3:
+                        plaintext = _compression.decompress(plaintext, chunk[3])
+                    for data in plaintext:
+                        d.write(data)
+
+    def _encrypt_chunks(self, file: Path) -> List[list]:
+        """
+        Split file into content-defined chunks and encrypt the new ones.
 
-        self._all_files = get_all_files(
-            self._working_dir, [self._metadata_dir])
+        A chunk is identified by keyed hash of its content. The chunks
+        which are already stored are reused.
 
-    def _decrypt_file(self, src: Path, dst: Path, key: bytes = None):
+        Returns
+        -------
+        list
+            Chunk ID, passphrase and size for each chunk of file.
+        """
+        with open(file, 'rb') as f:
+            return [self._encrypt_chunk(self._chunk_id(data), data, len(data))
+                    for data in chunking.chunks(f)]
+
+    def _encrypt_chunk(self, chunk_id: str, data: Union[bytes, Path], size: int) -> list:
+        """
+        Encrypt a chunk unless it is already stored.
+
+        Parameters
+        ----------
+        data : bytes or Path
+            Content of chunk or a file with it.
+
+        Returns
+        -------
+        list
+            Chunk ID, passphrase, size and compression if any.
+        """
+        # Compression depends only on content, so it is the same for any
+        # file with this chunk
+        compression = None
+        if chunk_id not in self._chunk_keys:
+            compression = self._compression_for(data)
+        while True:
+            with self._chunk_keys_lock:
+                new_chunk = chunk_id not in self._chunk_keys
+                if new_chunk:
+                    self._chunk_keys[chunk_id] = (Crypto.generate_key().decode(), compression)
+                    self._chunk_writes[chunk_id] = threading.Event()
+                written = self._chunk_writes.get(chunk_id)
+                passphrase, compression = self._chunk_keys[chunk_id]
+            if new_chunk or written is None:
+                break
+            # The chunk must be stored before a file refers to it. If its
+            # writer fails, the chunk is written again.
+            written.wait()
+            if chunk_id in self._chunk_keys:
+                break
+        if new_chunk:
+            try:
+                self._write_chunk(chunk_id, data, passphrase, compression)
+            except BaseException:
+                with self._chunk_keys_lock:
+                    del self._chunk_keys[chunk_id]
+                raise
+            finally:
+                with self._chunk_keys_lock:
+                    self._chunk_writes.pop(chunk_id).set()
+            logging.debug('New chunk "%s"', chunk_id)
+        return [chunk_id, passphrase, size] + ([compression] if compression else [])
+
+    def _write_chunk(self, chunk_id: str, data: Union[bytes, Path], passphrase: str,
+                     compression: Optional[str]):
+        blob = self._chunk_blob(chunk_id)
+        if isinstance(data, Path):
+            self._encrypt_file(data, blob, passphrase.encode(), compression)
+        else:
+            plaintext: Iterator[bytes] = iter([data])
+            if compression:
+                plaintext = _compression.compress(plaintext, compression, self.compression_level)
+            with atomic_write(blob) as d:
+                for c in Crypto(passphrase.encode(), stats=self.stats).encrypt_stream(plaintext):
+                    d.write(c)
+
+    def _chunk_id(self, data: bytes) -> str:
+        content_hash = content_hasher(self._crypto_key)
+        content_hash.update(data)
+        return content_hash.hexdigest()
+
+    def _checksum(self, file: Path, algorithm: Optional[str] = None) -> str:
+        return checksum(file, algorithm or self.hash_algorithm, self.buffer_size, self.mmap)
+
+    def _fingerprint(self, file: Path) -> Tuple[str, str, Optional[str]]:
+        """
+        Hash a file in a single read.
+
+        Returns
+        -------
+        tuple
+            Checksum, checksum by hash algorithm of the file's entry and
+            content ID if deduplication is on. The checksums are the same
+            unless the entry is hashed by another algorithm.
+        """
+        key = self._key(file)
+        algorithm = _hash_algorithm(self._metadata[key]) if key in self._metadata else self.hash_algorithm
+        if algorithm == self.hash_algorithm:
+            if not self.dedup:
+                file_checksum = self._checksum(file)
+                return file_checksum, file_checksum, None
+            file_checksum, content_id = fingerprint(
+                file, self._crypto_key, self.hash_algorithm, self.buffer_size, self.mmap)
+            return file_checksum, file_checksum, content_id
+        hashes = [hashing.new(self.hash_algorithm), hashing.new(algorithm)]
+        if self.dedup:
+            hashes.append(content_hasher(self._crypto_key))
+        hash_file(file, hashes, self.buffer_size, self.mmap)
+        return (hashes[0].hexdigest(), hashes[1].hexdigest(),
+                hashes[2].hexdigest() if self.dedup else None)
+
+    def _chunk_blob(self, chunk_id: str) -> Path:
+        return (self._output_dir / chunk_id).with_suffix('.gpg')
+
+    def _chunk_ids(self) -> Set[str]:
+        return {chunk[0] for entry in self._metadata.values()
+                for chunk in entry.get('chunks', [])}
+
+    def _index_chunks(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """
+        Get passphrases and compression of the stored chunks by chunk ID.
+        """
+        return {chunk[0]: (chunk[1], chunk[3] if len(chunk) > 3 else None)
+                for entry in self._metadata.values()
+                for chunk in entry.get('chunks', [])}
+
+    def _compression_for(self, data: Union[bytes, Path]) -> Optional[str]:
+        """
+        Get compression algorithm for data unless it does not shrink.
+
+        Parameters
+        ----------
+        data : bytes or Path
+            Content or a file with it.
+        """
+        if not self.compression:
+            return None
+        if isinstance(data, Path):
+            with open(data, 'rb') as f:
+                sample = f.read(_compression.SAMPLE_SIZE)
+        else:
+            sample = data[:_compression.SAMPLE_SIZE]
+        return self.compression if _compression.worth_compressing(sample) else None
+
+    def _remove_chunks(self, chunk_ids: Set[str]):
+        for chunk_id in chunk_ids:
+            logging.info('Remove unused chunk "%s"', chunk_id)
+            blob = self._chunk_blob(chunk_id)
+            if blob.is_file():
+                blob.unlink()
+
+    def _chunked(self, file_stat: FileStat) -> bool:
+        return self.chunking and file_stat[0] >= chunking.AVG_SIZE
+
+    def _content_addressed(self, file_stat: FileStat) -> bool:
+        # Stored as chunks named by content instead of a blob named by UUID
+        return self.dedup or self._chunked(file_stat)
+
+    def _decrypt_file(self, src: Path, dst: Path, key: Optional[bytes] = None,
+                      compression: Optional[str] = None):
         if not key:
             key = self._crypto_key
-        dst.parent.mkdir(exist_ok=True)
-        Crypto(key).decrypt_file(src, dst)
+        dst.parent.mkdir(exist_ok=True, parents=True)
+        Crypto(key, self.buffer_size, self._workers, stats=self.stats).decrypt_file(src, dst, compression=compression)
 
-    def _encrypt_file(self, src: Path, dst: Path, key: bytes = None):
+    def _encrypt_file(self, src: Path, dst: Path, key: Optional[bytes] = None,
+                      compression: Optional[str] = None):
         if not key:
             key = self._crypto_key
-        Crypto(key).encrypt_file(src, dst)
+        Crypto(key, self.buffer_size, self._workers, stats=self.stats).encrypt_file(
+            src, dst, compression, self.compression_level)
 
-    def _add(self, file: Path, file_checksum: str) -> Tuple[Path, Path, bytes]:
+    def _add(self, file: Path, file_checksum: str, file_stat: FileStat):
         """
         Raises
         ------
@@ -231,13 +1416,49 @@ class GPM:
         """
         key = self._key(file)
         file_uuid = self._uuid()
-        file_passphrase = Crypto.generate_key()
         self._metadata[key] = {
-            'uuid': file_uuid, 'checksum': file_checksum, 'passphrase': file_passphrase.decode() }
-        self._metadata_dirty = True
-        logging.info(f'Commit new file "{key}" as "{file_uuid}"')
+            'uuid': file_uuid, 'checksum': file_checksum, 'hash': self.hash_algorithm,
+            'stat': file_stat }
+        self._uuids[file_uuid] = key
+        if not self._content_addressed(file_stat):
+            self._metadata[key]['passphrase'] = Crypto.generate_key().decode()
+        self._touch(key)
+        logging.info('Commit new file "%s" as "%s"', key, file_uuid)
+
+    def _rollback(self, files: List[Path], new_keys: Set[str]):
+        """
+        Forget files which have not been encrypted.
+
+        New files are removed from database. Modified files lose their
+        checksum thus they are encrypted again on next run.
 
-        return file, self._blob(key), file_passphrase
+        Raises
+        ------
+        RuntimeError
+            If file not in working directory.
+        """
+        for file in files:
+            key = self._key(file)
+            if key in new_keys:
+                blob = self._blob(key)
+                if blob.is_file():
+                    blob.unlink()
+                del self._uuids[self._metadata[key]['uuid']]
+                del self._metadata[key]
+                self._forget(key)
+            else:
+                previous = self._unsealed.get(key)
+                if previous is not None:
+                    # The old blob is kept, since the new one is not written
+                    del self._uuids[self._metadata[key]['uuid']]
+                    self._metadata[key] = dict(previous)
+                    self._uuids[previous['uuid']] = key
+                    if self._blob(key) in self._garbage:
+                        self._garbage.remove(self._blob(key))
+                self._metadata[key]['checksum'] = None
+                self._metadata[key].pop('stat', None)
+                self._touch(key)
+            logging.info('Rollback file "%s"', key)
 
     def _contains(self, file: Path) -> bool:
         """
@@ -248,7 +1469,7 @@ class GPM:
         """
         return self._key(file) in self._metadata
 
-    def _differ(self, file: Path, file_checksum: str) -> bool:
+    def _differ(self, file: Path, file_checksum: Optional[str]) -> bool:
         """
         Raises
         ------
@@ -257,6 +1478,34 @@ class GPM:
         """
         return self._metadata[self._key(file)]['checksum'] != file_checksum
 
+    def _phase(self, name: str, file: Optional[Path] = None) -> ContextManager[Any]:
+        # Time a phase if stats are on, see Stats.phase
+        if self.stats is None:
+            return _NO_PHASE
+        return self.stats.phase(name, file, files=0)
+
+    def _timed(self, name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """
+        Time every call of a function of a file as a phase if stats are on.
+
+        The function is returned as it is otherwise, so it costs nothing.
+        """
+        stats = self.stats
+        if stats is None:
+            return func
+
+        def timed(file: Path, *args: Any) -> Any:
+            with stats.phase(name, file):
+                return func(file, *args)
+        return timed
+
+    def _stat_unchanged(self, key: str, file_stat: FileStat) -> bool:
+        """
+        Check if the file stats (size, mtime, inode and ctime) are the same
+        as when the file was last hashed.
+        """
+        return self._metadata[key].get('stat') == file_stat
+
     def _key(self, file: Path) -> str:
         """
         Raises
@@ -272,7 +1521,7 @@ class GPM:
         file_uuid = self._metadata[key]['uuid']
         return (self._output_dir / file_uuid).with_suffix('.gpg')
 
-    def _update_checksum(self, file: Path, file_checksum: str) -> Tuple[Path, Path, bytes]:
+    def _update_checksum(self, file: Path, file_checksum: str, file_stat: FileStat):
         """
         Raises
         ------
@@ -280,14 +1529,38 @@ class GPM:
             If file not in working directory.
         """
         key = self._key(file)
-        file_uuid = self._metadata[key]['uuid']
         old_checksum = self._metadata[key]['checksum']
-        file_passphrase = Crypto.generate_key()
         self._metadata[key]['checksum'] = file_checksum
-        self._metadata[key]['passphrase'] = file_passphrase.decode()
-        self._metadata_dirty = True
-        logging.info(f'Commit modified file "{key}" as "{file_uuid}": prev checksum="{old_checksum}", new checksum="{file_checksum}"')
-        return file, self._blob(key), file_passphrase
+        self._metadata[key]['hash'] = self.hash_algorithm
+        self._metadata[key]['stat'] = file_stat
+        if self._content_addressed(file_stat):
+            # Chunks are reused, but the whole file blob is not needed
+            if self._metadata[key].pop('passphrase', None):
+                self._garbage.append(self._blob(key))
+        else:
+            if 'passphrase' in self._metadata[key]:
+                # The published manifest refers to the old blob until it is
+                # replaced, so the new version gets a blob of its own
+                self._garbage.append(self._blob(key))
+                del self._uuids[self._metadata[key]['uuid']]
+                self._metadata[key]['uuid'] = self._uuid()
+                self._uuids[self._metadata[key]['uuid']] = key
+            self._metadata[key].pop('chunks', None)
+            self._metadata[key]['passphrase'] = Crypto.generate_key().decode()
+        file_uuid = self._metadata[key]['uuid']
+        self._touch(key)
+        logging.info('Commit modified file "%s" as "%s": prev checksum="%s", new checksum="%s"',
+                     key, file_uuid, old_checksum, file_checksum)
+
+    def _migrate_checksum(self, key: str, file_checksum: str):
+        """
+        Replace checksum of unmodified file by one of current hash algorithm.
+        """
+        logging.info('Rehash file "%s" by %s instead of %s',
+                     key, self.hash_algorithm, _hash_algorithm(self._metadata[key]))
+        self._metadata[key]['checksum'] = file_checksum
+        self._metadata[key]['hash'] = self.hash_algorithm
+        self._touch(key)
 
     def _uuid(self) -> str:
         """
@@ -295,86 +1568,233 @@ class GPM:
 
         Generated UUID is checked for collision in database.
 
-        Parameters
-        ----------
-        metadata : dict
-            A dictionary with database.
-
         Raises
         ------
         RuntimeError
             If fails to generate UUID in 10 times.
         """
-        for _ in range(10):
-            file_uuid = str(uuid4())
-            if not self._metadata:
-                logging.debug(f'Get UUID: {file_uuid}')
-                return file_uuid
-            no_collisions = True
-            for file_name, file_info in self._metadata.items():
-                if file_uuid != file_info['uuid']:
-                    continue
-                else:
-                    logging.debug(
-                        f'UUID "{file_uuid}" is used for "{file_name}"')
-                    no_collisions = False
-                    break
-            if no_collisions:
-                logging.debug(f'Get UUID: {file_uuid}')
-                return file_uuid
+        with self._phase('uuid'):
+            for _ in range(10):
+                file_uuid = str(uuid4())
+                if file_uuid not in self._uuids:
+                    logging.debug('Get UUID: %s', file_uuid)
+                    return file_uuid
+                logging.debug('UUID "%s" is used for "%s"', file_uuid, self._uuids[file_uuid])
         logging.debug('[CRITICAL] Failed to generate UUID')
         raise RuntimeError('Failed to generate UUID')
 
-    def _safe_key(self, key : str) -> bytes:
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=key.encode(),
-            iterations=100000,
-            backend=default_backend()
-        )
-        return base64.urlsafe_b64encode(kdf.derive(key.encode()))
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        # Other processes must not write into output directory meanwhile,
+        # see lock.locked. Nested calls, e.g. repack by gc, hold it once.
+        if self._locked:
+            yield
+            return
+        with lock.locked(self._output_dir):
+            self._locked = True
+            try:
+                yield
+            finally:
+                self._locked = False
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError('GPM is read-only: only dry runs are allowed')
+
+    def _unlock(self):
+        """
+        Derive master key unless it is derived with current parameters.
+
+        Raises
+        ------
+        RuntimeError
+            If no passphrase is set.
+        WrongKeyError
+            If the key does not decrypt the encrypted manifest.
+        """
+        params = self._kdf_params()
+        if self._kdf != params:
+            if not self._passphrase:
+                raise RuntimeError('No passphrase is set')
+            with self._phase('kdf'):
+                key = kdf.derive(self._passphrase, params)
+            self._check_key(key)
+            self._crypto_key = key
+            self._kdf = params
+
+    def _check_key(self, key: bytes):
+        # A key which does not decrypt the manifest would seal its new
+        # shards under another key than the old ones, so nothing is
+        # written with it
+        if not self._metafile_blob.is_file():
+            return
+        try:
+            with self._phase('manifest', self._metafile_blob), open(self._metafile_blob, 'rb') as f:
+                for _ in Crypto(key, stats=self.stats).decrypt_stream(read_blocks(f)):
+                    pass
+        except InvalidToken:
+            raise WrongKeyError('Wrong passphrase: it does not decrypt the encrypted manifest') from None
+
+    def _key_id(self) -> str:
+        # Identifies the key the manifest is sealed with, not the key itself
+        key_hash = hashlib.blake2b(
+            digest_size=16, person=b'gpm-key-id', key=base64.urlsafe_b64decode(self._crypto_key))
+        return key_hash.hexdigest()
+
+    def _kdf_params(self) -> kdf.Params:
+        if self._kdf_file.is_file():
+            return kdf.read_params(self._kdf_file)
+        if self._metafile_blob.is_file():
+            # Output directory of older versions
+            return kdf.LEGACY
+        # Salt is generated once and written by the first encrypt
+        if self._new_kdf is None:
+            self._new_kdf = kdf.new_params(self._kdf_iterations)
+        return self._new_kdf
 
 
 # TODO Use descriptive sometype instead 'str'
-def checksum(file: Path) -> str:
+def checksum(file: Path, algorithm: str = hashing.DEFAULT, buffer_size: int = BUFFER_SIZE,
+             use_mmap: bool = False) -> str:
     """
-    Calculate the MD5 checksum of a file
+    Calculate the checksum of a file
 
     Parameters
     ----------
     file : str
         Path to file.
+    algorithm : str
+        Hash algorithm, see :mod:`utils.hashing`.
+    buffer_size : int
+        Size of blocks the file is read by.
+    use_mmap : bool
+        Map the file into memory instead of reading it.
 
     Returns
     -------
     str
-        MD5 checksum of a file.
+        Checksum of a file.
+    """
+    file_hash = hashing.new(algorithm)
+    hash_file(file, [file_hash], buffer_size, use_mmap)
+    return file_hash.hexdigest()
+
+
+def fingerprint(file: Path, key: bytes, algorithm: str = hashing.DEFAULT,
+                buffer_size: int = BUFFER_SIZE, use_mmap: bool = False) -> Tuple[str, str]:
+    """
+    Calculate the checksum and the content ID of a file
+
+    The file is read once.
+
+    Parameters
+    ----------
+    file : str
+        Path to file.
+    key : bytes
+        Url-safe base64-encoded master key.
+    algorithm : str
+        Hash algorithm of checksum, see :mod:`utils.hashing`.
+    buffer_size : int
+        Size of blocks the file is read by.
+    use_mmap : bool
+        Map the file into memory instead of reading it.
+
+    Returns
+    -------
+    tuple
+        Checksum and content ID of a file.
+    """
+    file_hash = hashing.new(algorithm)
+    content_hash = content_hasher(key)
+    hash_file(file, [file_hash, content_hash], buffer_size, use_mmap)
+    return file_hash.hexdigest(), content_hash.hexdigest()
+
+
+def content_hasher(key: bytes) -> Any:
+    """
+    Create a keyed hash which identifies content of files and chunks
+
+    Parameters
+    ----------
+    key : bytes
+        Url-safe base64-encoded master key.
+
+    Returns
+    -------
+    hashlib hash object
+        Keyed BLAKE2b, so the IDs do not reveal content.
+    """
+    return hashlib.blake2b(
+        digest_size=16, person=b'gpm-chunk', key=base64.urlsafe_b64decode(key))
+
+
+def stat(file: Path) -> FileStat:
+    """
+    Get stats used to detect file changes without hashing
+
+    Parameters
+    ----------
+    file : str
+        Path to file.
+
+    Returns
+    -------
+    list
+        Size, mtime (ns), inode and ctime (ns) of a file.
+    """
+    return _file_stat(os.stat(file))
+
+
+def _file_stat(st: os.stat_result) -> FileStat:
+    return [st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns]
+
+
+def _hash_algorithm(entry: Dict[str, Any]) -> str:
+    return entry.get('hash', hashing.LEGACY)
+
+
+def _hashed(blocks: Iterable[Buffer], hash_object: Any) -> Iterator[Buffer]:
+    # Hash blocks on their way to encryption
+    for block in blocks:
+        hash_object.update(block)
+        yield block
+
+
+def _published(entry: Dict[str, Any]) -> Dict[str, Any]:
+    # Stats are valid only on the machine where the file was hashed
+    return {name: value for name, value in entry.items() if name != 'stat'}
+
+
+def _identity(file_stat: FileStat) -> Tuple[int, ...]:
+    # Size, mtime and inode are kept by rename, ctime is not
+    return tuple(file_stat[:3])
+
+
+def _pop_renamed(candidates: Dict[Any, List[str]], value: Any, deleted_keys: Set[str]) -> Optional[str]:
+    """
+    Take a removed file matching the value.
+
+    The file is taken once, so it is removed from deleted keys.
     """
-    hash_md5 = hashlib.md5()
-    with open(file, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    keys = candidates.get(value, [])
+    while keys:
+        key = keys.pop(0)
+        if key in deleted_keys:
+            deleted_keys.remove(key)
+            return key
+    return None
 
 
 def get_all_files(working_dir: Path, exclude: List[Path] = []) -> List[Path]:
     """
     Get list of files in all subfolders in working directory
 
-    The names contain paths relative to working direcotry.
+    Excluded directories and files ignored by *.gpmignore* are skipped.
 
     Returns
     -------
-    set
+    list
         A list of files in working directory and subdirectories.
     """
-    def excluded(entry: Path):
-        for path in exclude:
-            return path == entry or path in entry.parents
-
-    fs = []
-    for entry in working_dir.rglob('*'):
-        if entry.is_file() and not excluded(entry):
-            fs.append(entry)
-    return fs
+    return [working_dir / key for key, _ in walk(working_dir, exclude)]
@@ -0,0 +1,141 @@
+"""
+Test the agent which keeps master keys in memory.
+"""
+from git_privacy_manager import agent
+from pathlib import Path
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from .utils import add_file
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.socket = Path(tempfile.mkdtemp()) / 'agent.sock'
+        self.agent = agent.Agent(self.socket, ttl=60)
+        self.thread = threading.Thread(target=self.agent.serve)
+        self.thread.start()
+        for _ in range(100):
+            if self.socket.exists():
+                break
+            time.sleep(0.01)
+
+        self.file_path, self.file_data = add_file(self.working_directory)
+
+    def tearDown(self):
+        agent.request({'command': 'stop'}, self.socket)
+        self.thread.join()
+
+    def _request(self, command, **kwargs):
+        message = {
+            'command': command,
+            'directory': str(self.working_directory),
+            'output': str(self.output_directory),
+            'options': {'kdf_iterations': 1000},
+        }
+        message.update(kwargs)
+        return agent.request(message, self.socket)
+
+    def test_key_cached(self):
+        self.assertTrue(self._request('status')['ok'])
+        self.assertEqual({'ok': False, 'error': 'Passphrase is required', 'passphrase': True},
+                         self._request('encrypt'))
+        self.assertEqual({'ok': True}, self._request('encrypt', passphrase='123'))
+        self.assertIn(str(self.output_directory.resolve()), self._request('status')['keys'])
+
+        self.file_path.unlink()
+        with patch('git_privacy_manager.utils.kdf.derive') as mock_derive:
+            self.assertEqual({'ok': True}, self._request('decrypt'))
+        mock_derive.assert_not_called()
+        self.assertEqual(self.file_data, self.file_path.read_bytes())
+
+    def test_dry_run(self):
+        self._request('encrypt', passphrase='123')
+        self.file_path.unlink()
+        reply = self._request('decrypt', args={'dry_run': True})
+        self.assertTrue(reply['ok'])
+        self.assertEqual([self.file_path.name], [file['path'] for file in reply['result']['added']['paths']])
+        self.assertFalse(self.file_path.exists())
+
+    def test_stats(self):
+        reply = self._request('encrypt', passphrase='123', stats=True)
+        self.assertEqual(1, reply['stats']['phases']['walk']['files'])
+        self.assertNotIn('stats', self._request('encrypt'))
+
+    def test_key_expires(self):
+        self._request('encrypt', passphrase='123')
+        self.agent.ttl = 0
+        self._request('encrypt')
+        self.assertEqual({}, self._request('status')['keys'])
+        self.assertTrue(self._request('decrypt').get('passphrase'))
+
+    def test_error(self):
+        self._request('encrypt', passphrase='123')
+        reply = self._request('decrypt', output=str(self.working_directory / 'missing'))
+        self.assertFalse(reply['ok'])
+        self.assertIn('Passphrase', reply['error'])
+        reply = self._request('decrypt', output=str(self.working_directory / 'missing'), passphrase='123')
+        self.assertIn('no metafile', reply['error'])
+
+    def test_wrong_passphrase(self):
+        self._request('encrypt', passphrase='123')
+        reply = self._request('encrypt', passphrase='wrong')
+        self.assertFalse(reply['ok'])
+        self.assertIn('Wrong passphrase', reply['error'])
+        # The key is forgotten rather than trusted
+        self.assertEqual({}, self._request('status')['keys'])
+        self.assertTrue(self._request('encrypt').get('passphrase'))
+
+    def test_unverified_key_not_kept(self):
+        # No manifest to check the key against yet
+        self.assertTrue(self._request('encrypt', passphrase='123', args={'dry_run': True})['ok'])
+        self.assertEqual({}, self._request('status')['keys'])
+
+    def test_no_agent(self):
+        self.assertIsNone(agent.request({'command': 'status'}, self.socket.with_name('none')))
+
+    def test_already_running(self):
+        with self.assertRaises(RuntimeError):
+            agent.Agent(self.socket).serve()
+
+
+class TestSocketDirectory(unittest.TestCase):
+    """
+    Test that the agent socket is used only in a private directory.
+    """
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.socket = self.directory / 'agent' / 'agent.sock'
+
+    def _check_refused(self, message):
+        with self.assertRaisesRegex(RuntimeError, message):
+            agent.request({'command': 'status'}, self.socket)
+        with self.assertRaisesRegex(RuntimeError, message):
+            agent.Agent(self.socket).serve()
+
+    def test_not_private(self):
+        self.socket.parent.mkdir(mode=0o755)
+        self.socket.parent.chmod(0o755)
+        self._check_refused('mode 0700')
+
+    def test_symlink(self):
+        target = self.directory / 'target'
+        target.mkdir(mode=0o700)
+        self.socket.parent.symlink_to(target)
+        self._check_refused('not a directory')
+
+    def test_other_user(self):
+        self.socket.parent.mkdir(mode=0o700)
+        with patch('os.getuid', return_value=self.socket.parent.stat().st_uid + 1):
+            self._check_refused('another user')
+
+    def test_no_unix_sockets(self):
+        with patch.object(agent, 'AVAILABLE', False):
+            self.assertIsNone(agent.request({'command': 'status'}, self.socket))
+            with self.assertRaises(RuntimeError):
+                agent.Agent(self.socket).serve()
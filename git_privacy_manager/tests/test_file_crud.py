@@ -7,13 +7,20 @@ References
 .. [1] https://en.wikipedia.org/wiki/Create,_read,_update_and_delete
 """
 import git_privacy_manager as gpm
+import hashlib
+import json
+from git_privacy_manager.utils import kdf
+from git_privacy_manager.utils.stats import Stats
 import os
+import shutil
 from pathlib import Path
+import random
 import tempfile
+import threading
 import unittest
 from unittest.mock import patch
 import uuid  # Used to generate random string
-from .utils import add_file, files_in_directory
+from .utils import add_file, blobs_in_directory, files_in_directory
 
 
 class TestCustomOutputDir(unittest.TestCase):
@@ -28,8 +35,9 @@ class TestCustomOutputDir(unittest.TestCase):
         self.assertEqual(0, files_in_directory(self.output_direcotry))
         add_file(self.working_directory)
         self.gpm.encrypt()
-        # Now there are metafile and file blobs
-        self.assertEqual(2, files_in_directory(self.output_direcotry))
+        # Now there are manifest and file blobs
+        self.assertEqual(1, blobs_in_directory(self.output_direcotry))
+        self.assertTrue(self.gpm._metafile_blob.is_file())
 
 
 class TestSingleFileCRUD(unittest.TestCase):
@@ -173,3 +181,1283 @@ class TestMultipleFilesCRUD(unittest.TestCase):
         add_file(self.working_directory)
         add_file(self.working_directory)
         self.gpm.encrypt()
+
+
+class TestStatCache(unittest.TestCase):
+    """
+    Test that unchanged files are not re-hashed.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd)
+
+        self.file_path, self.file_data = add_file(self.working_directory)
+        self.gpm.encrypt()
+
+    @patch('git_privacy_manager.gpm.checksum')
+    def test_unchanged_file_not_hashed(self, mock_checksum):
+        self.gpm.encrypt()
+        self.gpm.decrypt()
+        mock_checksum.assert_not_called()
+
+    @patch('git_privacy_manager.gpm.checksum')
+    def test_paranoid_rehashes(self, mock_checksum):
+        mock_checksum.return_value = self.gpm._metadata[self.file_path.name]['checksum']
+        self.gpm.paranoid = True
+        self.gpm.encrypt()
+        mock_checksum.assert_called_once_with(self.file_path, 'sha256', self.gpm.buffer_size, False)
+
+    def test_modified_file_rehashed(self):
+        file_data_updated = b'ax' * 4096 + b'by'
+        with open(self.file_path, 'wb') as f:
+            f.write(file_data_updated)
+        self.gpm.encrypt()
+        os.remove(self.file_path)
+        self.gpm.decrypt()
+
+        with open(self.file_path, 'rb') as f:
+            self.assertEqual(file_data_updated, f.read())
+
+
+class TestSinglePass(unittest.TestCase):
+    """
+    Test hashing and encryption of new and modified files in a single read.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd)
+        self.file_path, self.file_data = add_file(self.working_directory)
+
+    def _check_decrypt(self):
+        os.remove(self.file_path)
+        self.gpm.decrypt()
+        self.assertEqual(self.file_data, self.file_path.read_bytes())
+
+    @patch('git_privacy_manager.gpm.checksum')
+    @patch.object(gpm.gpm.Crypto, 'encrypt_file')
+    def test_new_file_read_once(self, mock_encrypt_file, mock_checksum):
+        self.gpm.encrypt()
+        mock_checksum.assert_not_called()
+        mock_encrypt_file.assert_not_called()
+        self.assertEqual(hashlib.sha256(self.file_data).hexdigest(),
+                         self.gpm._metadata[self.file_path.name]['checksum'])
+        self.assertEqual([], list(self.gpm.output_dir.glob('*.tmp')))
+        self._check_decrypt()
+
+    def test_resized_file_read_once(self):
+        self.gpm.encrypt()
+        self.file_data += b'more'
+        self.file_path.write_bytes(self.file_data)
+        with patch('git_privacy_manager.gpm.checksum') as mock_checksum:
+            self.gpm.encrypt()
+        mock_checksum.assert_not_called()
+        self._check_decrypt()
+
+    def test_rewritten_with_same_content(self):
+        self.gpm.encrypt()
+        blob = self.gpm._blob(self.file_path.name)
+        blob_data = blob.read_bytes()
+        # Forget stats as after a failed run
+        del self.gpm._metadata[self.file_path.name]['stat']
+        with patch.object(gpm.GPM, '_hash_and_encrypt') as hash_and_encrypt:
+            self.gpm.encrypt()
+        # Hashed, but not encrypted again
+        hash_and_encrypt.assert_not_called()
+        self.assertIn('stat', self.gpm._metadata[self.file_path.name])
+        self.assertEqual(blob_data, blob.read_bytes())
+        self.assertEqual([], list(self.gpm.output_dir.glob('*.tmp')))
+
+    def test_changed_during_read(self):
+        read_blocks = gpm.gpm.read_blocks
+        appended = []
+
+        def append_once(f, *args):
+            for block in read_blocks(f, *args):
+                yield block
+                if not appended:
+                    appended.append(True)
+                    with open(self.file_path, 'ab') as a:
+                        a.write(b'tail')
+
+        with patch('git_privacy_manager.gpm.read_blocks', append_once):
+            self.gpm.encrypt()
+        self.file_data += b'tail'
+        entry = self.gpm._metadata[self.file_path.name]
+        self.assertEqual(hashlib.sha256(self.file_data).hexdigest(), entry['checksum'])
+        self.assertEqual(len(self.file_data), entry['stat'][0])
+        self._check_decrypt()
+
+
+class TestHashMigration(unittest.TestCase):
+    """
+    Test change of hash algorithm of existing entries.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.file_path, self.file_data = add_file(self.working_directory)
+        # Metadata of older versions has MD5 checksums and no algorithm
+        g = gpm.GPM(self.working_directory, self.pswd, hash_algorithm='md5')
+        g.encrypt()
+        del g._metadata[self.file_path.name]['hash']
+        g._touch(self.file_path.name)
+        g._write_metadata()
+        self.gpm = gpm.GPM(self.working_directory, self.pswd)
+        self.entry = self.gpm._metadata[self.file_path.name]
+        self.assertEqual(hashlib.md5(self.file_data).hexdigest(), self.entry['checksum'])
+
+    def test_unmodified_rehashed(self):
+        blob = self.gpm._blob(self.file_path.name).read_bytes()
+        self.gpm.paranoid = True
+        self.gpm.encrypt()
+        self.assertEqual('sha256', self.entry['hash'])
+        self.assertEqual(hashlib.sha256(self.file_data).hexdigest(),
+                         self.entry['checksum'])
+        # Not encrypted again
+        self.assertEqual(blob, self.gpm._blob(self.file_path.name).read_bytes())
+
+    def test_upgrade_keeps_blobs(self):
+        # Older versions have no stats either
+        del self.entry['stat']
+        file_uuid = self.entry['uuid']
+        blob = self.gpm._blob(self.file_path.name).read_bytes()
+        with patch.object(gpm.GPM, '_hash_and_encrypt') as hash_and_encrypt:
+            self.gpm.encrypt()
+        hash_and_encrypt.assert_not_called()
+        self.assertEqual(hashlib.sha256(self.file_data).hexdigest(), self.entry['checksum'])
+        self.assertEqual(file_uuid, self.entry['uuid'])
+        self.assertEqual(blob, self.gpm._blob(self.file_path.name).read_bytes())
+
+    def test_modified(self):
+        file_data_updated = b'ax' * 4096 + b'by'
+        self.file_path.write_bytes(file_data_updated)
+        self.gpm.encrypt()
+        self.assertEqual('sha256', self.entry['hash'])
+        os.remove(self.file_path)
+        self.gpm.decrypt()
+        self.assertEqual(file_data_updated, self.file_path.read_bytes())
+
+    def test_decrypt_modified(self):
+        self.file_path.write_bytes(b'ax' * 4096 + b'by')
+        self.gpm.decrypt()
+        self.assertEqual(self.file_data, self.file_path.read_bytes())
+
+
+class TestWorkers(unittest.TestCase):
+    """
+    Test encryption and decryption on a pool of threads.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd, workers=4)
+
+        self.files = dict(add_file(self.working_directory) for _ in range(16))
+
+    def test_encrypt_decrypt(self):
+        self.gpm.encrypt()
+        for file in self.files:
+            os.remove(file)
+        self.gpm.decrypt()
+
+        for file, data in self.files.items():
+            with open(file, 'rb') as f:
+                self.assertEqual(data, f.read())
+
+    def test_failure_reports_file(self):
+        failed = sorted(self.files)[3]
+        read_blocks = gpm.gpm.read_blocks
+
+        # New files are read once to hash and encrypt them
+        def fail_one(f, *args):
+            if f.name == str(failed):
+                raise OSError('disk full')
+            return read_blocks(f, *args)
+
+        with patch('git_privacy_manager.gpm.read_blocks', fail_one):
+            with self.assertRaisesRegex(RuntimeError, failed.name):
+                self.gpm.encrypt()
+        self.assertNotIn(failed.name, self.gpm._metadata)
+        self.assertEqual([], list(self.gpm.output_dir.glob('*.tmp')))
+
+        # Failed file is encrypted on next run
+        self.gpm.encrypt()
+        self.assertIn(failed.name, self.gpm._metadata)
+        os.remove(failed)
+        self.gpm.decrypt()
+        with open(failed, 'rb') as f:
+            self.assertEqual(self.files[failed], f.read())
+
+
+class TestChunking(unittest.TestCase):
+    """
+    Test encryption of large files as content-defined chunks.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory, chunking=True)
+
+        self.file_path = self.working_directory / 'large'
+        # Seeded, so chunk boundaries are the same on every run
+        self.file_data = random.Random(1).getrandbits(8 * 8 * 2**20).to_bytes(8 * 2**20, 'big')
+        self.file_path.write_bytes(self.file_data)
+        self.gpm.encrypt()
+
+    def test_add_chunked_file(self):
+        self.assertGreater(len(self.gpm._metadata['large']['chunks']), 1)
+        self.file_path.unlink()
+        self.gpm.decrypt()
+        self.assertEqual(self.file_data, self.file_path.read_bytes())
+
+    def test_update_reencrypts_changed_chunk(self):
+        blobs = set(self.output_directory.iterdir())
+        data = bytearray(self.file_data)
+        data[3 * 2**20] ^= 0xFF
+        self.file_path.write_bytes(data)
+        self.gpm.encrypt()
+
+        new_blobs = set(self.output_directory.iterdir()) - blobs
+        # New chunk and the manifest
+        self.assertEqual(1, len({b for b in new_blobs if not b.name.startswith('meta.')}))
+        self.file_path.unlink()
+        self.gpm.decrypt()
+        self.assertEqual(data, self.file_path.read_bytes())
+
+    def test_wait_for_chunk_being_written(self):
+        data = b'chunk' * 100
+        chunk_id = self.gpm._chunk_id(data)
+        started, release = threading.Event(), threading.Event()
+        write_chunk = gpm.GPM._write_chunk
+        writes = []
+
+        def write_or_fail(g, *args):
+            writes.append(args[0])
+            if len(writes) == 1:
+                started.set()
+                release.wait()
+                raise OSError('No space left on device')
+            write_chunk(g, *args)
+
+        errors = []
+        results = []
+
+        def encrypt_chunk():
+            try:
+                results.append(self.gpm._encrypt_chunk(chunk_id, data, len(data)))
+            except OSError as e:
+                errors.append(e)
+
+        with patch.object(gpm.GPM, '_write_chunk', write_or_fail):
+            first = threading.Thread(target=encrypt_chunk)
+            first.start()
+            started.wait()
+            second = threading.Thread(target=encrypt_chunk)
+            second.start()
+            # The chunk is not referred to until it is written
+            second.join(0.1)
+            self.assertTrue(second.is_alive())
+            release.set()
+            first.join()
+            second.join()
+
+        # The failed chunk is forgotten and written by the other caller
+        self.assertEqual(1, len(errors))
+        self.assertEqual([chunk_id, chunk_id], writes)
+        self.assertEqual(results[0][1], self.gpm._chunk_keys[chunk_id][0])
+        self.assertTrue(self.gpm._chunk_blob(chunk_id).is_file())
+        self.assertEqual({}, self.gpm._chunk_writes)
+
+    def test_copy_reuses_chunks(self):
+        blobs = blobs_in_directory(self.output_directory)
+        (self.working_directory / 'copy').write_bytes(self.file_data)
+        self.gpm.encrypt()
+        self.assertEqual(blobs, blobs_in_directory(self.output_directory))
+
+        # Shared chunks are kept while referenced
+        self.file_path.unlink()
+        self.gpm.encrypt()
+        self.assertEqual(blobs, blobs_in_directory(self.output_directory))
+        self.gpm.decrypt()
+        self.assertEqual(self.file_data, (self.working_directory / 'copy').read_bytes())
+
+    def test_delete_removes_chunks(self):
+        self.file_path.unlink()
+        self.gpm.encrypt()
+        # Only the manifest is left
+        self.assertEqual(0, blobs_in_directory(self.output_directory))
+
+
+class TestDeduplication(unittest.TestCase):
+    """
+    Test that files with the same content share a blob.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory, dedup=True)
+
+        self.file_1_path, self.file_data = add_file(self.working_directory)
+        self.file_2_path = self.working_directory / 'copy'
+        self.file_2_path.write_bytes(self.file_data)
+        self.gpm.encrypt()
+
+    def test_copies_share_blob(self):
+        # Manifest and a single blob
+        self.assertEqual(1, blobs_in_directory(self.output_directory))
+        self.file_1_path.unlink()
+        self.file_2_path.unlink()
+        self.gpm.decrypt()
+        self.assertEqual(self.file_data, self.file_1_path.read_bytes())
+        self.assertEqual(self.file_data, self.file_2_path.read_bytes())
+
+    @patch('git_privacy_manager.gpm.GPM._encrypt_file')
+    def test_rename_without_encryption(self, mock_encrypt):
+        self.file_1_path.rename(self.working_directory / 'renamed')
+        self.gpm.encrypt()
+        mock_encrypt.assert_not_called()
+
+    def test_blob_removed_with_last_reference(self):
+        self.file_1_path.unlink()
+        self.gpm.encrypt()
+        self.assertEqual(1, blobs_in_directory(self.output_directory))
+        self.file_2_path.unlink()
+        self.gpm.encrypt()
+        self.assertEqual(0, blobs_in_directory(self.output_directory))
+
+
+class TestRename(unittest.TestCase):
+    """
+    Test that renamed files keep their blobs.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory)
+
+        self.file_path, self.file_data = add_file(self.working_directory)
+        self.gpm.encrypt()
+        self.uuid = self.gpm._metadata[self.file_path.name]['uuid']
+
+    def _check_renamed(self, new_path):
+        self.assertNotIn(self.file_path.name, self.gpm._metadata)
+        key = str(new_path.relative_to(self.working_directory))
+        self.assertEqual(self.uuid, self.gpm._metadata[key]['uuid'])
+        self.assertEqual(1, blobs_in_directory(self.output_directory))
+
+        new_path.unlink()
+        self.gpm.decrypt()
+        self.assertEqual(self.file_data, new_path.read_bytes())
+
+    def test_move_to_directory(self):
+        new_path = self.working_directory / 'subdir' / 'renamed'
+        new_path.parent.mkdir()
+        self.file_path.rename(new_path)
+        with patch('git_privacy_manager.gpm.checksum') as mock_checksum, \
+                patch('git_privacy_manager.gpm.GPM._encrypt_file') as mock_encrypt:
+            self.gpm.encrypt()
+
+        # Matched by stats without hashing and encryption
+        mock_checksum.assert_not_called()
+        mock_encrypt.assert_not_called()
+        self._check_renamed(new_path)
+
+    def test_copy_and_delete(self):
+        new_path = self.working_directory / 'copy'
+        new_path.write_bytes(self.file_data)
+        self.file_path.unlink()
+        self.gpm.encrypt()
+
+        # Matched by checksum
+        self._check_renamed(new_path)
+
+    def test_rename_and_modify(self):
+        new_path = self.working_directory / 'renamed'
+        new_path.write_bytes(b'modified')
+        self.file_path.unlink()
+        self.gpm.encrypt()
+
+        self.assertNotIn(self.file_path.name, self.gpm._metadata)
+        self.assertNotEqual(self.uuid, self.gpm._metadata['renamed']['uuid'])
+        self.assertEqual(1, blobs_in_directory(self.output_directory))
+
+
+class TestIgnoreFile(unittest.TestCase):
+    """
+    Test that files ignored by .gpmignore are left alone.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory)
+
+        (self.working_directory / '.gpmignore').write_text('build/\n')
+        self.ignored = self.working_directory / 'build' / 'output'
+        self.ignored.parent.mkdir()
+        self.ignored.write_bytes(b'ignored')
+        self.file_path, self.file_data = add_file(self.working_directory)
+        self.gpm.encrypt()
+
+    def test_ignored_not_encrypted(self):
+        self.assertEqual({'.gpmignore', self.file_path.name}, set(self.gpm._metadata))
+
+    def test_ignored_not_removed(self):
+        self.file_path.unlink()
+        self.gpm.decrypt()
+        self.assertTrue(self.ignored.is_file())
+        self.assertEqual(self.file_data, self.file_path.read_bytes())
+
+    def test_output_inside_working_directory(self):
+        output = self.working_directory / 'encrypted'
+        g = gpm.GPM(self.working_directory, self.pswd, output)
+        g.encrypt()
+        self.assertFalse(any(key.startswith('encrypted') for key in g._metadata))
+
+
+class TestManifest(unittest.TestCase):
+    """
+    Test local metadata backends and shards of encrypted manifest.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory, metadata='sqlite')
+
+        self.files = {}
+        for directory in ('a', 'b', 'c'):
+            (self.working_directory / directory).mkdir()
+            self.files.update(add_file(self.working_directory / directory) for _ in range(2))
+        self.gpm.encrypt()
+
+    def _clone(self):
+        working_directory = Path(tempfile.mkdtemp())
+        clone = gpm.GPM(working_directory, self.pswd, self.output_directory)
+        clone.decrypt()
+        for file, data in self.files.items():
+            self.assertEqual(
+                data, (working_directory / file.relative_to(self.working_directory)).read_bytes())
+        return clone
+
+    def _manifest_blobs(self):
+        return len(list(self.output_directory.glob('meta*.gpg')))
+
+    def _manifest_mtimes(self):
+        return {blob.name: blob.stat().st_mtime_ns
+                for blob in self.output_directory.glob('meta*.gpg')}
+
+    def test_sqlite_backend(self):
+        self.assertTrue((self.working_directory / '.gpm' / 'metadata.db').is_file())
+        reopened = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory, metadata='sqlite')
+        self.assertEqual(self.gpm._metadata, reopened._metadata)
+
+    def test_shards(self):
+        shards = {self.gpm._shard(d) for d in ('a', 'b', 'c')}
+        self.assertEqual(len(shards) + 1, self._manifest_blobs())
+        self._clone()
+
+    def test_unchanged_manifest_not_written(self):
+        mtimes = self._manifest_mtimes()
+        self.gpm.encrypt()
+        self.assertEqual(mtimes, self._manifest_mtimes())
+
+    def test_only_changed_shard_written(self):
+        mtimes = self._manifest_mtimes()
+        file = next(f for f in self.files if f.parent.name == 'a')
+        self.files[file] = b'modified'
+        file.write_bytes(b'modified')
+        self.gpm.encrypt()
+
+        written = {name for name, mtime in self._manifest_mtimes().items()
+                   if mtimes.get(name) != mtime}
+        self.assertEqual({self.gpm._shard_blob(self.gpm._shard('a')).name}, written)
+        self._clone()
+
+    def test_removed_directory(self):
+        for file in [f for f in self.files if f.parent.name == 'b']:
+            file.unlink()
+            del self.files[file]
+        self.gpm.encrypt()
+        self.assertNotIn(self.gpm._shard('b'), self.gpm._store.settings['shards'])
+        self._clone()
+
+    def test_wrong_passphrase(self):
+        blobs = {blob.name: blob.read_bytes() for blob in self.output_directory.glob('meta*.gpg')}
+        file = next(f for f in self.files if f.parent.name == 'a')
+        self.files[file] = b'modified'
+        file.write_bytes(b'modified')
+        wrong = gpm.GPM(self.working_directory, 'wrong', self.output_directory, metadata='sqlite')
+        with self.assertRaises(gpm.gpm.WrongKeyError):
+            wrong.encrypt()
+        # Nothing is sealed with the wrong key
+        self.assertEqual(blobs, {blob.name: blob.read_bytes()
+                                 for blob in self.output_directory.glob('meta*.gpg')})
+        gpm.GPM(self.working_directory, self.pswd, self.output_directory, metadata='sqlite').encrypt()
+        self._clone()
+
+    def test_rekeyed_manifest_rewritten(self):
+        # As if the manifest was sealed with another key
+        self.gpm._store.publish(self.gpm._metadata, {'key': 'other'})
+        mtimes = self._manifest_mtimes()
+        file = next(f for f in self.files if f.parent.name == 'a')
+        self.files[file] = b'modified'
+        file.write_bytes(b'modified')
+        self.gpm.encrypt()
+        self.assertTrue(all(mtimes[name] != mtime for name, mtime in self._manifest_mtimes().items()))
+        self.assertEqual(self.gpm._key_id(), self.gpm._store.settings['key'])
+        self._clone()
+
+    def test_legacy_manifest(self):
+        legacy = {key: gpm.gpm._published(entry)
+                  for key, entry in self.gpm._metadata.items()}
+        for blob in self.output_directory.glob('meta*.gpg'):
+            blob.unlink()
+        (self.output_directory / 'kdf.json').unlink()
+        self.gpm.unlock(kdf.derive(self.pswd, kdf.LEGACY), kdf.LEGACY)
+        self.gpm._write_json_blob(self.gpm._metafile_blob, legacy)
+        clone = self._clone()
+        self.assertEqual(kdf.LEGACY, clone.kdf_params)
+
+        # Upgraded to shards by the next encrypt, but the key is the same
+        clone.encrypt()
+        self.assertEqual(len(clone._store.settings['shards']) + 1, self._manifest_blobs())
+        self.assertFalse((self.output_directory / 'kdf.json').exists())
+        self._clone()
+
+
+class TestKeyDerivation(unittest.TestCase):
+    """
+    Test that master key is derived with stored parameters.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory, kdf_iterations=1000)
+        self.file_path, self.file_data = add_file(self.working_directory)
+
+    def test_params_written(self):
+        self.assertFalse((self.output_directory / 'kdf.json').exists())
+        self.gpm.encrypt()
+        params = kdf.read_params(self.output_directory / 'kdf.json')
+        self.assertEqual(1000, params['iterations'])
+        self.assertIsNotNone(params['salt'])
+        self.assertEqual(kdf.derive(self.pswd, params), self.gpm.key)
+
+    def test_unlock_with_master_key(self):
+        self.gpm.encrypt()
+        g = gpm.GPM(self.working_directory, None, self.output_directory)
+        with patch('git_privacy_manager.utils.kdf.derive') as mock_derive:
+            g.unlock(self.gpm.key, self.gpm.kdf_params)
+            self.file_path.unlink()
+            g.decrypt()
+        mock_derive.assert_not_called()
+        self.assertEqual(self.file_data, self.file_path.read_bytes())
+
+    def test_no_passphrase(self):
+        g = gpm.GPM(self.working_directory, None, self.output_directory)
+        with self.assertRaises(RuntimeError):
+            g.encrypt()
+
+
+class TestSelectiveDecrypt(unittest.TestCase):
+    """
+    Test decryption of a subtree.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory)
+
+        self.files = {}
+        for name in ('config/prod/a', 'config/prod/deep/b', 'config/dev/c', 'data/d', 'e'):
+            path = self.working_directory / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(name.encode())
+            self.files[name] = name.encode()
+        self.gpm.encrypt()
+
+        self.clone_directory = Path(tempfile.mkdtemp())
+        self.clone = gpm.GPM(self.clone_directory, self.pswd, self.output_directory)
+
+    def _files(self, directory):
+        return {str(f.relative_to(directory)) for f in directory.rglob('*')
+                if f.is_file() and '.gpm' not in f.parts}
+
+    def test_subtree(self):
+        read = []
+        read_json_blob = gpm.GPM._read_json_blob
+
+        def tracked(g, blob):
+            read.append(blob.name)
+            return read_json_blob(g, blob)
+
+        with patch('git_privacy_manager.gpm.GPM._read_json_blob', tracked), \
+                patch('git_privacy_manager.gpm.GPM._decrypt_entry',
+                      autospec=True, side_effect=gpm.GPM._decrypt_entry) as mock_decrypt:
+            self.clone.decrypt(['config/prod/**'])
+
+        self.assertEqual({'config/prod/a', 'config/prod/deep/b'}, self._files(self.clone_directory))
+        self.assertEqual(2, mock_decrypt.call_count)
+        shards = {self.clone._shard_blob(self.clone._shard(d)).name
+                  for d in ('config/prod', 'config/prod/deep')}
+        self.assertEqual({'meta.gpg'} | shards, set(read))
+
+    def test_file_and_glob(self):
+        self.clone.decrypt(['e', 'config/*/c'])
+        self.assertEqual({'e', 'config/dev/c'}, self._files(self.clone_directory))
+
+    def test_rest_of_tree_untouched(self):
+        (self.working_directory / 'data' / 'd').write_bytes(b'local')
+        (self.working_directory / 'untracked').write_bytes(b'untracked')
+        (self.working_directory / 'config' / 'prod' / 'a').unlink()
+        self.gpm.decrypt(['config'])
+
+        self.assertEqual(b'config/prod/a', (self.working_directory / 'config' / 'prod' / 'a').read_bytes())
+        self.assertEqual(b'local', (self.working_directory / 'data' / 'd').read_bytes())
+        self.assertTrue((self.working_directory / 'untracked').is_file())
+
+    def test_encrypt_refused_until_full_decrypt(self):
+        self.clone.decrypt(['data'])
+        with self.assertRaises(RuntimeError):
+            self.clone.encrypt()
+
+        self.clone.decrypt()
+        self.assertEqual(set(self.files), self._files(self.clone_directory))
+        self.clone.encrypt()
+
+
+class TestCompression(unittest.TestCase):
+    """
+    Test compression of files before encryption.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory, compression='zlib')
+
+        self.text = self.working_directory / 'dump.sql'
+        self.text_data = b''.join(b'INSERT INTO t VALUES (%d);\n' % i for i in range(100000))
+        self.text.write_bytes(self.text_data)
+        self.random = self.working_directory / 'photo.jpg'
+        self.random_data = os.urandom(100000)
+        self.random.write_bytes(self.random_data)
+
+    def _check_decrypt(self):
+        self.text.unlink()
+        self.random.unlink()
+        self.gpm.decrypt()
+        self.assertEqual(self.text_data, self.text.read_bytes())
+        self.assertEqual(self.random_data, self.random.read_bytes())
+
+    def test_compressed(self):
+        self.gpm.encrypt()
+        self.assertEqual('zlib', self.gpm._metadata['dump.sql']['compression'])
+        self.assertLess(self.gpm._blob('dump.sql').stat().st_size, len(self.text_data) // 5)
+        # Incompressible data is stored as is
+        self.assertNotIn('compression', self.gpm._metadata['photo.jpg'])
+        self._check_decrypt()
+
+    def test_chunks_compressed(self):
+        self.gpm.chunking = self.gpm.dedup = True
+        self.text_data *= 2
+        self.text.write_bytes(self.text_data)
+        self.gpm.encrypt()
+        chunks = self.gpm._metadata['dump.sql']['chunks']
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(chunk[3] == 'zlib' for chunk in chunks))
+        self.assertEqual(3, len(self.gpm._metadata['photo.jpg']['chunks'][0]))
+        self._check_decrypt()
+
+    def test_modified_to_incompressible(self):
+        self.gpm.encrypt()
+        self.text_data = os.urandom(1000)
+        self.text.write_bytes(self.text_data)
+        self.gpm.encrypt()
+        self.assertNotIn('compression', self.gpm._metadata['dump.sql'])
+        self._check_decrypt()
+
+    def test_unavailable(self):
+        with patch('git_privacy_manager.utils.compression.zstandard', None):
+            with self.assertRaises(RuntimeError):
+                gpm.GPM(self.working_directory, self.pswd, self.output_directory,
+                        compression='zstd')
+
+
+class TestBuffers(unittest.TestCase):
+    """
+    Test reading files by small blocks and hashing mapped files.
+    """
+
+    def test_small_buffer_and_mmap(self):
+        working_directory = Path(tempfile.mkdtemp())
+        output_directory = Path(tempfile.mkdtemp())
+        data = os.urandom(10000)
+        (working_directory / 'file').write_bytes(data)
+        (working_directory / 'empty').touch()
+        g = gpm.GPM(working_directory, '123', output_directory,
+                    buffer_size=1000, mmap=True, dedup=True)
+        g.encrypt()
+        for f in ('file', 'empty'):
+            (working_directory / f).unlink()
+
+        g = gpm.GPM(working_directory, '123', output_directory,
+                    buffer_size=1000, mmap=True, dedup=True)
+        g.decrypt()
+        self.assertEqual(data, (working_directory / 'file').read_bytes())
+        self.assertEqual(b'', (working_directory / 'empty').read_bytes())
+
+
+class TestPacks(unittest.TestCase):
+    """
+    Test packing of small files.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.output_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd,
+                           self.output_directory, pack=True)
+        self.data = {f'file{i}': os.urandom(100 + i) for i in range(10)}
+        self.data['large'] = os.urandom(200000)
+        for name, data in self.data.items():
+            (self.working_directory / name).write_bytes(data)
+
+    def _packs(self):
+        return list(self.output_directory.glob('*.pack'))
+
+    def _check_decrypt(self):
+        for name in self.data:
+            (self.working_directory / name).unlink()
+        g = gpm.GPM(self.working_directory, self.pswd, self.output_directory, pack=True)
+        g.decrypt()
+        for name, data in self.data.items():
+            self.assertEqual(data, (self.working_directory / name).read_bytes())
+
+    def test_packed(self):
+        self.gpm.encrypt()
+        self.assertEqual(1, len(self._packs()))
+        # Only large file has a blob of its own
+        self.assertEqual(1, blobs_in_directory(self.output_directory))
+        self.assertIn('pack', self.gpm._metadata['file0'])
+        self.assertNotIn('pack', self.gpm._metadata['large'])
+        self._check_decrypt()
+
+    def test_modified(self):
+        self.gpm.encrypt()
+        pack = self._packs()[0]
+        # Same size, so the file is encrypted after it is hashed
+        self.data['file1'] = os.urandom(101)
+        # Other size, so the file is hashed and encrypted in a single read
+        self.data['file2'] = os.urandom(50)
+        for name in ('file1', 'file2'):
+            (self.working_directory / name).write_bytes(self.data[name])
+        self.gpm.encrypt()
+        self.assertEqual(2, len(self._packs()))
+        self.assertNotEqual(pack.stem, self.gpm._metadata['file1']['pack'][0])
+        self.assertEqual(self.gpm._metadata['file1']['pack'][0],
+                         self.gpm._metadata['file2']['pack'][0])
+        self._check_decrypt()
+
+    def test_blob_to_pack(self):
+        self.gpm.pack = False
+        self.gpm.encrypt()
+        self.assertEqual(0, len(self._packs()))
+        self.gpm.pack = True
+        self.data['file0'] = os.urandom(100)
+        (self.working_directory / 'file0').write_bytes(self.data['file0'])
+        self.gpm.encrypt()
+        self.assertEqual(1, len(self._packs()))
+        self.assertEqual(len(self.data) - 1, blobs_in_directory(self.output_directory))
+        self._check_decrypt()
+
+    def test_repack(self):
+        self.gpm.encrypt()
+        old = self._packs()[0]
+        for i in range(7):
+            (self.working_directory / f'file{i}').unlink()
+            del self.data[f'file{i}']
+        self.gpm.encrypt()
+        # Removed members are kept until the pack is compacted
+        self.assertEqual([old], self._packs())
+        self.gpm.repack()
+        packs = self._packs()
+        self.assertEqual(1, len(packs))
+        self.assertNotEqual(old, packs[0])
+        members = [entry['pack'] for entry in self.gpm._metadata.values() if 'pack' in entry]
+        self.assertEqual(3, len(members))
+        self.assertEqual(sum(length for _, _, length in members), packs[0].stat().st_size)
+        self._check_decrypt()
+
+    def test_all_removed(self):
+        self.gpm.encrypt()
+        for name in list(self.data):
+            if name != 'large':
+                (self.working_directory / name).unlink()
+                del self.data[name]
+        self.gpm.encrypt()
+        # Pack without live members is removed right away
+        self.assertEqual([], self._packs())
+        self._check_decrypt()
+
+    def test_gc(self):
+        self.gpm.encrypt()
+        orphans = [self.output_directory / name for name in (
+            f'{uuid.uuid4()}.gpg', f'{uuid.uuid4()}.pack', f'{uuid.uuid4()}.tmp')]
+        for orphan in orphans:
+            orphan.write_bytes(b'orphan')
+        blobs = set(self.output_directory.iterdir())
+        self.gpm.gc()
+        self.assertEqual(blobs - set(orphans), set(self.output_directory.iterdir()))
+        self._check_decrypt()
+
+
+class TestCrashSafety(unittest.TestCase):
+    """
+    Test that an interrupted encrypt leaves consistent blobs and metadata.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.data = {'a': b'a' * 1000, 'b': b'b' * 1000}
+        for name, data in self.data.items():
+            (self.working_directory / name).write_bytes(data)
+        gpm.GPM(self.working_directory, self.pswd).encrypt()
+        # Other size, so the file is hashed and encrypted in a single read
+        self.data['a'] = b'new' * 1000
+        (self.working_directory / 'a').write_bytes(self.data['a'])
+        self.data['c'] = b'c' * 1000
+        (self.working_directory / 'c').write_bytes(self.data['c'])
+
+    def _crash(self, flush):
+        def crash(journal):
+            if flush:
+                flush(journal)
+            raise KeyboardInterrupt
+        with patch.object(gpm.utils.journal.Journal, 'flush', crash):
+            with self.assertRaises(KeyboardInterrupt):
+                gpm.GPM(self.working_directory, self.pswd).encrypt()
+
+    def _check_decrypt(self, data):
+        for name in data:
+            (self.working_directory / name).unlink()
+        gpm.GPM(self.working_directory, self.pswd).decrypt()
+        for name, content in data.items():
+            self.assertEqual(content, (self.working_directory / name).read_bytes())
+
+    def test_crash_before_journal(self):
+        self._crash(None)
+        g = gpm.GPM(self.working_directory, self.pswd)
+        # Nothing is committed and the old blob is intact
+        self.assertNotIn('c', g._metadata)
+        self._check_decrypt({name: self.data[name] for name in ('b',)})
+        (self.working_directory / 'c').write_bytes(self.data['c'])
+        (self.working_directory / 'a').write_bytes(self.data['a'])
+        g = gpm.GPM(self.working_directory, self.pswd)
+        g.encrypt()
+        self.assertEqual([], list(g.output_dir.glob('*.tmp')))
+
+    def test_resume_from_journal(self):
+        self._crash(gpm.utils.journal.Journal.flush)
+        g = gpm.GPM(self.working_directory, self.pswd)
+        self.assertFalse(g._journal.path.exists())
+        self.assertIn('c', g._metadata)
+        with patch.object(gpm.GPM, '_hash_and_encrypt') as mock_encrypt:
+            g.encrypt()
+            mock_encrypt.assert_not_called()
+        self.assertEqual([], list(g.output_dir.glob('*.tmp')))
+        self._check_decrypt(self.data)
+
+    def test_crash_before_manifest(self):
+        # Same size, so the file is hashed and encrypted separately
+        (self.working_directory / 'b').write_bytes(b'B' * 1000)
+        old = {'a': b'a' * 1000, 'b': b'b' * 1000}
+        with patch.object(gpm.GPM, '_write_metadata_blob', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                gpm.GPM(self.working_directory, self.pswd).encrypt()
+        # A clone of output directory has the old manifest and its blobs
+        clone = Path(tempfile.mkdtemp())
+        shutil.copytree(self.working_directory / '.gpm' / 'data', clone / 'data')
+        gpm.GPM(clone / 'work', self.pswd, clone / 'data').decrypt()
+        for name, data in old.items():
+            self.assertEqual(data, (clone / 'work' / name).read_bytes())
+
+        g = gpm.GPM(self.working_directory, self.pswd)
+        g.encrypt()
+        # Old blobs are left to gc once the new manifest is published
+        g.gc()
+        self.assertEqual(3, blobs_in_directory(g.output_dir))
+        self.data['b'] = b'B' * 1000
+        self._check_decrypt(self.data)
+
+
+class TestCheckpoints(unittest.TestCase):
+    """
+    Test that progress of a long encrypt is committed on the way.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.data = {f'file{i}': os.urandom(1000) for i in range(6)}
+        for name, data in self.data.items():
+            (self.working_directory / name).write_bytes(data)
+
+    def _gpm(self, **kwargs):
+        return gpm.GPM(self.working_directory, self.pswd, checkpoint_files=2, **kwargs)
+
+    def _crash_on(self, method: str, call: int, exception: type):
+        original = getattr(gpm.GPM, method)
+        calls = []
+
+        def crash(g, *args):
+            calls.append(args)
+            if len(calls) == call:
+                raise exception
+            return original(g, *args)
+        with patch.object(gpm.GPM, method, crash):
+            with self.assertRaises(exception):
+                self._gpm().encrypt()
+
+    def _check_decrypt(self):
+        for name in self.data:
+            (self.working_directory / name).unlink()
+        self._gpm().decrypt()
+        for name, data in self.data.items():
+            self.assertEqual(data, (self.working_directory / name).read_bytes())
+
+    def test_checkpoints(self):
+        g = self._gpm()
+        with patch.object(gpm.GPM, '_checkpoint', autospec=True, side_effect=gpm.GPM._checkpoint) as checkpoint:
+            g.encrypt()
+        # Every two files and once at the end
+        self.assertEqual(4, checkpoint.call_count)
+
+    def test_json_committed_at_end(self):
+        for backend, store, commits in (('json', gpm.utils.metadata.JsonStore, 1),
+                                        ('sqlite', gpm.utils.metadata.SqliteStore, 3)):
+            with self.subTest(backend=backend):
+                shutil.rmtree(self.working_directory / '.gpm', ignore_errors=True)
+                with patch.object(store, 'commit', autospec=True, side_effect=store.commit) as commit:
+                    self._gpm(metadata=backend).encrypt()
+                # Checkpoints on the way only sync the journal unless the
+                # store writes changed entries only
+                self.assertEqual(commits, commit.call_count)
+                self._check_decrypt()
+
+    def test_resume_after_crash(self):
+        # Not even rollback is done, as if the process was killed
+        self._crash_on('_hash_and_encrypt', 6, SystemExit)
+        g = self._gpm()
+        self.assertEqual(4, len(g._metadata))
+        with patch.object(gpm.GPM, '_hash_and_encrypt', autospec=True,
+                          side_effect=gpm.GPM._hash_and_encrypt) as hash_and_encrypt:
+            g.encrypt()
+        self.assertEqual(2, hash_and_encrypt.call_count)
+        self._check_decrypt()
+
+    def test_resume_after_interrupt(self):
+        self._crash_on('_hash_and_encrypt', 4, KeyboardInterrupt)
+        # Files encrypted before Ctrl-C are committed
+        self.assertEqual(3, len(self._gpm()._metadata))
+        self._gpm().encrypt()
+        self._check_decrypt()
+
+    def test_unencrypted_modified_file(self):
+        self._gpm().encrypt()
+        # Same size, so files are hashed first and encrypted later
+        for name in self.data:
+            self.data[name] = os.urandom(1000)
+            (self.working_directory / name).write_bytes(self.data[name])
+        self._crash_on('_encrypt_entry', 4, SystemExit)
+        # Modified files which were not encrypted keep previous entries
+        g = self._gpm()
+        with patch.object(gpm.GPM, '_encrypt_entry', autospec=True,
+                          side_effect=gpm.GPM._encrypt_entry) as encrypt_entry:
+            g.encrypt()
+        self.assertEqual(4, encrypt_entry.call_count)
+        self._check_decrypt()
+
+    def test_progress(self):
+        with patch('sys.stderr') as stderr:
+            self._gpm(progress=True).encrypt()
+        self.assertIn('6/6 files', stderr.write.call_args[0][0])
+
+
+class TestSelectiveEncrypt(unittest.TestCase):
+    """
+    Test encryption of touched paths only.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd)
+        for name in ('a/1', 'a/2', 'b/3', '4'):
+            path = self.working_directory / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+        self.gpm.encrypt()
+
+    def test_only_selected(self):
+        (self.working_directory / 'a' / '1').write_text('new 1')
+        (self.working_directory / 'b' / '3').write_text('new 3')
+        (self.working_directory / 'a' / '2').unlink()
+        (self.working_directory / '4').unlink()
+        (self.working_directory / 'b' / '5').write_text('5')
+        with patch.object(gpm.GPM, '_hash_and_encrypt', autospec=True,
+                          side_effect=gpm.GPM._hash_and_encrypt) as hash_and_encrypt:
+            self.gpm.encrypt(paths=['a', 'b/5'])
+        self.assertEqual([(self.gpm, self.working_directory / 'a' / '1'), (self.gpm, self.working_directory / 'b' / '5')],
+                         [c.args for c in hash_and_encrypt.call_args_list])
+        # Removed file out of selected paths is kept
+        self.assertEqual({'a/1', 'b/3', 'b/5', '4'}, {k.replace(os.sep, '/') for k in self.gpm._metadata})
+
+        self.gpm.encrypt()
+        for name in ('a/1', 'b/3', 'b/5'):
+            (self.working_directory / name).unlink()
+        self.gpm.decrypt()
+        self.assertEqual('new 1', (self.working_directory / 'a' / '1').read_text())
+        self.assertEqual('new 3', (self.working_directory / 'b' / '3').read_text())
+        self.assertFalse((self.working_directory / '4').exists())
+
+    def test_removed_directory(self):
+        for name in ('1', '2'):
+            (self.working_directory / 'a' / name).unlink()
+        (self.working_directory / 'a').rmdir()
+        self.gpm.encrypt(paths=['a'])
+        self.assertEqual({'b/3', '4'}, {k.replace(os.sep, '/') for k in self.gpm._metadata})
+
+
+class TestPlan(unittest.TestCase):
+    """
+    Test plans of encrypt and decrypt.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd)
+        for name in ('a/1', 'a/2', 'b/3', '4'):
+            path = self.working_directory / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+        self.gpm.encrypt()
+
+    def paths(self, plan, category):
+        return [file['path'].replace(os.sep, '/') for file in plan.files[category]]
+
+    def test_encrypt(self):
+        (self.working_directory / 'a' / '1').write_text('new 1')
+        (self.working_directory / 'a' / '2').unlink()
+        (self.working_directory / '4').rename(self.working_directory / 'b' / '4')
+        (self.working_directory / 'b' / '5').write_text('55')
+        metadata = json.loads(json.dumps(self.gpm._metadata))
+        with patch.object(gpm.GPM, '_checksum') as checksum, \
+                patch.object(gpm.GPM, '_fingerprint') as fingerprint:
+            plan = self.gpm.encrypt(dry_run=True)
+        checksum.assert_not_called()
+        fingerprint.assert_not_called()
+        self.assertEqual(['b/5'], self.paths(plan, 'added'))
+        self.assertEqual(['a/1'], self.paths(plan, 'modified'))
+        self.assertEqual(['a/2'], self.paths(plan, 'deleted'))
+        self.assertEqual(['b/3'], self.paths(plan, 'unchanged'))
+        self.assertEqual([('4', 'b/4')], [(file['from'], file['path'].replace(os.sep, '/'))
+                                          for file in plan.files['renamed']])
+        self.assertEqual(2, plan.size('added'))
+        self.assertEqual(5, plan.size('modified'))
+        self.assertEqual(3, plan.size('deleted'))
+        # Nothing is changed
+        self.assertEqual(metadata, self.gpm._metadata)
+
+        self.gpm.encrypt()
+        self.assertFalse(self.gpm.plan())
+        self.assertEqual(4, self.gpm.plan().count('unchanged'))
+
+    def test_encrypt_selected(self):
+        (self.working_directory / 'a' / '1').write_text('new 1')
+        (self.working_directory / '4').unlink()
+        plan = self.gpm.plan(paths=['a'])
+        self.assertEqual(['a/1'], self.paths(plan, 'modified'))
+        self.assertEqual(['a/2'], self.paths(plan, 'unchanged'))
+        self.assertEqual([], self.paths(plan, 'deleted'))
+
+    def test_decrypt(self):
+        (self.working_directory / 'a' / '1').unlink()
+        (self.working_directory / 'a' / '2').write_text('new 2')
+        (self.working_directory / '5').write_text('5')
+        blobs = sorted(self.gpm.output_dir.iterdir())
+        plan = self.gpm.decrypt(dry_run=True)
+        self.assertEqual(['a/1'], self.paths(plan, 'added'))
+        self.assertEqual(['a/2'], self.paths(plan, 'modified'))
+        self.assertEqual(['5'], self.paths(plan, 'deleted'))
+        self.assertEqual(['4', 'b/3'], self.paths(plan, 'unchanged'))
+        self.assertEqual(self.gpm._blob('a/1').stat().st_size, plan.size('added'))
+        # Nothing is changed
+        self.assertFalse((self.working_directory / 'a' / '1').exists())
+        self.assertEqual('new 2', (self.working_directory / 'a' / '2').read_text())
+        self.assertTrue((self.working_directory / '5').exists())
+        self.assertEqual(blobs, sorted(self.gpm.output_dir.iterdir()))
+
+        self.gpm.decrypt()
+        self.assertFalse(self.gpm.decrypt(dry_run=True))
+
+    def test_decrypt_selected(self):
+        (self.working_directory / 'a' / '1').unlink()
+        (self.working_directory / 'b' / '3').unlink()
+        plan = self.gpm.decrypt(paths=['b'], dry_run=True)
+        self.assertEqual(['b/3'], self.paths(plan, 'added'))
+        self.assertEqual([], self.paths(plan, 'unchanged'))
+
+
+    def _snapshot(self):
+        return {path: path.read_bytes()
+                for path in sorted((self.working_directory / '.gpm').rglob('*')) if path.is_file()}
+
+    def test_read_only(self):
+        (self.working_directory / 'a' / '1').write_text('new 1')
+
+        def crash(journal):
+            flush(journal)
+            raise KeyboardInterrupt
+        flush = gpm.utils.journal.Journal.flush
+        with patch.object(gpm.utils.journal.Journal, 'flush', crash):
+            with self.assertRaises(KeyboardInterrupt):
+                gpm.GPM(self.working_directory, self.pswd).encrypt()
+        snapshot = self._snapshot()
+        self.assertIn(self.gpm.metadata_dir / 'journal', snapshot)
+
+        g = gpm.GPM(self.working_directory, self.pswd, read_only=True)
+        # The journaled file is planned as encrypted, but is not recovered
+        # and the manifest has its old version
+        self.assertFalse(g.encrypt(dry_run=True))
+        self.assertEqual(['a/1'], self.paths(g.decrypt(dry_run=True), 'modified'))
+        with self.assertRaises(RuntimeError):
+            g.encrypt()
+        self.assertEqual(snapshot, self._snapshot())
+
+    def test_read_only_sqlite(self):
+        g = gpm.GPM(self.working_directory, self.pswd, metadata='sqlite')
+        g.encrypt()
+        g._store.close()
+        (self.working_directory / '5').write_text('5')
+        snapshot = self._snapshot()
+        g = gpm.GPM(self.working_directory, self.pswd, metadata='sqlite', read_only=True)
+        self.assertEqual(['5'], self.paths(g.plan(), 'added'))
+        g.decrypt(dry_run=True)
+        self.assertEqual(snapshot, self._snapshot())
+
+    def test_read_only_new_directory(self):
+        directory = Path(tempfile.mkdtemp())
+        (directory / 'a').write_text('a')
+        for backend in ('json', 'sqlite'):
+            plan = gpm.GPM(directory, self.pswd, metadata=backend, read_only=True).plan()
+            self.assertEqual(['a'], self.paths(plan, 'added'))
+            self.assertEqual([directory / 'a'], list(directory.iterdir()))
+
+class TestStats(unittest.TestCase):
+    """
+    Test instrumentation of encrypt and decrypt.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.events = []
+        self.stats = Stats(hooks=[self.events.append])
+        self.gpm = gpm.GPM(self.working_directory, self.pswd, stats=self.stats)
+        for name in ('a/1', 'a/2', '3'):
+            path = self.working_directory / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(os.urandom(1000))
+
+    def test_encrypt(self):
+        self.gpm.encrypt()
+        stats = self.stats.to_dict()
+        phases = stats['phases']
+        for name in ('kdf', 'walk', 'uuid', 'hash+encrypt', 'cipher', 'checkpoint', 'metadata', 'manifest'):
+            self.assertIn(name, phases)
+        self.assertEqual(3, phases['walk']['files'])
+        self.assertEqual({'calls': 3, 'files': 3, 'bytes': 3000},
+                         {k: v for k, v in phases['hash+encrypt'].items() if k != 'seconds'})
+        self.assertEqual(3, len(stats['slowest']))
+        self.assertIn(str(self.working_directory / '3'), [file['file'] for file in stats['slowest']])
+        self.assertIn('cipher', [event.phase for event in self.events])
+
+    def test_decrypt(self):
+        self.gpm.encrypt()
+        (self.working_directory / '3').unlink()
+        stats = Stats()
+        gpm.GPM(self.working_directory, self.pswd, stats=stats).decrypt()
+        phases = stats.to_dict()['phases']
+        self.assertEqual({'calls': 1, 'files': 1, 'bytes': 1000},
+                         {k: v for k, v in phases['decrypt'].items() if k != 'seconds'})
+        self.assertNotIn('encrypt', phases)
+
+    def test_disabled(self):
+        # Functions of files are not wrapped
+        self.gpm.stats = None
+        func = self.gpm._checksum
+        self.assertIs(func, self.gpm._timed('hash', func))
+        phases = self.stats.to_dict()['phases']
+        self.gpm.encrypt()
+        self.assertEqual(phases, self.stats.to_dict()['phases'])
+
+
+class TestLogging(unittest.TestCase):
+    """
+    Test logs of encrypt and decrypt.
+    """
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        self.pswd = '123'
+        self.gpm = gpm.GPM(self.working_directory, self.pswd)
+        for i in range(10):
+            (self.working_directory / str(i)).write_text(str(i))
+        self.gpm.encrypt()
+
+    def test_no_secrets(self):
+        passphrases = [entry['passphrase'] for entry in self.gpm._metadata.values()]
+        for i in range(5):
+            (self.working_directory / str(i)).unlink()
+        with self.assertLogs(level='DEBUG') as logs:
+            gpm.GPM(self.working_directory, self.pswd).encrypt()
+            gpm.GPM(self.working_directory, self.pswd).decrypt()
+        output = '\n'.join(logs.output)
+        for secret in passphrases + [self.gpm._crypto_key.decode()]:
+            self.assertNotIn(secret, output)
+        self.assertIn('5 of 10 files have been removed', output)
+        # Every removed file is logged once, not with every other file
+        self.assertEqual(5, output.count('have been removed since last commit'))
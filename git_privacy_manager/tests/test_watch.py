@@ -0,0 +1,129 @@
+"""
+Test continuous encryption of working directory.
+"""
+from git_privacy_manager import GPM, watch
+from git_privacy_manager.utils.walk import walk
+from git_privacy_manager.utils.inotify import Inotify
+from pathlib import Path
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+
+def _inotify_available():
+    try:
+        Inotify().close()
+    except OSError:
+        return False
+    return True
+
+
+class TestWatch(unittest.TestCase):
+    poll = False
+
+    def setUp(self):
+        self.working_directory = Path(tempfile.mkdtemp())
+        (self.working_directory / 'a').write_text('a')
+        self.gpm = GPM(self.working_directory, '123', kdf_iterations=1000)
+        self.batches = []
+        self.encrypted = threading.Event()
+        encrypt = self.gpm.encrypt
+
+        def recorded(paths=None):
+            encrypt(paths)
+            self.batches.append(paths)
+            self.encrypted.set()
+        self.gpm.encrypt = recorded
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=watch.watch, args=(self.gpm,), kwargs={
+            'debounce': 0.2, 'poll': self.poll, 'stop': self.stop, 'poll_interval': 0.1})
+        self.thread.start()
+        self._wait()
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+
+    def _wait(self):
+        self.assertTrue(self.encrypted.wait(10))
+        self.encrypted.clear()
+
+    def test_batch(self):
+        self.assertEqual([None], self.batches)
+        self.assertIn('a', self.gpm._metadata)
+        (self.working_directory / 'b').write_text('b')
+        (self.working_directory / 'd').mkdir()
+        (self.working_directory / 'd' / 'c').write_text('c')
+        (self.working_directory / 'a').unlink()
+        self._wait()
+        self.assertEqual({'b', str(Path('d', 'c'))}, set(self.gpm._metadata))
+        # Changes are encrypted together and only touched paths are walked
+        self.assertEqual(2, len(self.batches))
+        self.assertNotIn('.', self.batches[1])
+
+    def test_manifest_written_once_per_batch(self):
+        with patch.object(GPM, '_write_json_blob', autospec=True,
+                          side_effect=GPM._write_json_blob) as write:
+            for name in ('x', 'y', 'z'):
+                (self.working_directory / name).write_text(name)
+            self._wait()
+        # A shard and the root index
+        self.assertLessEqual(write.call_count, 2)
+
+
+@unittest.skipUnless(_inotify_available(), 'inotify is not available')
+class TestInotifyWatch(TestWatch):
+    def test_new_directory_watched(self):
+        (self.working_directory / 'd').mkdir()
+        self._wait()
+        (self.working_directory / 'd' / 'e').write_text('e')
+        self._wait()
+        self.assertIn(str(Path('d', 'e')), self.gpm._metadata)
+
+
+class TestPollingWatch(TestWatch):
+    poll = True
+
+
+del TestWatch
+
+
+class TestNormalize(unittest.TestCase):
+    def test_ignore_file(self):
+        self.assertEqual({'a', 'b'}, watch._normalize({'a', str(Path('b', '.gpmignore'))}))
+        self.assertIsNone(watch._normalize({'a', '.gpmignore'}))
+        self.assertIsNone(watch._merge({'a'}, None))
+
+
+class TestEncrypt(unittest.TestCase):
+    def test_file_deleted_mid_batch(self):
+        working_directory = Path(tempfile.mkdtemp())
+        for name in ('a', 'b'):
+            (working_directory / name).write_text(name)
+        gpm = GPM(working_directory, '123', kdf_iterations=1000)
+
+        def deleting(*args, **kwargs):
+            # "b" is listed but gone when it is stat'ed
+            for path, st in walk(*args, **kwargs):
+                (working_directory / 'b').unlink()
+                yield path, st
+        with patch('git_privacy_manager.gpm.walk', side_effect=deleting), self.assertLogs(level='ERROR'):
+            # The batch is kept to be retried
+            self.assertEqual({'a', 'b'}, watch._encrypt(gpm, {'a', 'b'}))
+        self.assertEqual(set(), watch._encrypt(gpm, {'a', 'b'}))
+        self.assertEqual({'a'}, set(gpm._metadata))
+
+
+class TestInotifyUnavailable(unittest.TestCase):
+    def test_no_libc(self):
+        # Windows has no C library to find, so watch falls back to polling
+        with patch('ctypes.util.find_library', return_value=None), \
+                patch('ctypes.CDLL', side_effect=TypeError('expected str')):
+            with self.assertRaises(OSError):
+                Inotify()
+
+
+if __name__ == '__main__':
+    unittest.main()
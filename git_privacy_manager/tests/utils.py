@@ -25,6 +25,11 @@ def files_in_directory(path: Path):
     return len([f for f in all_files if f.is_file()])
 
 
+def blobs_in_directory(path: Path):
+    # Blobs of files without encrypted manifest
+    return len([f for f in path.glob('*.gpg') if not f.name.startswith('meta.')])
+
+
 def get_all_files(path: Path) -> List[Path]:
     all_files = path.rglob('*')
     return [f for f in all_files if f.is_file() and path == f.parent]
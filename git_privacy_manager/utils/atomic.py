@@ -0,0 +1,74 @@
+"""
+Crash-safe writes.
+
+A file is written into a temporary file next to it, synced to disk and
+renamed over the old one. So an interrupted write leaves either the old
+file or the new one, never a truncated mix of both. Temporary files have
+the *.tmp* suffix, so leftovers of a crash are easy to find.
+"""
+
+from contextlib import contextmanager
+import os
+from pathlib import Path
+from typing import IO, Any, Iterator
+from uuid import uuid4
+
+SUFFIX = '.tmp'
+
+
+def temporary_path(path: Path) -> Path:
+    """
+    Get a unique temporary path next to a file
+    """
+    return path.with_name(f'{path.name}.{uuid4().hex}{SUFFIX}')
+
+
+@contextmanager
+def atomic_write(path: Path, mode: str = 'wb') -> Iterator[Any]:
+    """
+    Write a file atomically
+
+    The file is replaced only if the block exits without an exception.
+    The directory is not synced, see :func:`sync_directory`.
+
+    Parameters
+    ----------
+    path : Path
+        File to write.
+    mode : str
+        Mode to open the temporary file with, *wb* or *w*.
+    """
+    temporary = temporary_path(path)
+    try:
+        with open(temporary, mode) as f:
+            yield f
+            sync(f)
+        os.replace(temporary, path)
+    except BaseException:
+        if temporary.exists():
+            temporary.unlink()
+        raise
+
+
+def sync(f: IO[Any]):
+    """
+    Flush an open file to disk
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def sync_directory(path: Path):
+    """
+    Flush renames and removals of files in a directory to disk
+
+    It is a no-op where directories could not be opened, e.g. on Windows.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:  # pragma: no cover
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
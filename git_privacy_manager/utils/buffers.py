@@ -0,0 +1,131 @@
+"""
+Reading of files in large reusable blocks.
+
+Hashing and encryption are done by C code, so the per-block Python
+overhead dominates with small blocks. Files are read with ``readinto``
+into a single preallocated buffer and handed over as memoryview slices,
+so no bytes object is allocated per block.
+"""
+
+from contextlib import nullcontext
+import io
+import mmap
+import os
+import threading
+from typing import Any, BinaryIO, Iterable, Iterator, Optional, Union
+from pathlib import Path
+
+BUFFER_SIZE = 1024 * 1024
+
+# Windows has no positional reads
+_PREAD = hasattr(os, 'pread')
+
+# Block of data which is not copied into bytes
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def read_blocks(f: BinaryIO, buffer_size: int = BUFFER_SIZE) -> Iterator[memoryview]:
+    """
+    Read a file in blocks
+
+    Parameters
+    ----------
+    f : file
+        File opened in binary mode.
+    buffer_size : int
+        Size of a block. The buffer is not larger than a regular file,
+        so small files do not pay for allocation of a large one.
+
+    Returns
+    -------
+    iterator
+        Views of the same buffer. A view is valid only until the next
+        block is read, so it must be consumed or copied right away.
+    """
+    buffer = bytearray(fit(f, buffer_size))
+    with memoryview(buffer) as view:
+        while True:
+            size = f.readinto(view)  # type: ignore
+            if not size:
+                return
+            yield view[:size]
+
+
+def read_at(f: BinaryIO, size: int, offset: int, lock: Optional[threading.Lock] = None) -> bytes:
+    """
+    Read a range of a file
+
+    Ranges are read with ``os.pread`` if there is one, so several threads
+    read the same file at once. Otherwise the file is seeked and read.
+
+    Parameters
+    ----------
+    f : file
+        File opened in binary mode.
+    size : int
+        Number of bytes to read. Fewer are read at the end of file.
+    offset : int
+        Offset of the range.
+    lock : Lock
+        Lock held while the file is seeked and read. It must be shared by
+        all threads which read the file.
+    """
+    if _PREAD:
+        return os.pread(f.fileno(), size, offset)
+    with lock or nullcontext():
+        f.seek(offset)
+        return f.read(size)
+
+
+def fit(f: BinaryIO, buffer_size: int) -> int:
+    """
+    Get size of buffer to read the rest of a file by
+
+    Returns
+    -------
+    int
+        Buffer size or size of the rest of a regular file plus a byte
+        to see the end of it, whichever is less.
+    """
+    try:
+        rest = os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, io.UnsupportedOperation):
+        return buffer_size
+    return max(min(buffer_size, rest + 1), 1)
+
+
+def hash_file(file: Path, hashes: Iterable[Any], buffer_size: int = BUFFER_SIZE,
+              use_mmap: bool = False):
+    """
+    Update hashes with content of a file
+
+    Parameters
+    ----------
+    file : Path
+        Path to file.
+    hashes : iterable
+        hashlib hash objects.
+    buffer_size : int
+        Size of a block.
+    use_mmap : bool
+        Map the file into memory instead of reading it. The blocks are
+        hashed right from the page cache without copying.
+    """
+    hashes = list(hashes)
+    with open(file, 'rb') as f:
+        if use_mmap:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file can not be mapped
+                return
+            with mapped, memoryview(mapped) as view:
+                for offset in range(0, len(view), buffer_size):
+                    block = view[offset:offset + buffer_size]
+                    for h in hashes:
+                        h.update(block)
+                    block.release()
+            return
+        for block in read_blocks(f, buffer_size):
+            for h in hashes:
+                h.update(block)
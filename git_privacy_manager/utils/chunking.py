@@ -0,0 +1,164 @@
+"""
+Content-defined chunking.
+
+Chunk boundaries are chosen like in FastCDC ([1]_): a gear rolling hash
+over the last 32 bytes, normalized chunking and minimal/maximal chunk
+sizes. Boundaries depend only on the nearby content thus an edit changes
+only the chunks around it.
+
+The gear hash here uses XOR instead of addition. So every bit of the hash
+is a XOR of gear table bits and the hash at all positions of a block is
+computed with a few dozen big integer operations instead of a Python loop
+per byte.
+
+References
+----------
+
+.. [1] Wen Xia et al. FastCDC: a Fast and Efficient Content-Defined
+   Chunking Approach for Data Deduplication. USENIX ATC 2016.
+"""
+
+from functools import lru_cache
+import hashlib
+from typing import BinaryIO, Iterator, List, Tuple
+
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+
+# Bits of the rolling hash. Bit k depends on the last k + 1 bytes.
+_HASH_BITS = 32
+_WINDOW = _HASH_BITS
+
+
+def _gear() -> List[int]:
+    # Fixed pseudo-random table, so chunk boundaries are the same everywhere
+    return [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+            for i in range(256)]
+
+
+# Byte q of gear values. Bit j of the table is bit 8 * q + j of the gear.
+_GEAR_BYTES = [bytes((g >> (8 * q)) & 0xFF for g in _gear())
+               for q in range(_HASH_BITS // 8)]
+
+
+@lru_cache(maxsize=8)
+def _lanes(byte: int, size: int) -> int:
+    return int.from_bytes(bytes([byte]) * size, 'big')
+
+
+def boundaries(data: bytes, strict_bits: int, loose_bits: int) -> Tuple[bytes, bytes]:
+    """
+    Find positions where the top bits of the rolling hash are zero
+
+    The hash is ``h = (h << 1) ^ gear[byte]`` starting from zero.
+
+    Data is handled as a big integer with a byte per position. Byte q of
+    the hash at every position is computed at once: bit j of the hash
+    gets bit j - i of gear from i positions back. This diagonal sum is
+    done in three doubling steps. Then bit 7 of the byte is carried to
+    the next byte of the hash.
+
+    Parameters
+    ----------
+    data : bytes
+        Data to scan. At most 24 top bits are supported.
+    strict_bits : int
+        Number of top bits which must be zero for strict positions.
+    loose_bits : int
+        Number of top bits which must be zero for loose positions.
+
+    Returns
+    -------
+    tuple
+        Strict and loose maps. The map has zero byte at every position
+        with matching hash.
+    """
+    size = len(data)
+    hash_bytes = []
+    carry = 0
+    for table in _GEAR_BYTES:
+        x = int.from_bytes(data.translate(table), 'big') ^ carry
+        x ^= (x >> 7) & _lanes(0xFE, size)
+        x ^= (x >> 14) & _lanes(0xFC, size)
+        x ^= (x >> 28) & _lanes(0xF0, size)
+        hash_bytes.append(x)
+        # Bit 7 at previous position feeds bit 0 of the next hash byte
+        carry = (x & _lanes(0x80, size)) >> 15
+
+    def zeros(bits: int) -> bytes:
+        top = _HASH_BITS - bits
+        mask = 0
+        for q, x in enumerate(hash_bytes):
+            low = max(top - 8 * q, 0)
+            if low == 0:
+                mask |= x
+            elif low < 8:
+                mask |= x & _lanes((0xFF << low) & 0xFF, size)
+        return mask.to_bytes(size, 'big')
+
+    return zeros(strict_bits), zeros(loose_bits)
+
+
+def chunks(stream: BinaryIO, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE,
+           max_size: int = MAX_SIZE) -> Iterator[bytes]:
+    """
+    Split a stream into content-defined chunks
+
+    At most two maximal chunks are kept in memory.
+
+    Parameters
+    ----------
+    stream : file
+        A binary stream.
+    min_size : int
+        No chunk is smaller except the last one.
+    avg_size : int
+        Desired size of chunks. Must be a power of two.
+    max_size : int
+        No chunk is larger.
+
+    Returns
+    -------
+    iterator
+        Chunks of data.
+    """
+    # Normalized chunking: harder to cut before average size, easier after
+    bits = avg_size.bit_length() - 1
+    strict_bits, loose_bits = bits + 1, bits - 1
+
+    buffer = bytearray()
+    strict = bytearray()  # Boundary maps of the buffer
+    loose = bytearray()
+    history = b''  # Last bytes before the end of the buffer
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = stream.read(max_size)
+            if not data:
+                eof = True
+                break
+            # Prepend history to know the hash of the first bytes of data
+            s, l = boundaries(history + data, strict_bits, loose_bits)
+            strict += s[len(history):]
+            loose += l[len(history):]
+            history = (history + data)[-(_WINDOW - 1):]
+            buffer += data
+        if not buffer:
+            # Masks are as large as data, do not keep them
+            _lanes.cache_clear()
+            return
+
+        size = min(len(buffer), max_size)
+        normal = min(avg_size, size)
+        # Cut after the first matching position
+        if size <= min_size:
+            cut = size
+        else:
+            cut = strict.find(0, min_size, normal) + 1 or \
+                loose.find(0, normal, size) + 1 or size
+        chunk = bytes(buffer[:cut])
+        del buffer[:cut]
+        del strict[:cut]
+        del loose[:cut]
+        yield chunk
@@ -0,0 +1,109 @@
+"""
+Compression of data before encryption.
+
+Encrypted data does not compress, so it is compressed before. Data which
+does not shrink, like media or archives, is stored as is. That is decided
+by compressing a sample from the beginning of the data.
+
+The *zlib* algorithm is always available. The *zstd* one needs the
+optional *zstandard* package.
+"""
+
+from typing import Any, Iterable, Iterator, Optional
+import zlib
+
+from .buffers import Buffer
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+ALGORITHMS = ('zlib', 'zstd')
+DEFAULT_LEVELS = {'zlib': 6, 'zstd': 3}
+SAMPLE_SIZE = 64 * 1024
+# Sample must shrink at least to this ratio to compress data
+MIN_RATIO = 0.9
+
+
+def check(algorithm: str):
+    """
+    Check that an algorithm could be used
+
+    Raises
+    ------
+    RuntimeError
+        If algorithm is unknown or its package is not installed.
+    """
+    if algorithm not in ALGORITHMS:
+        raise RuntimeError(f'Unknown compression algorithm "{algorithm}"')
+    if algorithm == 'zstd' and zstandard is None:
+        raise RuntimeError('The "zstandard" package is required for zstd compression: '
+                           'install the "zstd" extra, e.g. pip install "git_privacy_manager[zstd]"')
+
+
+def worth_compressing(sample: bytes) -> bool:
+    """
+    Check if data shrinks by a sample from its beginning
+
+    A fast zlib level is used whatever the algorithm is.
+    """
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) <= MIN_RATIO * len(sample)
+
+
+def compress(src: Iterable[Buffer], algorithm: str, level: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Compress a stream
+
+    Parameters
+    ----------
+    src : iterable
+        Blocks of data.
+    algorithm : str
+        One of *zlib* or *zstd*.
+    level : int
+        Compression level. Default depends on algorithm.
+
+    Returns
+    -------
+    iterator
+        Blocks of compressed data.
+    """
+    check(algorithm)
+    if level is None:
+        level = DEFAULT_LEVELS[algorithm]
+    compressor: Any
+    if algorithm == 'zlib':
+        compressor = zlib.compressobj(level)
+    else:
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    for data in src:
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def decompress(src: Iterable[Buffer], algorithm: str) -> Iterator[bytes]:
+    """
+    Decompress a stream
+
+    Raises
+    ------
+    RuntimeError
+        If algorithm is unknown or its package is not installed.
+    """
+    check(algorithm)
+    decompressor: Any
+    if algorithm == 'zlib':
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for data in src:
+        decompressed = decompressor.decompress(data)
+        if decompressed:
+            yield decompressed
+    if algorithm == 'zlib':
+        yield decompressor.flush()
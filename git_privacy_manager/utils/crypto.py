@@ -6,11 +6,19 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.hmac import HMAC
+import itertools
 import os
 from pathlib import Path
 import struct
+import threading
 import time
-from typing import Iterator
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Tuple
+
+from . import compression as _compression
+from .atomic import atomic_write
+from .buffers import BUFFER_SIZE, Buffer, read_at, read_blocks
+from .parallel import imap
+from .stats import Stats
 
 
 class InvalidToken(Exception):
@@ -18,19 +26,62 @@ class InvalidToken(Exception):
 
 
 _MAX_CLOCK_SKEW = 60
+# Magic + timestamp + nonce
+_LEGACY_HEADER_SIZE = 25
+# Magic + timestamp + nonce + segment size
+_HEADER_SIZE = 29
+_HMAC_SIZE = 32
+# Amount of ciphertext of legacy stream decrypted at once
+_CHUNK_SIZE = 64 * 1024
+# Cipher output may be up to a block longer than input
+_BLOCK_SIZE = 16
+SEGMENT_SIZE = 64 * 1024
+# Segment size comes from a header which is not authenticated before it is
+# used, so larger sizes are rejected before anything is allocated by them
+MAX_SEGMENT_SIZE = 1024 * 1024
 
 
 class Crypto(object):
     """
     Stream version of Fernet.
 
-    The enrypted stream looks like:
-      magic + timestamp + nonce + ciphertext + HMAC signature
+    The encrypted stream is split into segments which are authenticated
+    separately, like the STREAM construction. It looks like:
+      magic + timestamp + nonce + segment size + segments
+    and each segment looks like:
+      ciphertext + HMAC signature
+    The signature covers the header, index of the segment, a flag of the
+    last segment and the ciphertext, so segments could not be reordered,
+    dropped or moved to another stream. All segments but the last have
+    *segment size* bytes of ciphertext. The AES-CTR counter runs through
+    all segments, so any of them is decrypted alone: in parallel, out of
+    order or to read a range of a stream. Corruption is detected by the
+    segment it is in, before its plaintext is released.
+
+    Streams of older versions are still decrypted. They look like:
+      legacy magic + timestamp + nonce + ciphertext + HMAC signature
     """
 
-    magic = b'\x8a'
+    magic = b'\x8b'
+    legacy_magic = b'\x8a'
 
-    def __init__(self, key: bytes):
+    def __init__(self, key: bytes, buffer_size: int = BUFFER_SIZE, workers: int = 1,
+                 segment_size: int = SEGMENT_SIZE, stats: Optional[Stats] = None):
+        """
+        Parameters
+        ----------
+        key : bytes
+            Url-safe base64-encoded 32 bytes key.
+        buffer_size : int
+            Size of blocks files are read and written by.
+        workers : int
+            Number of threads to encrypt and decrypt segments of a file.
+        segment_size : int
+            Size of segments of new streams. Must be a multiple of 16 and
+            not larger than :data:`MAX_SEGMENT_SIZE`.
+        stats : Stats
+            Stats to count time of ciphering segments into, as *cipher*.
+        """
         backend = default_backend()
 
         key = base64.urlsafe_b64decode(key)
@@ -38,92 +89,293 @@ class Crypto(object):
             raise ValueError(
                 'Key must be 32 url-safe base64-encoded bytes.'
             )
+        if not _valid_segment_size(segment_size):
+            raise ValueError(f'Segment size must be a positive multiple of 16 up to {MAX_SEGMENT_SIZE}.')
 
         self._signing_key = key[:16]
         self._encryption_key = key[16:]
         self._backend = backend
+        self._buffer_size = buffer_size
+        self._workers = workers
+        self._segment_size = segment_size
+        self.stats = stats
 
     @classmethod
     def generate_key(cls) -> bytes:
         return base64.urlsafe_b64encode(os.urandom(32))
 
-    def encrypt_file(self, src: Path, dst: Path):
+    def encrypt_file(self, src: Path, dst: Path, compression: Optional[str] = None,
+                     level: Optional[int] = None):
+        """
+        Encrypt a file
+
+        Uncompressed file of a few buffers is encrypted by several
+        workers, if any. The destination is replaced atomically once the
+        blob is synced to disk.
+
+        Parameters
+        ----------
+        compression : str
+            Algorithm to compress data before encryption, if any.
+        level : int
+            Compression level.
+        """
+        with open(src, 'rb') as s, atomic_write(dst) as d:
+            if compression or self._workers < 2 or os.fstat(s.fileno()).st_size <= self._batch_size():
+                self.encrypt_blocks(read_blocks(s, self._buffer_size), d, compression, level)
+            else:
+                self._encrypt_file_parallel(s, d)
+
+    def encrypt_blocks(self, src: Iterable[Buffer], dst: BinaryIO, compression: Optional[str] = None,
+                       level: Optional[int] = None):
+        """
+        Encrypt blocks of data into a file
+
+        Unlike :meth:`encrypt_stream` the blocks of plaintext could be
+        views of a reused buffer.
+
+        Parameters
+        ----------
+        src : iterable
+            Blocks of plaintext.
+        dst : file
+            File opened for writing in binary mode.
+        compression : str
+            Algorithm to compress data before encryption, if any.
+        level : int
+            Compression level.
+        """
+        if compression:
+            src = _compression.compress(src, compression, level)
+        for data in self.encrypt_stream(src):
+            dst.write(data)
+
+    def encrypt_stream(self, src: Iterable[Buffer]) -> Iterator[Buffer]:
+        segments = _Segments(self, self._new_header())
+        yield segments.header
+        yield from _stream(src, self._segment_size, segments.seal)
+
+    def _encrypt_file_parallel(self, src: BinaryIO, dst: BinaryIO):
+        size = os.fstat(src.fileno()).st_size
+        batch_size = self._batch_size()
+        batches = -(-size // batch_size)
+        segments = _Segments(self, self._new_header())
+        lock = threading.Lock()
+
+        def seal(batch: int) -> bytearray:
+            data = read_at(src, batch_size, batch * batch_size, lock)
+            last = batch == batches - 1
+            if len(data) != (size - batch * batch_size if last else batch_size):
+                raise RuntimeError('File has changed while being encrypted')
+            return segments.seal(batch * batch_size // self._segment_size, data, last)
+
+        dst.write(segments.header)
+        for sealed in imap(seal, ((batch,) for batch in range(batches)), self._workers):
+            dst.write(sealed)
+
+    def decrypt_file(self, src: Path, dst: Path, ttl: Optional[int] = None,
+                     compression: Optional[str] = None):
+        """
+        Decrypt a file
+
+        Segments are decrypted by several workers, if any.
+
+        Parameters
+        ----------
+        compression : str
+            Algorithm the data was compressed with before encryption, if any.
+        """
         with open(src, 'rb') as s, open(dst, 'wb') as d:
-            ciphertext = self.encrypt_stream(iter(lambda: s.read(4096), b''))
-            for data in ciphertext:
+            plaintext: Iterable[Buffer] = self._decrypt_file(s, ttl)
+            if compression:
+                plaintext = _compression.decompress(plaintext, compression)
+            for data in plaintext:
                 if data:
                     d.write(data)
 
-    def encrypt_stream(self, src: Iterator[bytes]) -> Iterator[bytes]:
-        nonce = os.urandom(16)
-        encryptor = Cipher(
-            algorithms.AES(self._encryption_key), modes.CTR(
-                nonce), self._backend
-        ).encryptor()
+    def decrypt_range(self, src: Path, offset: int, length: int, ttl: Optional[int] = None) -> bytes:
+        """
+        Decrypt a range of a file
+
+        Only the segments with the range are read. Streams of older
+        versions are read as a whole.
+
+        Parameters
+        ----------
+        offset : int
+            Offset of the range in plaintext.
+        length : int
+            Length of the range. It is shorter if the plaintext ends before.
+
+        Returns
+        -------
+        bytes
+            Plaintext of the range.
+        """
+        with open(src, 'rb') as s:
+            if s.read(1) == self.legacy_magic:
+                s.seek(0)
+                plaintext = b''.join(bytes(block) for block in self._decrypt_legacy_file(s, ttl))
+                return plaintext[offset:offset + length]
+            s.seek(0)
+            segments, count, size = self._open_file(s, ttl)
+            end = min(offset + length, size)
+            if offset >= end:
+                return b''
+            first = offset // segments.size
+            last = (end - 1) // segments.size
+            sealed = segments.size + _HMAC_SIZE
+            data = read_at(s, (last - first + 1) * sealed, _HEADER_SIZE + first * sealed)
+            start = offset - first * segments.size
+            return bytes(segments.open(first, data, last == count - 1)[start:start + end - offset])
+
+    def _decrypt_file(self, src: BinaryIO, ttl: Optional[int] = None) -> Iterator[Buffer]:
+        if src.read(1) == self.legacy_magic:
+            src.seek(0)
+            yield from self._decrypt_legacy_file(src, ttl)
+            return
+        src.seek(0)
+        segments, count, _ = self._open_file(src, ttl)
+        sealed = segments.size + _HMAC_SIZE
+        per_batch = max(self._buffer_size // segments.size, 1)
+        lock = threading.Lock()
+
+        def open_batch(first: int) -> bytearray:
+            data = read_at(src, per_batch * sealed, _HEADER_SIZE + first * sealed, lock)
+            return segments.open(first, data, first + per_batch >= count)
+
+        batches = ((first,) for first in range(0, count, per_batch))
+        # No threads for a single batch
+        workers = self._workers if count > per_batch else 1
+        try:
+            yield from imap(open_batch, batches, workers)
+        except RuntimeError as e:
+            if isinstance(e.__cause__, InvalidToken):
+                raise e.__cause__
+            raise
+
+    def _open_file(self, src: BinaryIO, ttl: Optional[int] = None) -> Tuple['_Segments', int, int]:
+        """
+        Read header of an open file
+
+        Returns
+        -------
+        tuple
+            Segments of the stream, their number and size of plaintext.
+        """
+        header = src.read(_HEADER_SIZE)
+        self._check_header(header, ttl)
+        segments = _Segments(self, header)
+        body = os.fstat(src.fileno()).st_size - _HEADER_SIZE
+        if body < _HMAC_SIZE:
+            raise InvalidToken
+        count = -(-body // (segments.size + _HMAC_SIZE))
+        return segments, count, body - count * _HMAC_SIZE
+
+    def _decrypt_legacy_file(self, src: BinaryIO, ttl: Optional[int] = None) -> Iterator[memoryview]:
+        """
+        Decrypt an open file of older versions
+
+        Unlike a stream, the size of a file is known, so ciphertext is
+        read and decrypted right into reused buffers.
+
+        Returns
+        -------
+        iterator
+            Blocks of plaintext. A block is valid only until the next one
+            is produced.
+        """
+        header = src.read(_LEGACY_HEADER_SIZE)
+        self._check_header(header, ttl, legacy=True)
+        size = os.fstat(src.fileno()).st_size - _LEGACY_HEADER_SIZE - _HMAC_SIZE
+        if size < 0:
+            raise InvalidToken
         hmac = HMAC(self._signing_key, hashes.SHA256(), backend=self._backend)
-        # Format header
-        current_time = int(time.time())
-        basic_parts = (
-            self.magic + struct.pack('>Q', current_time) + nonce
-        )
-        hmac.update(basic_parts) # The header is part of signature
-        yield basic_parts
-        # Encryption phase
+        hmac.update(header)
+        decryptor = Cipher(
+            algorithms.AES(self._encryption_key), modes.CTR(header[9:25]),
+            self._backend).decryptor()
+        buffer_size = max(min(self._buffer_size, size), 1)
+        ciphertext = bytearray(buffer_size)
+        plaintext = bytearray(buffer_size + _BLOCK_SIZE - 1)
+        with memoryview(ciphertext) as src_view, memoryview(plaintext) as dst_view:
+            while size > 0:
+                read = src.readinto(src_view[:min(size, buffer_size)])  # type: ignore
+                if not read:
+                    raise InvalidToken
+                size -= read
+                hmac.update(src_view[:read])
+                decrypted = decryptor.update_into(src_view[:read], plaintext)
+                block = dst_view[:decrypted]
+                yield block
+                block.release()
+        try:
+            decryptor.finalize()
+        except ValueError:
+            raise InvalidToken
+        try:
+            hmac.verify(src.read(_HMAC_SIZE))
+        except InvalidSignature:
+            raise InvalidToken
+
+    def decrypt_stream(self, src: Iterable[Buffer], ttl: Optional[int] = None) -> Iterator[Buffer]:
+        src = iter(src)
+        # Collect enougth bytes for header. The rest of source is not read.
+        buffer = bytearray()
         for data in src:
-            ciphertext = encryptor.update(data)
-            hmac.update(ciphertext)
-            yield ciphertext
-        # Process last bytes if any
-        fin = encryptor.finalize()
-        hmac.update(fin)
-        yield fin
-        # Write HMAC
-        yield hmac.finalize()
-
-    def decrypt_file(self, src: Path, dst: Path, ttl: int = None):
-        with open(src, 'rb') as s, open(dst, 'wb') as d:
-            plaintext = self.decrypt_stream(
-                iter(lambda: s.read(4096), b''), ttl)
-            for data in plaintext:
-                if data:
-                    d.write(data)
+            buffer += data
+            if len(buffer) >= _HEADER_SIZE:
+                break
+        if buffer[:1] == self.legacy_magic:
+            yield from self._decrypt_legacy_stream(itertools.chain([bytes(buffer)], src), ttl)
+            return
+        header = bytes(buffer[:_HEADER_SIZE])
+        self._check_header(header, ttl)
+        segments = _Segments(self, header)
+        del buffer[:_HEADER_SIZE]
+        yield from _stream(itertools.chain([buffer], src), segments.size + _HMAC_SIZE, segments.open)
 
-    def decrypt_stream(self, src: Iterator[bytes], ttl: int = None) -> Iterator[bytes]:
-        # Use internal buffer as cache. This is needed because iterator could
-        # return too small chunks of data.
-        buffer = b''
-        # Collect enougth bytes for header
+    def _decrypt_legacy_stream(self, src: Iterator[Buffer], ttl: Optional[int] = None) -> Iterator[Buffer]:
+        # Collect enougth bytes for header. The rest of source is not read.
+        buffer = bytearray()
         for data in src:
             buffer += data
-            if len(buffer) < 25:
-                yield b''
-        self._check_header(buffer, ttl)
+            if len(buffer) >= _LEGACY_HEADER_SIZE:
+                break
+        self._check_header(bytes(buffer[:_LEGACY_HEADER_SIZE]), ttl, legacy=True)
         # Prepare HMAC checking
         hmac = HMAC(self._signing_key, hashes.SHA256(), backend=self._backend)
         # Prepare decryptor
         decryptor = Cipher(
-            algorithms.AES(self._encryption_key), modes.CTR(buffer[9:25]),
+            algorithms.AES(self._encryption_key), modes.CTR(bytes(buffer[9:25])),
             self._backend).decryptor()
         # Decryption phase
-        hmac.update(buffer[0:25])  # Header is under HMAC too
-        buffer = buffer[25:]      # Drop header. Leave body and HMAC.
-        # In cycle process previous block of data if current is large enougth
-        # to store HMAC. Otherwise append current block of data to buffer and
-        # wait for enother block of ciphertext.
+        hmac.update(bytes(buffer[:_LEGACY_HEADER_SIZE]))  # Header is under HMAC too
+        del buffer[:_LEGACY_HEADER_SIZE]  # Drop header. Leave body and HMAC.
+        # The last 32 bytes of buffer could be the HMAC so always keep them.
+        # Everything before them is ciphertext which is processed as soon as
+        # enough of it is collected. So the buffer never grows above one
+        # chunk plus one block of source.
         for data in src:
-            if len(data) < 32:
-                buffer += data
-                yield b''
-            hmac.update(buffer)
-            yield decryptor.update(buffer)
-            buffer = data
+            buffer += data
+            if len(buffer) < _HMAC_SIZE + _CHUNK_SIZE:
+                continue
+            with memoryview(buffer) as view:
+                ciphertext = view[:-_HMAC_SIZE]
+                hmac.update(ciphertext)
+                plaintext = decryptor.update(ciphertext)
+                ciphertext.release()
+            del buffer[:-_HMAC_SIZE]
+            yield plaintext
         # At this point last 32 bytes should countain HMAC
-        signature = buffer[-32:]
+        if len(buffer) < _HMAC_SIZE:
+            raise InvalidToken
+        signature = bytes(buffer[-_HMAC_SIZE:])
         # And signature is not part of HMAC check
-        buffer = buffer[:-32]
-        hmac.update(buffer)
+        del buffer[-_HMAC_SIZE:]
+        hmac.update(bytes(buffer))
         try:
-            plaintext = decryptor.update(buffer) + decryptor.finalize()
+            plaintext = decryptor.update(bytes(buffer)) + decryptor.finalize()
             yield plaintext
         except ValueError:
             raise InvalidToken
@@ -133,6 +385,14 @@ class Crypto(object):
         except InvalidSignature:
             raise InvalidToken
 
+    def _new_header(self) -> bytes:
+        return (self.magic + struct.pack('>Q', int(time.time())) + os.urandom(16)
+                + struct.pack('>I', self._segment_size))
+
+    def _batch_size(self) -> int:
+        # Whole segments of about buffer size
+        return max(self._buffer_size // self._segment_size, 1) * self._segment_size
+
     @staticmethod
     def _get_timestamp(data: bytes) -> int:
         try:
@@ -142,18 +402,186 @@ class Crypto(object):
         return timestamp
 
     @classmethod
-    def _check_header(cls, buffer: bytes, ttl: int = None):
-        if len(buffer) < 9:
+    def _check_header(cls, buffer: bytes, ttl: Optional[int] = None, legacy: bool = False):
+        if len(buffer) < (_LEGACY_HEADER_SIZE if legacy else _HEADER_SIZE):
             raise InvalidToken
         # Check magic number
-        if buffer[0:1] != cls.magic:
+        if buffer[0:1] != (cls.legacy_magic if legacy else cls.magic):
             raise InvalidToken
         # Check timestamp
         if ttl is not None:
-            timestamp = cls._get_timestamp(buffer[1:9])
+            timestamp = cls._get_timestamp(buffer)
             current_time = int(time.time())
             if timestamp + ttl < current_time:
                 raise InvalidToken
 
             if current_time + _MAX_CLOCK_SKEW < timestamp:
                 raise InvalidToken
+
+
+def _stream(src: Iterable[Buffer], size: int,
+            process: Callable[[int, Buffer, bool], bytearray]) -> Iterator[bytearray]:
+    """
+    Split a stream into segments and process them in batches
+
+    The last segment is kept until the end of stream is seen, so it is
+    processed as the last one. At most one segment of source is buffered.
+
+    Parameters
+    ----------
+    size : int
+        Size of segments. The last one could be shorter.
+    process : callable
+        Gets index of the first segment, whole segments and whether they
+        end the stream.
+    """
+    index = 0
+    pending = bytearray()
+    for data in src:
+        with memoryview(data) as view:
+            if not len(view):
+                continue
+            fill = min(size - len(pending), len(view)) if pending else 0
+            pending += view[:fill]
+            rest = view[fill:]
+            if not len(rest):
+                continue
+            if pending:
+                # More data follows, so pending segment is not the last one
+                yield process(index, pending, False)
+                index += 1
+            count = (len(rest) - 1) // size
+            if count:
+                yield process(index, rest[:count * size], False)
+                index += count
+            pending = bytearray(rest[count * size:])
+            rest.release()
+    yield process(index, pending, True)
+
+
+class _Segments:
+    """
+    Seals and opens segments of a stream.
+    """
+
+    def __init__(self, crypto: Crypto, header: bytes):
+        """
+        Raises
+        ------
+        InvalidToken
+            If segment size in header is invalid.
+        """
+        self.header = header
+        self.size, = struct.unpack('>I', header[25:29])
+        if not _valid_segment_size(self.size):
+            raise InvalidToken
+        self._crypto = crypto
+        self._nonce = int.from_bytes(header[9:25], 'big')
+        # Every signature starts with the header
+        self._hmac = HMAC(crypto._signing_key, hashes.SHA256(), backend=crypto._backend)
+        self._hmac.update(header)
+
+    def seal(self, first: int, plaintext: Buffer, last: bool) -> bytearray:
+        """
+        Encrypt and sign consecutive segments
+
+        Parameters
+        ----------
+        first : int
+            Index of the first segment.
+        plaintext : bytes
+            Plaintext of whole segments, but the last one of stream.
+        last : bool
+            If plaintext ends the stream.
+
+        Returns
+        -------
+        bytes
+            Sealed segments. An empty stream has a single empty segment.
+        """
+        stats = self._crypto.stats
+        if stats is None:
+            return self._seal(first, plaintext, last)
+        with stats.phase('cipher', size=len(plaintext)):
+            return self._seal(first, plaintext, last)
+
+    def _seal(self, first: int, plaintext: Buffer, last: bool) -> bytearray:
+        encryptor = self._cipher(first).encryptor()
+        with memoryview(plaintext) as view:
+            count = max(-(-len(view) // self.size), 1)
+            # Ciphertext is encrypted right into place. A signature follows
+            # it, so there is room for the extra block update_into needs.
+            sealed = bytearray(len(view) + count * _HMAC_SIZE)
+            with memoryview(sealed) as dst:
+                offset = 0
+                for i in range(count):
+                    size = encryptor.update_into(view[i * self.size:(i + 1) * self.size], dst[offset:])
+                    ciphertext = dst[offset:offset + size]
+                    offset += size
+                    dst[offset:offset + _HMAC_SIZE] = self._sign(first + i, last and i == count - 1, ciphertext)
+                    offset += _HMAC_SIZE
+        return sealed
+
+    def open(self, first: int, sealed: Buffer, last: bool) -> bytearray:
+        """
+        Verify and decrypt consecutive segments
+
+        Parameters
+        ----------
+        first : int
+            Index of the first segment.
+        sealed : bytes
+            Whole sealed segments.
+        last : bool
+            If the segments end the stream.
+
+        Raises
+        ------
+        InvalidToken
+            If any segment is corrupted, truncated or out of place.
+        """
+        stats = self._crypto.stats
+        if stats is None:
+            return self._open(first, sealed, last)
+        with stats.phase('cipher', size=len(sealed)):
+            return self._open(first, sealed, last)
+
+    def _open(self, first: int, sealed: Buffer, last: bool) -> bytearray:
+        decryptor = self._cipher(first).decryptor()
+        with memoryview(sealed) as view:
+            plaintext = bytearray(len(view) + _BLOCK_SIZE - 1)
+            index, offset, size = first, 0, 0
+            while True:
+                segment = view[offset:offset + self.size + _HMAC_SIZE]
+                if len(segment) < _HMAC_SIZE:
+                    raise InvalidToken
+                offset += len(segment)
+                ciphertext = segment[:-_HMAC_SIZE]
+                end = offset >= len(view)
+                hmac = self._sign(index, last and end, ciphertext, finalize=False)
+                try:
+                    hmac.verify(bytes(segment[-_HMAC_SIZE:]))
+                except InvalidSignature:
+                    raise InvalidToken
+                with memoryview(plaintext) as dst:
+                    size += decryptor.update_into(ciphertext, dst[size:])
+                index += 1
+                if end:
+                    del plaintext[size:]
+                    return plaintext
+
+    def _cipher(self, index: int) -> Cipher:
+        # The counter continues from the end of the previous segment
+        counter = (self._nonce + index * self.size // _BLOCK_SIZE) % 2**128
+        return Cipher(algorithms.AES(self._crypto._encryption_key),
+                      modes.CTR(counter.to_bytes(16, 'big')), self._crypto._backend)
+
+    def _sign(self, index: int, last: bool, ciphertext: Buffer, finalize: bool = True):
+        hmac = self._hmac.copy()
+        hmac.update(struct.pack('>Q?', index, last))
+        hmac.update(ciphertext)
+        return hmac.finalize() if finalize else hmac
+
+
+def _valid_segment_size(size: int) -> bool:
+    return 0 < size <= MAX_SEGMENT_SIZE and not size % _BLOCK_SIZE
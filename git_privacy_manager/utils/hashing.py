@@ -0,0 +1,67 @@
+"""
+Hashes which detect changes of files.
+
+The algorithm is recorded in metadata entry of each file, so it could be
+changed at any time. Entries of older versions have no algorithm. Their
+checksums are MD5.
+
+The *blake3* algorithm needs the optional *blake3* package.
+"""
+
+import hashlib
+from typing import Any
+
+try:
+    import blake3
+except ImportError:  # pragma: no cover
+    blake3 = None  # type: ignore
+
+ALGORITHMS = ('sha256', 'blake2b', 'blake3', 'md5')
+# Hardware-accelerated by SHA extensions of modern CPUs
+DEFAULT = 'sha256'
+# Algorithm of entries without one
+LEGACY = 'md5'
+
+
+def check(algorithm: str):
+    """
+    Check that an algorithm could be used
+
+    Raises
+    ------
+    RuntimeError
+        If algorithm is unknown or its package is not installed.
+    """
+    if algorithm not in ALGORITHMS:
+        raise RuntimeError(f'Unknown hash algorithm "{algorithm}"')
+    if algorithm == 'blake3' and blake3 is None:
+        raise RuntimeError('The "blake3" package is required for blake3 hash: '
+                           'install the "blake3" extra, e.g. pip install "git_privacy_manager[blake3]"')
+
+
+def new(algorithm: str) -> Any:
+    """
+    Create a hash object
+
+    Parameters
+    ----------
+    algorithm : str
+        One of :data:`ALGORITHMS`.
+
+    Returns
+    -------
+    hash object
+        Object with ``update`` and ``hexdigest`` methods.
+
+    Raises
+    ------
+    RuntimeError
+        If algorithm is unknown or its package is not installed.
+    """
+    check(algorithm)
+    if algorithm == 'blake2b':
+        # 256 bits are enough and keep metadata short
+        return hashlib.blake2b(digest_size=32)
+    if algorithm == 'blake3':
+        return blake3.blake3()
+    return hashlib.new(algorithm)
@@ -0,0 +1,144 @@
+"""
+Minimal binding of Linux inotify ([1]_) by ctypes.
+
+Only what a recursive watch of a directory tree needs is bound. Every
+directory of the tree has a watch of its own, since inotify does not
+watch subdirectories.
+
+References
+----------
+
+.. [1] https://man7.org/linux/man-pages/man7/inotify.7.html
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from typing import Any, Iterator, List, NamedTuple, Optional
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# Events which change content, stats or set of files
+CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+           IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+class Event(NamedTuple):
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify:
+    """
+    Inotify instance.
+    """
+
+    def __init__(self):
+        """
+        Raises
+        ------
+        OSError
+            If inotify is not available, e.g. on other systems than Linux.
+        """
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            _raise()
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def add_watch(self, path: str, mask: int = CHANGES) -> int:
+        """
+        Watch a directory
+
+        Returns
+        -------
+        int
+            Watch descriptor. A directory watched again keeps its
+            descriptor.
+
+        Raises
+        ------
+        OSError
+            If the directory is gone or the limit of watches is reached.
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if wd < 0:
+            _raise()
+        return wd
+
+    def read(self, timeout: Optional[float] = None) -> List[Event]:
+        """
+        Read events
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait for events. Waits forever if None.
+
+        Returns
+        -------
+        list
+            Events or nothing if none came in time.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+        return list(_parse(data))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _parse(data: bytes) -> Iterator[Event]:
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        yield Event(wd, mask, cookie, os.fsdecode(name))
+
+
+def _libc() -> Any:
+    name = ctypes.util.find_library('c')
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+    except (TypeError, AttributeError) as e:
+        # No C library to load by name, as on Windows
+        raise OSError(f'inotify is not available: {e}') from e
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError('inotify is not available')
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def _raise():
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
@@ -0,0 +1,91 @@
+"""
+Journal of files committed by encrypt.
+
+Encrypt writes new blobs under temporary names and records each encrypted
+file here: its new metadata entry and the temporary blob. Records are
+synced to disk after the blobs and packs they refer to, and only then the
+temporary blobs are renamed. Once the entries are committed to local
+metadata, the journal is cleared. Metadata stores which are rewritten as
+a whole are committed only at the end of encrypt, so until then the
+journal keeps every file encrypted by the run.
+
+If encrypt is interrupted, the next run replays the synced records, so
+the files encrypted before the crash are not encrypted again. A record
+which was not synced is lost together with its file, which is simply
+encrypted again.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from . import atomic
+
+Record = Dict[str, Any]
+
+
+class Journal:
+    """
+    Append-only log of JSON records, one per line.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._records: List[str] = []
+
+    def record(self, key: str, entry: Dict[str, Any], blob: Optional[str] = None):
+        """
+        Record an encrypted file
+
+        The record is kept in memory until :meth:`flush`.
+
+        Parameters
+        ----------
+        key : str
+            Key of metadata entry.
+        entry : dict
+            The new entry. It is serialized right away, so it could be
+            changed later.
+        blob : str
+            Name of temporary blob in output directory, if any.
+        """
+        self._records.append(json.dumps({'key': key, 'entry': entry, 'blob': blob}))
+
+    def flush(self):
+        """
+        Append recorded files to the journal and sync it to disk
+        """
+        if not self._records:
+            return
+        new = not self.path.exists()
+        with open(self.path, 'a') as f:
+            f.write(''.join(f'{record}\n' for record in self._records))
+            atomic.sync(f)
+        if new:
+            atomic.sync_directory(self.path.parent)
+        self._records = []
+
+    def replay(self) -> List[Record]:
+        """
+        Read the records synced to disk
+
+        A record cut by a crash is skipped.
+        """
+        if not self.path.is_file():
+            return []
+        records = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                records.append(json.loads(line))
+        return records
+
+    def clear(self):
+        """
+        Forget all records once their entries are committed
+        """
+        self._records = []
+        if self.path.exists():
+            os.remove(self.path)
@@ -0,0 +1,88 @@
+"""
+Derivation of master key from passphrase.
+
+Parameters of derivation are stored in plain text next to the encrypted
+blobs, so every clone derives the same key. Older stores have no
+parameters. Their key is derived with the passphrase as salt.
+"""
+
+import base64
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict
+
+from .atomic import atomic_write
+
+ALGORITHM = 'pbkdf2-sha256'
+ITERATIONS = 100000
+SALT_SIZE = 16
+
+Params = Dict[str, Any]
+
+# Parameters of stores created by older versions
+LEGACY: Params = {'algorithm': ALGORITHM, 'salt': None, 'iterations': 100000}
+
+
+def new_params(iterations: int = ITERATIONS) -> Params:
+    """
+    Generate parameters with random salt
+
+    Parameters
+    ----------
+    iterations : int
+        Cost of derivation.
+
+    Returns
+    -------
+    dict
+        Algorithm, url-safe base64-encoded salt and number of iterations.
+    """
+    return {
+        'algorithm': ALGORITHM,
+        'salt': base64.urlsafe_b64encode(os.urandom(SALT_SIZE)).decode(),
+        'iterations': iterations,
+    }
+
+
+def derive(passphrase: str, params: Params) -> bytes:
+    """
+    Derive master key from passphrase
+
+    Returns
+    -------
+    bytes
+        Url-safe base64-encoded 32 bytes key.
+
+    Raises
+    ------
+    RuntimeError
+        If algorithm is unknown.
+    """
+    if params.get('algorithm') != ALGORITHM:
+        raise RuntimeError(f'Unknown key derivation algorithm "{params.get("algorithm")}"')
+    if params['salt'] is None:
+        salt = passphrase.encode()
+    else:
+        salt = base64.urlsafe_b64decode(params['salt'])
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=params['iterations'],
+        backend=default_backend()
+    )
+    return base64.urlsafe_b64encode(kdf.derive(passphrase.encode()))
+
+
+def read_params(path: Path) -> Params:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_params(path: Path, params: Params):
+    with atomic_write(path, 'w') as f:
+        json.dump(params, f)
@@ -0,0 +1,45 @@
+"""
+Exclusive locks of output directories.
+
+Encrypt, repack and gc of the same output directory by several processes,
+e.g. by ``gpm watch`` and ``gpm encrypt``, would remove temporary blobs
+of each other. So each of them holds an exclusive lock on the directory.
+
+The lock is taken on the directory itself, so no lock file is left among
+the blobs. It is advisory and released when its holder exits, even by a
+crash. Without ``flock``, as on Windows, nothing is locked.
+"""
+
+from contextlib import contextmanager
+import logging
+import os
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+
+@contextmanager
+def locked(directory: Path) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a directory
+
+    If another process holds it, wait until it is released.
+    """
+    if fcntl is None:  # pragma: no cover
+        yield
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info('Wait for another process to release "%s"', directory)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the last descriptor releases the lock
+        os.close(fd)
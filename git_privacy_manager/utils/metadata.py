@@ -0,0 +1,300 @@
+"""
+Local storage of metadata.
+
+A store keeps entries of files by relative path. Besides entries it keeps
+the keys changed since the encrypted manifest was last published and the
+settings of the manifest, for example its shards. So the next publish
+writes only what changed.
+
+Two backends are available:
+
+* *json* keeps everything in a single JSON file which is rewritten on
+  every commit. It is readable and fine for small directories. Encrypt
+  commits to it only at the end, so the whole file is not rewritten at
+  every checkpoint.
+* *sqlite* keeps entries in an SQLite database indexed by path and UUID.
+  Only changed rows are written.
+"""
+
+from abc import ABC, abstractmethod
+import json
+from pathlib import Path
+import sqlite3
+from typing import Any, Dict, Iterable, Set, Tuple
+
+from .atomic import atomic_write
+
+DataBase = Dict[str, Dict[str, Any]]
+
+_VERSION = 2
+
+
+class MetadataStore(ABC):
+    """
+    Base class of metadata backends.
+    """
+
+    # Whether a commit writes only changed entries, so it is cheap enough
+    # for every checkpoint of encrypt
+    incremental = False
+
+    def __init__(self, path: Path, read_only: bool = False):
+        """
+        Parameters
+        ----------
+        path : Path
+            File of the store.
+        read_only : bool
+            Only read the store. It is not created if it is missing.
+        """
+        self.path = path
+        self.read_only = read_only
+        # Settings of the published manifest
+        self.settings: Dict[str, Any] = {}
+
+    @abstractmethod
+    def load(self) -> DataBase:
+        """
+        Read all entries and settings.
+        """
+
+    @abstractmethod
+    def commit(self, metadata: DataBase, changed: Set[str], removed: Set[str],
+               local: Iterable[str] = ()):
+        """
+        Save changed entries and forget removed ones.
+
+        The changed and removed keys are remembered as pending until
+        :meth:`publish`.
+
+        Parameters
+        ----------
+        metadata : dict
+            All entries.
+        changed : set
+            Keys of added or modified entries.
+        removed : set
+            Keys of removed entries.
+        local : set
+            Keys of entries with changes which are not published, for
+            example file stats.
+        """
+
+    @abstractmethod
+    def pending(self) -> Tuple[Set[str], Set[str]]:
+        """
+        Get keys changed and removed since the last publish.
+        """
+
+    @abstractmethod
+    def publish(self, metadata: DataBase, settings: Dict[str, Any]):
+        """
+        Forget pending keys and update settings once the manifest is written.
+        """
+
+    def close(self):
+        pass
+
+
+class JsonStore(MetadataStore):
+    """
+    Metadata in a JSON file.
+
+    The file of older versions is a plain dictionary of entries. It is read
+    as is and has no pending keys.
+    """
+
+    def __init__(self, path: Path, read_only: bool = False):
+        super().__init__(path, read_only)
+        self._changed: Set[str] = set()
+        self._removed: Set[str] = set()
+
+    def load(self) -> DataBase:
+        if not self.path.is_file():
+            return {}
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        if not _versioned(data):
+            return data
+        self.settings = data['settings']
+        self._changed = set(data['changed'])
+        self._removed = set(data['removed'])
+        return data['entries']
+
+    def commit(self, metadata: DataBase, changed: Set[str], removed: Set[str],
+               local: Iterable[str] = ()):
+        _merge_pending(self._changed, self._removed, changed, removed)
+        self._save(metadata)
+
+    def pending(self) -> Tuple[Set[str], Set[str]]:
+        return set(self._changed), set(self._removed)
+
+    def publish(self, metadata: DataBase, settings: Dict[str, Any]):
+        self._changed.clear()
+        self._removed.clear()
+        self.settings.update(settings)
+        self._save(metadata)
+
+    def _save(self, metadata: DataBase):
+        with atomic_write(self.path, 'w') as f:
+            json.dump({
+                'version': _VERSION,
+                'settings': self.settings,
+                'changed': sorted(self._changed),
+                'removed': sorted(self._removed),
+                'entries': metadata}, f)
+
+
+class SqliteStore(MetadataStore):
+    """
+    Metadata in an SQLite database.
+
+    Every entry is a row with JSON of the entry. Rows are indexed by path
+    and by UUID.
+    """
+
+    incremental = True
+
+    def __init__(self, path: Path, read_only: bool = False):
+        super().__init__(path, read_only)
+        if read_only:
+            # Without a WAL file the database is complete, so it is read
+            # as immutable and no WAL or shared memory file is made
+            query = 'mode=ro' if Path(f'{path}-wal').exists() else 'immutable=1'
+            self._db = sqlite3.connect(f'{path.resolve().as_uri()}?{query}', uri=True,
+                                       check_same_thread=False)
+            return
+        # Only the thread which owns GPM writes, but it may be finalized elsewhere
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Blobs are replaced before a commit, so it must survive power loss
+        self._db.execute('PRAGMA synchronous=FULL')
+        with self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY, uuid TEXT NOT NULL, entry TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS entries_uuid ON entries (uuid);
+                CREATE TABLE IF NOT EXISTS pending (
+                    key TEXT PRIMARY KEY, removed INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS settings (
+                    name TEXT PRIMARY KEY, value TEXT NOT NULL);
+            ''')
+
+    def load(self) -> DataBase:
+        self.settings = {name: json.loads(value) for name, value in
+                         self._db.execute('SELECT name, value FROM settings')}
+        return {key: json.loads(entry) for key, entry in
+                self._db.execute('SELECT key, entry FROM entries')}
+
+    def commit(self, metadata: DataBase, changed: Set[str], removed: Set[str],
+               local: Iterable[str] = ()):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                ((key, metadata[key]['uuid'], json.dumps(metadata[key]))
+                 for key in sorted(set(changed) | set(local))))
+            self._db.executemany(
+                'DELETE FROM entries WHERE key = ?', ((key,) for key in sorted(removed)))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO pending VALUES (?, ?)',
+                [(key, 0) for key in sorted(changed)] +
+                [(key, 1) for key in sorted(removed)])
+
+    def pending(self) -> Tuple[Set[str], Set[str]]:
+        changed: Set[str] = set()
+        removed: Set[str] = set()
+        for key, is_removed in self._db.execute('SELECT key, removed FROM pending'):
+            (removed if is_removed else changed).add(key)
+        return changed, removed
+
+    def publish(self, metadata: DataBase, settings: Dict[str, Any]):
+        self.settings.update(settings)
+        with self._db:
+            self._db.execute('DELETE FROM pending')
+            self._db.executemany(
+                'INSERT OR REPLACE INTO settings VALUES (?, ?)',
+                ((name, json.dumps(value)) for name, value in settings.items()))
+
+    def close(self):
+        self._db.close()
+
+
+BACKENDS = {
+    'json': (JsonStore, 'metafile'),
+    'sqlite': (SqliteStore, 'metadata.db'),
+}
+
+
+def open_store(directory: Path, backend: str = 'json', read_only: bool = False) -> MetadataStore:
+    """
+    Open metadata store in a directory
+
+    If the directory holds metadata of another backend it is migrated.
+
+    Parameters
+    ----------
+    directory : Path
+        Metadata directory.
+    backend : str
+        One of *json* or *sqlite*.
+    read_only : bool
+        Only read metadata. Metadata of another backend is read as it is
+        instead of being migrated.
+
+    Returns
+    -------
+    MetadataStore
+
+    Raises
+    ------
+    RuntimeError
+        If backend is unknown.
+    """
+    if backend not in BACKENDS:
+        raise RuntimeError(f'Unknown metadata backend "{backend}"')
+    store_class, name = BACKENDS[backend]
+    path = directory / name
+    if path.exists():
+        return store_class(path, read_only)
+    if read_only:
+        for other_class, other_name in BACKENDS.values():
+            if (directory / other_name).exists():
+                return other_class(directory / other_name, read_only)
+        # Nothing to read, a missing JSON file is empty
+        return JsonStore(directory / BACKENDS['json'][1], read_only)
+
+    store = store_class(path)
+    for other_class, other_name in BACKENDS.values():
+        other_path = directory / other_name
+        if other_path != path and other_path.exists():
+            other = other_class(other_path)
+            metadata = other.load()
+            store.publish(metadata, other.settings)
+            # Everything is pending, so next publish writes the whole manifest
+            store.commit(metadata, set(metadata), set())
+            other.close()
+            _remove(other_path)
+            break
+    return store
+
+
+def _versioned(data: Dict[str, Any]) -> bool:
+    # Entries are dictionaries, so a path named "version" does not confuse
+    return isinstance(data.get('version'), int)
+
+
+def _merge_pending(pending_changed: Set[str], pending_removed: Set[str],
+                   changed: Iterable[str], removed: Iterable[str]):
+    for key in changed:
+        pending_changed.add(key)
+        pending_removed.discard(key)
+    for key in removed:
+        pending_removed.add(key)
+        pending_changed.discard(key)
+
+
+def _remove(path: Path):
+    # SQLite may leave journal files next to the database
+    for p in (path, Path(f'{path}-wal'), Path(f'{path}-shm')):
+        if p.exists():
+            p.unlink()
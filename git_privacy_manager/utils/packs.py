@@ -0,0 +1,110 @@
+"""
+Packs of small encrypted files.
+
+A pack is a file with encrypted streams of several small files one after
+another. Each stream has its own key as a separate blob has. A member of
+a pack is located by ID of the pack, offset and length, which are kept in
+the encrypted manifest, so the pack itself has no index. Members are never
+changed in place: a new version of a file is appended to a new pack and
+the old one is left until the pack is compacted.
+"""
+
+from pathlib import Path
+from typing import BinaryIO, List, Optional
+from uuid import uuid4
+
+from .atomic import sync
+from .buffers import Buffer, read_at
+
+SUFFIX = '.pack'
+# Size to start a new pack at
+PACK_SIZE = 32 * 1024 * 1024
+
+Location = List  # Pack ID, offset and length
+
+
+def pack_path(directory: Path, pack_id: str) -> Path:
+    return directory / f'{pack_id}{SUFFIX}'
+
+
+def read_member(directory: Path, location: Location) -> bytes:
+    """
+    Read a member of a pack
+
+    Parameters
+    ----------
+    directory : Path
+        Directory with packs.
+    location : list
+        Pack ID, offset and length of the member.
+
+    Raises
+    ------
+    RuntimeError
+        If the pack is shorter than expected.
+    """
+    pack_id, offset, length = location
+    # Each reader has a file of its own, so no lock is needed without pread
+    with open(pack_path(directory, pack_id), 'rb') as f:
+        data = read_at(f, length, offset)
+    if len(data) != length:
+        raise RuntimeError(f'Pack "{pack_id}" is truncated')
+    return data
+
+
+class PackWriter:
+    """
+    Appends members to new packs.
+    """
+
+    def __init__(self, directory: Path, max_size: int = PACK_SIZE):
+        """
+        Parameters
+        ----------
+        directory : Path
+            Directory to create packs in.
+        max_size : int
+            Size to start a new pack at. A pack is larger if its only
+            member is.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self._pack_id: Optional[str] = None
+        self._file: Optional[BinaryIO] = None
+        self._size = 0
+
+    def append(self, data: Buffer) -> Location:
+        """
+        Append a member
+
+        Returns
+        -------
+        list
+            Pack ID, offset and length of the member.
+        """
+        if self._file is not None and self._size + len(data) > self.max_size:
+            self.close()
+        if self._file is None:
+            self._pack_id = str(uuid4())
+            self._file = open(pack_path(self.directory, self._pack_id), 'xb')
+            self._size = 0
+        location = [self._pack_id, self._size, len(data)]
+        self._file.write(data)
+        self._size += len(data)
+        return location
+
+    def flush(self):
+        """
+        Sync members appended so far to disk.
+        """
+        if self._file is not None:
+            sync(self._file)
+
+    def close(self):
+        """
+        Sync and finish the current pack. The next member starts a new one.
+        """
+        if self._file is not None:
+            sync(self._file)
+            self._file.close()
+            self._file = None
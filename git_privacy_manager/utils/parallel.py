@@ -0,0 +1,65 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Iterable, Iterator, Tuple
+
+
+def imap(func: Callable[..., Any], tasks: Iterable[Tuple], workers: int = 1) -> Iterator[Any]:
+    """
+    Apply a function to tasks on a pool of threads
+
+    Hashing and encryption are done by C code which releases the GIL,
+    so threads are enough to use multiple cores. At most ``2 * workers``
+    tasks are in flight at any moment thus memory usage is bounded.
+
+    Parameters
+    ----------
+    func : callable
+        A function to apply.
+    tasks : iterable
+        Tuples of arguments for the function. The first argument is used
+        to describe the task in error messages.
+    workers : int
+        Number of threads. If less than 2 then tasks run in the caller's
+        thread.
+
+    Returns
+    -------
+    iterator
+        Results in the same order as tasks.
+
+    Raises
+    ------
+    RuntimeError
+        If any task fails. The rest of tasks are cancelled.
+    """
+    if workers < 2:
+        for args in tasks:
+            yield _call(func, args)
+        return
+
+    pending: Deque[Tuple[Tuple, Future]] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for args in tasks:
+                if len(pending) >= 2 * workers:
+                    yield _result(*pending.popleft())
+                pending.append((args, pool.submit(func, *args)))
+            while pending:
+                yield _result(*pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def _call(func: Callable[..., Any], args: Tuple) -> Any:
+    try:
+        return func(*args)
+    except Exception as e:
+        raise RuntimeError(f'Failed to process "{args[0]}": {e}') from e
+
+
+def _result(args: Tuple, future: Future) -> Any:
+    try:
+        return future.result()
+    except Exception as e:
+        raise RuntimeError(f'Failed to process "{args[0]}": {e}') from e
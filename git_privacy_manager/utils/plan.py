@@ -0,0 +1,97 @@
+"""
+Plans of encrypt and decrypt.
+
+A plan lists the files an encrypt or a decrypt would add, modify, delete
+or rename and the ones it would leave as they are. It is made from cached
+file stats and metadata only, so files which are touched but not changed
+are planned as modified.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional
+
+from .progress import format_size
+
+CATEGORIES = ('added', 'modified', 'deleted', 'renamed', 'unchanged')
+
+_LABELS = {'added': 'new file', 'modified': 'modified', 'deleted': 'deleted',
+           'renamed': 'renamed'}
+
+
+class Plan:
+    """
+    Files by category with their sizes in bytes.
+
+    A file is a dictionary with *path* and *size*. Renamed files have the
+    old path as *from* too.
+    """
+
+    def __init__(self, action: str):
+        """
+        Parameters
+        ----------
+        action : str
+            *encrypt* or *decrypt*.
+        """
+        self.action = action
+        self.files: Dict[str, List[Dict[str, Any]]] = {category: [] for category in CATEGORIES}
+
+    def add(self, category: str, path: str, size: int, old_path: Optional[str] = None):
+        file: Dict[str, Any] = {'path': path, 'size': size}
+        if old_path is not None:
+            file['from'] = old_path
+        self.files[category].append(file)
+
+    def count(self, category: str) -> int:
+        return len(self.files[category])
+
+    def size(self, category: str) -> int:
+        return sum(file['size'] for file in self.files[category])
+
+    def changes(self) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over files with a category other than unchanged
+        """
+        for category in CATEGORIES[:-1]:
+            for file in self.files[category]:
+                yield dict(file, category=category)
+
+    def __bool__(self) -> bool:
+        return any(self.files[category] for category in CATEGORIES[:-1])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Convert into JSON serializable dictionary
+        """
+        plan: Dict[str, Any] = {'action': self.action}
+        for category in CATEGORIES:
+            plan[category] = {'files': self.count(category), 'bytes': self.size(category),
+                              'paths': sorted(self.files[category], key=lambda file: file['path'])}
+        return plan
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Plan':
+        plan = cls(data['action'])
+        for category in CATEGORIES:
+            plan.files[category] = [dict(file) for file in data[category]['paths']]
+        return plan
+
+    def summary(self) -> str:
+        """
+        Count files and bytes by category in a single line
+        """
+        return ', '.join(f'{self.count(category)} {category} ({format_size(self.size(category))})'
+                         for category in CATEGORIES)
+
+    def __str__(self) -> str:
+        lines = []
+        if self:
+            lines.append(f'Changes to {self.action}:')
+            for file in sorted(self.changes(), key=lambda file: file['path']):
+                path = file['path']
+                if 'from' in file:
+                    path = f'{file["from"]} -> {path}'
+                lines.append(f'  {_LABELS[file["category"]] + ":":<10}{path}')
+        else:
+            lines.append(f'Nothing to {self.action}')
+        lines.append(self.summary())
+        return '\n'.join(lines)
@@ -0,0 +1,109 @@
+"""
+Progress of long runs with estimated time left.
+
+Progress is counted in files and bytes. The time left is estimated by the
+bytes processed so far, since large files dominate the time.
+"""
+
+import sys
+import time
+from typing import Callable, Optional, TextIO
+
+# Seconds between reports
+INTERVAL = 1.0
+
+_UNITS = ('B', 'KiB', 'MiB', 'GiB', 'TiB')
+
+
+class Progress:
+    """
+    Counts processed files and reports progress from time to time.
+    """
+
+    def __init__(self, files: int, size: int, output: Optional[TextIO] = None,
+                 interval: float = INTERVAL, clock: Callable[[], float] = time.monotonic):
+        """
+        Parameters
+        ----------
+        files : int
+            Number of files to process.
+        size : int
+            Total size of the files.
+        output : file
+            Text stream to report to, standard error by default.
+        interval : float
+            Seconds between reports.
+        clock : callable
+            Source of time in seconds.
+        """
+        self.files = files
+        self.size = size
+        self.done_files = 0
+        self.done_size = 0
+        self._output = output or sys.stderr
+        self._interval = interval
+        self._clock = clock
+        self._start = clock()
+        self._reported = self._start
+
+    def advance(self, size: int):
+        """
+        Count a processed file and report progress if it is time to
+        """
+        self.done_files += 1
+        self.done_size += size
+        now = self._clock()
+        if now - self._reported >= self._interval:
+            self._reported = now
+            self._report()
+
+    def finish(self):
+        """
+        Report the final state
+        """
+        if self.files:
+            self._report()
+
+    def rate(self) -> float:
+        """
+        Bytes per second so far
+        """
+        elapsed = self._clock() - self._start
+        return self.done_size / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> Optional[float]:
+        """
+        Estimate seconds left, if anything is processed yet
+        """
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(self.size - self.done_size, 0) / rate
+
+    def __str__(self) -> str:
+        eta = self.eta()
+        left = _duration(eta) if eta is not None else '?'
+        return (f'{self.done_files}/{self.files} files, '
+                f'{format_size(self.done_size)}/{format_size(self.size)}, '
+                f'{format_size(self.rate())}/s, {left} left')
+
+    def _report(self):
+        self._output.write(f'{self}\n')
+        self._output.flush()
+
+
+def format_size(size: float) -> str:
+    """
+    Format bytes with binary units, e.g. *1.5 KiB*
+    """
+    for unit in _UNITS[:-1]:
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} {_UNITS[-1]}'
+
+
+def _duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
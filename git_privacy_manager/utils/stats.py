@@ -0,0 +1,168 @@
+"""
+Timings and counters of encrypt and decrypt by phase.
+
+A run is split into phases: deriving master key, walking working
+directory, hashing files, generating UUIDs, encrypting and decrypting
+files, ciphering (AES and HMAC) of their segments, reading and writing
+local metadata and the encrypted manifest, and checkpoints. Each phase
+counts its wall time, calls, files and bytes. Phases nest: time of
+*cipher* is a part of time of *encrypt* or *decrypt*. Phases run by
+several workers at once sum their times, so they could take longer than
+the whole run.
+
+Unless a :class:`Stats` is given to :class:`GPM`, stats are off and cost
+a check per phase at most.
+"""
+
+from contextlib import contextmanager
+import heapq
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from .progress import format_size
+
+# Number of slowest files to keep
+SLOWEST = 10
+
+
+class Event(NamedTuple):
+    """
+    A finished phase as it is passed to hooks.
+    """
+    phase: str
+    seconds: float
+    files: int
+    size: int
+    file: Optional[str]
+
+
+Hook = Callable[[Event], None]
+
+
+class Stats:
+    """
+    Collects timings and counters of phases.
+
+    It is thread safe, so workers record phases into the same stats.
+    """
+
+    def __init__(self, slowest: int = SLOWEST, hooks: Iterable[Hook] = (),
+                 clock: Callable[[], float] = time.perf_counter):
+        """
+        Parameters
+        ----------
+        slowest : int
+            Number of slowest files to keep.
+        hooks : list
+            Callables which are called with an :class:`Event` after every
+            phase, e.g. to feed a dashboard. They are called by the thread
+            which ran the phase.
+        clock : callable
+            Source of time in seconds.
+        """
+        self.hooks = list(hooks)
+        self._slowest = slowest
+        self._clock = clock
+        self._start = clock()
+        self._lock = threading.Lock()
+        # Seconds, calls, files and bytes by phase
+        self._phases: Dict[str, List[Any]] = {}
+        # Min-heap of the slowest files: seconds, path and phase
+        self._files: List[Tuple[float, str, str]] = []
+
+    @contextmanager
+    def phase(self, name: str, file: Optional[Path] = None, files: Optional[int] = None,
+              size: Optional[int] = None) -> Iterator[None]:
+        """
+        Time a phase
+
+        Parameters
+        ----------
+        name : str
+            Name of phase.
+        file : Path
+            File the phase processes. If no size is given, the size of
+            the file when the phase ends is counted.
+        files : int
+            Number of files the phase processes, one if there is a file.
+            Only phases of files are candidates for the slowest files.
+        size : int
+            Number of bytes the phase processes.
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            seconds = self._clock() - start
+            if size is None:
+                size = _size(file) if file is not None else 0
+            if files is None:
+                files = 1 if file is not None else 0
+            self.add(name, seconds, files, size, calls=1, file=str(file) if files and file else None)
+
+    def add(self, name: str, seconds: float = 0.0, files: int = 0, size: int = 0,
+            calls: int = 0, file: Optional[str] = None):
+        """
+        Count time, files and bytes into a phase
+        """
+        with self._lock:
+            counters = self._phases.setdefault(name, [0.0, 0, 0, 0])
+            counters[0] += seconds
+            counters[1] += calls
+            counters[2] += files
+            counters[3] += size
+            if file is not None and self._slowest > 0:
+                if len(self._files) < self._slowest:
+                    heapq.heappush(self._files, (seconds, file, name))
+                elif seconds > self._files[0][0]:
+                    heapq.heapreplace(self._files, (seconds, file, name))
+        for hook in self.hooks:
+            hook(Event(name, seconds, files, size, file))
+
+    def elapsed(self) -> float:
+        """
+        Seconds since the stats are made
+        """
+        return self._clock() - self._start
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Convert into JSON serializable dictionary
+        """
+        with self._lock:
+            return {
+                'seconds': self.elapsed(),
+                'phases': {name: {'seconds': seconds, 'calls': calls, 'files': files, 'bytes': size}
+                           for name, (seconds, calls, files, size) in self._phases.items()},
+                'slowest': [{'file': file, 'phase': name, 'seconds': seconds}
+                            for seconds, file, name in sorted(self._files, reverse=True)],
+            }
+
+    def __str__(self) -> str:
+        return format_report(self.to_dict())
+
+
+def format_report(stats: Dict[str, Any]) -> str:
+    """
+    Format stats converted into dictionary as a table
+    """
+    lines = [f'{"phase":<14} {"seconds":>9} {"calls":>8} {"files":>8} {"bytes":>12}']
+    for name, phase in sorted(stats['phases'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append(f'{name:<14} {phase["seconds"]:>9.3f} {phase["calls"]:>8} '
+                     f'{phase["files"]:>8} {format_size(phase["bytes"]):>12}')
+    lines.append(f'{"total":<14} {stats["seconds"]:>9.3f}')
+    if stats['slowest']:
+        lines.append('Slowest files:')
+        for file in stats['slowest']:
+            lines.append(f'  {file["seconds"]:>9.3f} {file["phase"]:<14} {file["file"]}')
+    return '\n'.join(lines)
+
+
+def _size(file: Path) -> int:
+    try:
+        return os.stat(file).st_size
+    except OSError:
+        return 0
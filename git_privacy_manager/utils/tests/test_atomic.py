@@ -0,0 +1,33 @@
+from ..atomic import atomic_write
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+
+class TestAtomicWrite(unittest.TestCase):
+    def test_replace(self):
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'file'
+            path.write_bytes(b'old')
+            with atomic_write(path) as f:
+                f.write(b'new')
+                # The old file is intact until the write is done
+                self.assertEqual(b'old', path.read_bytes())
+            self.assertEqual(b'new', path.read_bytes())
+            self.assertEqual([path], list(Path(d).iterdir()))
+
+    def test_failure(self):
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'file'
+            path.write_text('old')
+            with self.assertRaises(KeyboardInterrupt):
+                with atomic_write(path, 'w') as f:
+                    f.write('new')
+                    raise KeyboardInterrupt
+            self.assertEqual('old', path.read_text())
+            self.assertEqual([path], list(Path(d).iterdir()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+from ..buffers import hash_file, read_at, read_blocks
+
+import hashlib
+import io
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+from unittest.mock import patch
+
+
+class TestReadBlocks(unittest.TestCase):
+    def test_blocks(self):
+        data = bytes(range(256)) * 10
+        blocks = [bytes(b) for b in read_blocks(io.BytesIO(data), 1000)]
+        self.assertEqual([len(b) for b in blocks], [1000, 1000, 560])
+        self.assertEqual(b''.join(blocks), data)
+
+    def test_empty(self):
+        self.assertEqual(list(read_blocks(io.BytesIO(b''))), [])
+
+
+class TestReadAt(unittest.TestCase):
+    def test_pread_and_seek(self):
+        data = bytes(range(256)) * 10
+        with TemporaryDirectory() as d:
+            file = Path(d) / 'file'
+            file.write_bytes(data)
+            for pread in (True, False):
+                with patch('git_privacy_manager.utils.buffers._PREAD', pread), open(file, 'rb') as f:
+                    self.assertEqual(data[1000:1100], read_at(f, 100, 1000, threading.Lock()))
+                    self.assertEqual(data[2500:], read_at(f, 100, 2500))
+                    self.assertEqual(b'', read_at(f, 100, 3000))
+
+
+class TestHashFile(unittest.TestCase):
+    def test_read_and_mmap(self):
+        data = bytes(range(256)) * 1000
+        with TemporaryDirectory() as d:
+            file = Path(d) / 'file'
+            file.write_bytes(data)
+            for use_mmap in (False, True):
+                md5, blake2b = hashlib.md5(), hashlib.blake2b()
+                hash_file(file, (md5, blake2b), 1000, use_mmap)
+                self.assertEqual(md5.digest(), hashlib.md5(data).digest())
+                self.assertEqual(blake2b.digest(), hashlib.blake2b(data).digest())
+
+    def test_empty_mmap(self):
+        with TemporaryDirectory() as d:
+            file = Path(d) / 'file'
+            file.touch()
+            md5 = hashlib.md5()
+            hash_file(file, [md5], use_mmap=True)
+            self.assertEqual(md5.digest(), hashlib.md5().digest())
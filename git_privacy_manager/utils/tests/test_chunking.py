@@ -0,0 +1,50 @@
+from ..chunking import MAX_SIZE, MIN_SIZE, boundaries, chunks, _gear
+
+from io import BytesIO
+import random
+import unittest
+
+
+class TestBoundaries(unittest.TestCase):
+    def test_rolling_hash(self):
+        rng = random.Random(1)
+        data = bytes(rng.getrandbits(8) for _ in range(10000))
+        strict, loose = boundaries(data, 6, 4)
+
+        gear = _gear()
+        h = 0
+        for i, byte in enumerate(data):
+            h = ((h << 1) ^ gear[byte]) & 0xFFFFFFFF
+            self.assertEqual(h >> 26 == 0, strict[i] == 0)
+            self.assertEqual(h >> 28 == 0, loose[i] == 0)
+
+
+class TestChunks(unittest.TestCase):
+    def setUp(self):
+        # Fixed data, so an edit does not randomly fall next to a boundary
+        self.data = random.Random(1).getrandbits(8 * 12 * 2**20).to_bytes(12 * 2**20, 'big')
+
+    def test_chunks(self):
+        result = list(chunks(BytesIO(self.data)))
+        self.assertEqual(self.data, b''.join(result))
+        for chunk in result[:-1]:
+            self.assertGreater(len(chunk), MIN_SIZE)
+            self.assertLessEqual(len(chunk), MAX_SIZE)
+
+    def test_small_reads(self):
+        class SlowStream(BytesIO):
+            def read(self, size=-1):
+                return super().read(min(size, 100000))
+
+        self.assertEqual(list(chunks(BytesIO(self.data))),
+                         list(chunks(SlowStream(self.data))))
+
+    def test_insert(self):
+        edited = self.data[:5000000] + b'x' + self.data[5000000:]
+        before = list(chunks(BytesIO(self.data)))
+        after = list(chunks(BytesIO(edited)))
+        # Only the chunk with the edit differs
+        self.assertEqual(1, len(set(after) - set(before)))
+
+    def test_empty(self):
+        self.assertEqual([], list(chunks(BytesIO(b''))))
@@ -0,0 +1,41 @@
+from .. import compression
+from ..compression import compress, decompress, worth_compressing
+
+import os
+import unittest
+from unittest.mock import patch
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.data = [b'SELECT * FROM users;\n' * 1000, b'', os.urandom(1000), b'end']
+
+    def _round_trip(self, algorithm):
+        compressed = list(compress(iter(self.data), algorithm))
+        self.assertLess(len(b''.join(compressed)), len(b''.join(self.data)))
+        self.assertEqual(b''.join(self.data), b''.join(decompress(iter(compressed), algorithm)))
+
+    def test_zlib(self):
+        self._round_trip('zlib')
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self._round_trip('zstd')
+
+    def test_level(self):
+        fast = b''.join(compress(iter(self.data), 'zlib', 1))
+        self.assertEqual(b''.join(self.data), b''.join(decompress(iter([fast]), 'zlib')))
+
+    def test_worth_compressing(self):
+        self.assertTrue(worth_compressing(self.data[0]))
+        self.assertFalse(worth_compressing(os.urandom(compression.SAMPLE_SIZE)))
+        self.assertFalse(worth_compressing(b''))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(RuntimeError):
+            list(compress(iter(self.data), 'lzma'))
+
+    def test_zstd_missing(self):
+        with patch.object(compression, 'zstandard', None):
+            with self.assertRaisesRegex(RuntimeError, r'git_privacy_manager\[zstd\]'):
+                compression.check('zstd')
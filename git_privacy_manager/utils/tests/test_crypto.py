@@ -1,10 +1,13 @@
-from ..crypto import Crypto
+from ..crypto import Crypto, InvalidToken
 
+import base64
 from filecmp import cmp
 import os
 from pathlib import Path
 from tempfile import TemporaryDirectory, mkstemp
+import tracemalloc
 import unittest
+from unittest.mock import patch
 
 
 class TestCryptoFile(unittest.TestCase):
@@ -18,6 +21,67 @@ class TestCryptoFile(unittest.TestCase):
             c.decrypt_file(encrypted, unencrypted)
             self.assertTrue(cmp(original, unencrypted))
 
+    def test_file_compressed(self):
+        with TemporaryDirectory() as d:
+            original = self._add_file(d, 1000000)
+            encrypted = original.with_suffix('.enc')
+            unencrypted = original.with_suffix('.unenc')
+            c = Crypto(Crypto.generate_key())
+            c.encrypt_file(original, encrypted, 'zlib')
+            self.assertLess(encrypted.stat().st_size, 10000)
+            c.decrypt_file(encrypted, unencrypted, compression='zlib')
+            self.assertTrue(cmp(original, unencrypted))
+
+    def test_file_small_buffer(self):
+        with TemporaryDirectory() as d:
+            original = self._add_file(d, 10000)
+            encrypted = original.with_suffix('.enc')
+            unencrypted = original.with_suffix('.unenc')
+            c = Crypto(Crypto.generate_key(), buffer_size=1000)
+            c.encrypt_file(original, encrypted)
+            c.decrypt_file(encrypted, unencrypted)
+            self.assertTrue(cmp(original, unencrypted))
+            # Blobs are the same whatever the buffer size is
+            with open(encrypted, 'rb') as f:
+                plaintext = b''.join(c.decrypt_stream(iter([f.read()])))
+            self.assertEqual(plaintext, b'a' * 10000)
+
+    def test_file_compressed_block_larger_than_buffer(self):
+        with TemporaryDirectory() as d:
+            original = Path(d) / 'random'
+            original.write_bytes(os.urandom(10000))
+            encrypted = original.with_suffix('.enc')
+            unencrypted = original.with_suffix('.unenc')
+            c = Crypto(Crypto.generate_key(), buffer_size=100)
+            c.encrypt_file(original, encrypted, 'zlib')
+            c.decrypt_file(encrypted, unencrypted, compression='zlib')
+            self.assertTrue(cmp(original, unencrypted))
+
+    def test_file_empty(self):
+        with TemporaryDirectory() as d:
+            original = self._add_file(d, 0)
+            encrypted = original.with_suffix('.enc')
+            unencrypted = original.with_suffix('.unenc')
+            c = Crypto(Crypto.generate_key())
+            c.encrypt_file(original, encrypted)
+            c.decrypt_file(encrypted, unencrypted)
+            self.assertTrue(cmp(original, unencrypted))
+
+    def test_file_tampered(self):
+        with TemporaryDirectory() as d:
+            original = self._add_file(d, 8192)
+            encrypted = original.with_suffix('.enc')
+            c = Crypto(Crypto.generate_key())
+            c.encrypt_file(original, encrypted)
+            data = bytearray(encrypted.read_bytes())
+            data[100] ^= 1
+            encrypted.write_bytes(data)
+            with self.assertRaises(InvalidToken):
+                c.decrypt_file(encrypted, original.with_suffix('.unenc'))
+            encrypted.write_bytes(data[:20])
+            with self.assertRaises(InvalidToken):
+                c.decrypt_file(encrypted, original.with_suffix('.unenc'))
+
     @staticmethod
     def _add_file(working_directory, size=1):
         file_data = b'a' * size
@@ -69,3 +133,168 @@ class TestCryptoStream(unittest.TestCase):
 
     def test_stream_8KB_4KB(self):
         self._body_stream(8192, 4096)
+
+    def test_stream_64KB_1B(self):
+        self._body_stream(64 * 1024 + 7, 1)
+
+    def test_truncated(self):
+        c = Crypto(Crypto.generate_key())
+        encrypted = b''.join(c.encrypt_stream(iter([b'a' * 100])))
+        for size in (0, 10, 30, len(encrypted) - 1):
+            with self.assertRaises(InvalidToken):
+                b''.join(c.decrypt_stream(iter([encrypted[:size]])))
+
+    def test_ttl(self):
+        c = Crypto(Crypto.generate_key())
+        encrypted = b''.join(c.encrypt_stream(iter([b'a' * 100])))
+        decrypted = b''.join(c.decrypt_stream(iter([encrypted]), ttl=60))
+        self.assertEqual(b'a' * 100, decrypted)
+
+
+class TestCryptoStreamMemory(unittest.TestCase):
+    """
+    Peak memory of stream decryption must not depend on stream size.
+    """
+
+    BLOCK = 64 * 1024
+
+    def _peak(self, size: int) -> int:
+        c = Crypto(Crypto.generate_key())
+
+        def plaintext_generator():
+            block = b'a' * self.BLOCK
+            for _ in range(size // self.BLOCK):
+                yield block
+
+        tracemalloc.start()
+        try:
+            decrypted = 0
+            for data in c.decrypt_stream(c.encrypt_stream(plaintext_generator())):
+                decrypted += len(data)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(size, decrypted)
+        return peak
+
+    def test_peak_memory_is_constant(self):
+        small = self._peak(1 * 2**20)
+        large = self._peak(64 * 2**20)
+        self.assertLess(large, 8 * self.BLOCK)
+        self.assertLess(large, small + self.BLOCK)
+
+
+class TestSegments(unittest.TestCase):
+    """
+    Test streams of separately authenticated segments.
+    """
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.key = Crypto.generate_key()
+        self.plaintext = os.urandom(10000)
+        self.original = Path(self.directory.name) / 'original'
+        self.original.write_bytes(self.plaintext)
+        self.encrypted = self.original.with_suffix('.enc')
+        self.decrypted = self.original.with_suffix('.dec')
+
+    def _crypto(self, workers=1):
+        # Segments of 1 KB, 4 of them per buffer
+        return Crypto(self.key, buffer_size=4096, workers=workers, segment_size=1024)
+
+    def test_parallel(self):
+        for workers in (1, 4):
+            for size in (0, 1024, 4096, 10000):
+                self.original.write_bytes(self.plaintext[:size])
+                self._crypto(workers).encrypt_file(self.original, self.encrypted)
+                self.assertEqual(29 + size + 32 * max(-(-size // 1024), 1),
+                                 self.encrypted.stat().st_size)
+                # Blobs do not depend on number of workers
+                decrypted = b''.join(self._crypto().decrypt_stream(iter([self.encrypted.read_bytes()])))
+                self.assertEqual(self.plaintext[:size], decrypted)
+                self._crypto(workers).decrypt_file(self.encrypted, self.decrypted)
+                self.assertTrue(cmp(self.original, self.decrypted))
+
+    def test_without_pread(self):
+        # As on Windows, workers seek and read the file in turns
+        with patch('git_privacy_manager.utils.buffers._PREAD', False):
+            self._crypto(4).encrypt_file(self.original, self.encrypted)
+            self._crypto(4).decrypt_file(self.encrypted, self.decrypted)
+            self.assertTrue(cmp(self.original, self.decrypted))
+            self.assertEqual(self.plaintext[1000:3000],
+                             self._crypto().decrypt_range(self.encrypted, 1000, 2000))
+
+    def test_range(self):
+        c = self._crypto()
+        c.encrypt_file(self.original, self.encrypted)
+        # Segments out of range are not read
+        data = bytearray(self.encrypted.read_bytes())
+        # Corrupt the sixth segment: 5120-6143 bytes of plaintext
+        data[29 + 5 * 1056 + 10] ^= 1
+        self.encrypted.write_bytes(data)
+        for offset, length in ((0, 10), (1000, 100), (1023, 2), (2048, 3000), (9999, 10), (20000, 1)):
+            self.assertEqual(self.plaintext[offset:offset + length],
+                             c.decrypt_range(self.encrypted, offset, length))
+        with self.assertRaises(InvalidToken):
+            c.decrypt_range(self.encrypted, 5000, 200)
+
+    def test_corrupted_segment_fails_early(self):
+        c = self._crypto()
+        c.encrypt_file(self.original, self.encrypted)
+        data = bytearray(self.encrypted.read_bytes())
+        data[40] ^= 1
+        stream = c.decrypt_stream(iter([data[i:i + 100] for i in range(0, len(data), 100)]))
+        with self.assertRaises(InvalidToken):
+            next(stream)
+        for workers in (1, 4):
+            self.encrypted.write_bytes(data)
+            with self.assertRaises(InvalidToken):
+                self._crypto(workers).decrypt_file(self.encrypted, self.decrypted)
+
+    def test_reordered_and_truncated(self):
+        c = self._crypto()
+        c.encrypt_file(self.original, self.encrypted)
+        data = self.encrypted.read_bytes()
+        header, body = data[:29], data[29:]
+        sealed = [body[i:i + 1056] for i in range(0, len(body), 1056)]
+        for tampered in (sealed[1:2] + sealed[0:1] + sealed[2:], sealed[:-1], sealed[:3]):
+            with self.assertRaises(InvalidToken):
+                b''.join(c.decrypt_stream(iter([header + b''.join(tampered)])))
+
+    def test_huge_segment_size(self):
+        self._crypto().encrypt_file(self.original, self.encrypted)
+        data = bytearray(self.encrypted.read_bytes())
+        # Header claims segments of almost 4 GB
+        data[25:29] = (2**32 - 16).to_bytes(4, 'big')
+        self.encrypted.write_bytes(data)
+        tracemalloc.start()
+        try:
+            with self.assertRaises(InvalidToken):
+                self._crypto(4).decrypt_file(self.encrypted, self.decrypted)
+            with self.assertRaises(InvalidToken):
+                self._crypto().decrypt_range(self.encrypted, 0, 10)
+            with self.assertRaises(InvalidToken):
+                b''.join(self._crypto().decrypt_stream(iter([bytes(data)])))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 1024 * 1024)
+        with self.assertRaises(ValueError):
+            Crypto(self.key, segment_size=2 * 1024 * 1024)
+
+    def test_legacy(self):
+        # Written by older version with key of bytes 0..31
+        c = Crypto(base64.urlsafe_b64encode(bytes(range(32))))
+        self.encrypted.write_bytes(base64.b64decode(LEGACY_BLOB))
+        expected = b'Legacy blob ' * 10
+        self.assertEqual(expected, b''.join(c.decrypt_stream(iter([self.encrypted.read_bytes()]))))
+        c.decrypt_file(self.encrypted, self.decrypted)
+        self.assertEqual(expected, self.decrypted.read_bytes())
+        self.assertEqual(expected[7:17], c.decrypt_range(self.encrypted, 7, 10))
+
+
+LEGACY_BLOB = (
+    'igAAAABq0oQu79P8djXBdB6yjw6P5FZg9gFLOtbe62mvihk/m+klkbTT5CMAKKnPnGjv9XAcqHP5TF4azy4pFmuUA1Pg'
+    'EoYTx1p0bakDyWP3IgbkuzvzO8gGKcEh3dxDhHDOzEzNvTajA6qY4iH6J335FGOv45AuY9KiiXHkeixrlH4kZlNUW7i4'
+    '4Z5irUjj+w9dPsxS27MKOZ3ASHF+HHPIjNpSXL/PP5OlR7HDUytB')
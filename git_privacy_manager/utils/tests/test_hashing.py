@@ -0,0 +1,34 @@
+from .. import hashing
+
+import hashlib
+import unittest
+from unittest.mock import patch
+
+
+class TestHashing(unittest.TestCase):
+    def test_algorithms(self):
+        data = b'SELECT * FROM users;\n' * 1000
+        expected = {
+            'blake2b': hashlib.blake2b(data, digest_size=32).hexdigest(),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'md5': hashlib.md5(data).hexdigest(),
+        }
+        for algorithm, digest in expected.items():
+            h = hashing.new(algorithm)
+            h.update(memoryview(data))
+            self.assertEqual(digest, h.hexdigest())
+
+    @unittest.skipIf(hashing.blake3 is None, 'blake3 is not installed')
+    def test_blake3(self):
+        h = hashing.new('blake3')
+        h.update(b'data')
+        self.assertEqual(64, len(h.hexdigest()))
+
+    def test_unknown(self):
+        with self.assertRaises(RuntimeError):
+            hashing.new('crc32')
+
+    def test_unavailable(self):
+        with patch.object(hashing, 'blake3', None):
+            with self.assertRaisesRegex(RuntimeError, r'git_privacy_manager\[blake3\]'):
+                hashing.check('blake3')
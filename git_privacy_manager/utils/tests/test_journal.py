@@ -0,0 +1,38 @@
+from ..journal import Journal
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+
+class TestJournal(unittest.TestCase):
+    def test_replay(self):
+        with TemporaryDirectory() as d:
+            journal = Journal(Path(d) / 'journal')
+            entry = {'uuid': '1'}
+            journal.record('a', entry, 'blob.tmp')
+            # Entry is serialized when recorded
+            entry['uuid'] = '2'
+            journal.record('b', entry)
+            self.assertEqual([], Journal(journal.path).replay())
+            journal.flush()
+            self.assertEqual([
+                {'key': 'a', 'entry': {'uuid': '1'}, 'blob': 'blob.tmp'},
+                {'key': 'b', 'entry': {'uuid': '2'}, 'blob': None},
+            ], Journal(journal.path).replay())
+            journal.clear()
+            self.assertFalse(journal.path.exists())
+            self.assertEqual([], journal.replay())
+
+    def test_torn_record(self):
+        with TemporaryDirectory() as d:
+            journal = Journal(Path(d) / 'journal')
+            journal.record('a', {'uuid': '1'})
+            journal.flush()
+            with open(journal.path, 'a') as f:
+                f.write('{"key": "b", "ent')
+            self.assertEqual(['a'], [record['key'] for record in journal.replay()])
+
+
+if __name__ == '__main__':
+    unittest.main()
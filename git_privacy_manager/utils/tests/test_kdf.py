@@ -0,0 +1,29 @@
+from ..kdf import LEGACY, derive, new_params
+
+import base64
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import unittest
+
+
+class TestKdf(unittest.TestCase):
+    def test_legacy(self):
+        # Passphrase is used as salt by older versions
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=b'123',
+                         iterations=100000, backend=default_backend())
+        self.assertEqual(base64.urlsafe_b64encode(kdf.derive(b'123')), derive('123', LEGACY))
+
+    def test_random_salt(self):
+        params1, params2 = new_params(1000), new_params(1000)
+        self.assertNotEqual(params1['salt'], params2['salt'])
+        self.assertNotEqual(derive('123', params1), derive('123', params2))
+        self.assertEqual(derive('123', params1), derive('123', dict(params1)))
+
+    def test_cost(self):
+        params = new_params(1000)
+        self.assertNotEqual(derive('123', params), derive('123', dict(params, iterations=1001)))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(RuntimeError):
+            derive('123', dict(new_params(), algorithm='md5'))
@@ -0,0 +1,32 @@
+from ..lock import locked
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import threading
+import unittest
+
+
+class TestLocked(unittest.TestCase):
+    def test_wait_for_release(self):
+        with TemporaryDirectory() as d:
+            events: list = []
+
+            def other():
+                with locked(Path(d)):
+                    events.append('other')
+
+            with locked(Path(d)):
+                thread = threading.Thread(target=other)
+                thread.start()
+                # The other holder waits until this one releases
+                thread.join(0.2)
+                self.assertTrue(thread.is_alive())
+                self.assertEqual([], events)
+                events.append('first')
+            thread.join(5)
+            self.assertEqual(['first', 'other'], events)
+            self.assertEqual([], list(Path(d).iterdir()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+from ..metadata import JsonStore, MetadataStore, SqliteStore, open_store
+
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+
+def entry(uuid, checksum='x'):
+    return {'uuid': uuid, 'checksum': checksum, 'stat': [1, 2, 3, 4]}
+
+
+class StoreTests:
+    """
+    Tests shared by all backends.
+    """
+    name = ''
+
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.directory = Path(self._tmp.name)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _open(self):
+        return open_store(self.directory, self.name)
+
+    def test_round_trip(self):
+        store = self._open()
+        metadata = {'a': entry('1'), 'b/c': entry('2')}
+        store.commit(metadata, {'a', 'b/c'}, set())
+        store.close()
+        self.assertEqual(metadata, self._open().load())
+
+    def test_incremental_commit(self):
+        store = self._open()
+        metadata = {'a': entry('1'), 'b': entry('2')}
+        store.commit(metadata, {'a', 'b'}, set())
+        metadata['a'] = entry('1', 'y')
+        del metadata['b']
+        metadata['c'] = entry('3')
+        store.commit(metadata, {'a', 'c'}, {'b'})
+        store.close()
+        self.assertEqual(metadata, self._open().load())
+
+    def test_pending(self):
+        store = self._open()
+        metadata = {'a': entry('1'), 'b': entry('2')}
+        store.commit(metadata, {'a'}, set(), {'b'})
+        self.assertEqual(({'a'}, set()), store.pending())
+
+        store.publish(metadata, {'generation': 3})
+        self.assertEqual((set(), set()), store.pending())
+        del metadata['a']
+        store.commit(metadata, set(), {'a'})
+        store.close()
+
+        store = self._open()
+        self.assertEqual({'b': entry('2')}, store.load())
+        self.assertEqual((set(), {'a'}), store.pending())
+        self.assertEqual(3, store.settings['generation'])
+
+
+class TestJsonStore(StoreTests, unittest.TestCase):
+    name = 'json'
+
+    def test_legacy_file(self):
+        metadata = {'version': entry('1')}
+        (self.directory / 'metafile').write_text(json.dumps(metadata))
+        store = self._open()
+        self.assertIsInstance(store, JsonStore)
+        self.assertEqual(metadata, store.load())
+        self.assertEqual((set(), set()), store.pending())
+
+
+class TestSqliteStore(StoreTests, unittest.TestCase):
+    name = 'sqlite'
+
+    def test_backend(self):
+        store = self._open()
+        self.assertIsInstance(store, SqliteStore)
+        # Cheap enough to commit at every checkpoint, unlike json
+        self.assertTrue(store.incremental)
+        self.assertFalse(JsonStore.incremental)
+        store.close()
+        with self.assertRaises(TypeError):
+            MetadataStore(self.directory / 'store')
+
+    def test_migrate_from_json(self):
+        metadata = {'a': entry('1')}
+        json_store = open_store(self.directory, 'json')
+        json_store.publish({}, {'generation': 5})
+        json_store.commit(metadata, {'a'}, set())
+
+        store = self._open()
+        self.assertFalse((self.directory / 'metafile').exists())
+        self.assertEqual(metadata, store.load())
+        self.assertEqual(5, store.settings['generation'])
+        # Everything must be published again
+        self.assertEqual(({'a'}, set()), store.pending())
+        store.close()
+
+
+class TestOpenStore(unittest.TestCase):
+    def test_unknown_backend(self):
+        with TemporaryDirectory() as directory:
+            with self.assertRaises(RuntimeError):
+                open_store(Path(directory), 'xml')
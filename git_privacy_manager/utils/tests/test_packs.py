@@ -0,0 +1,65 @@
+from ..packs import PackWriter, pack_path, read_member
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+
+class TestPacks(unittest.TestCase):
+    def test_append_and_read(self):
+        with TemporaryDirectory() as d:
+            directory = Path(d)
+            writer = PackWriter(directory)
+            first = writer.append(b'first')
+            second = writer.append(memoryview(b'second'))
+            writer.close()
+            self.assertEqual(first[0], second[0])
+            self.assertEqual(first[1:], [0, 5])
+            self.assertEqual(second[1:], [5, 6])
+            self.assertEqual(read_member(directory, first), b'first')
+            self.assertEqual(read_member(directory, second), b'second')
+
+    def test_read_without_pread(self):
+        with TemporaryDirectory() as d:
+            directory = Path(d)
+            writer = PackWriter(directory)
+            locations = [writer.append(data) for data in (b'first', b'second')]
+            writer.close()
+            with patch('git_privacy_manager.utils.buffers._PREAD', False):
+                self.assertEqual(read_member(directory, locations[1]), b'second')
+
+    def test_rollover(self):
+        with TemporaryDirectory() as d:
+            directory = Path(d)
+            writer = PackWriter(directory, max_size=10)
+            locations = [writer.append(data) for data in (b'1234', b'5678', b'90abcdefghijk', b'l')]
+            writer.close()
+            self.assertEqual(locations[0][0], locations[1][0])
+            # A member larger than a pack has a pack of its own
+            self.assertNotEqual(locations[1][0], locations[2][0])
+            self.assertNotEqual(locations[2][0], locations[3][0])
+            self.assertEqual(3, len(list(directory.glob('*.pack'))))
+            self.assertEqual(read_member(directory, locations[2]), b'90abcdefghijk')
+
+    def test_close_starts_new_pack(self):
+        with TemporaryDirectory() as d:
+            writer = PackWriter(Path(d))
+            first = writer.append(b'a')
+            writer.close()
+            self.assertNotEqual(first[0], writer.append(b'b')[0])
+            writer.close()
+
+    def test_truncated(self):
+        with TemporaryDirectory() as d:
+            directory = Path(d)
+            writer = PackWriter(directory)
+            location = writer.append(b'member')
+            writer.close()
+            pack_path(directory, location[0]).write_bytes(b'mem')
+            with self.assertRaises(RuntimeError):
+                read_member(directory, location)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+from ..plan import Plan
+
+import json
+import unittest
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.plan = Plan('encrypt')
+        self.plan.add('added', 'b', 1024)
+        self.plan.add('added', 'a', 512)
+        self.plan.add('renamed', 'd', 10, 'c')
+        self.plan.add('unchanged', 'e', 7)
+
+    def test_counts(self):
+        self.assertEqual(2, self.plan.count('added'))
+        self.assertEqual(1536, self.plan.size('added'))
+        self.assertEqual(0, self.plan.size('deleted'))
+        self.assertTrue(self.plan)
+        self.assertFalse(Plan('decrypt'))
+
+    def test_dict(self):
+        data = json.loads(json.dumps(self.plan.to_dict()))
+        self.assertEqual('encrypt', data['action'])
+        self.assertEqual({'files': 2, 'bytes': 1536, 'paths': [
+            {'path': 'a', 'size': 512}, {'path': 'b', 'size': 1024}]}, data['added'])
+        self.assertEqual([{'path': 'd', 'size': 10, 'from': 'c'}], data['renamed']['paths'])
+        self.assertEqual(data, Plan.from_dict(data).to_dict())
+
+    def test_str(self):
+        self.assertEqual('\n'.join([
+            'Changes to encrypt:',
+            '  new file: a',
+            '  new file: b',
+            '  renamed:  c -> d',
+            '2 added (1.5 KiB), 0 modified (0.0 B), 0 deleted (0.0 B), '
+            '1 renamed (10.0 B), 1 unchanged (7.0 B)']), str(self.plan))
+        self.assertEqual('Nothing to decrypt', str(Plan('decrypt')).splitlines()[0])
@@ -0,0 +1,35 @@
+from ..progress import Progress
+
+import io
+import unittest
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.output = io.StringIO()
+        self.progress = Progress(4, 4096, self.output, interval=1.0, clock=lambda: self.now)
+
+    def test_eta(self):
+        self.assertIsNone(self.progress.eta())
+        self.now = 2.0
+        self.progress.advance(1024)
+        self.assertEqual(512, self.progress.rate())
+        self.assertEqual(6, self.progress.eta())
+        self.assertEqual('1/4 files, 1.0 KiB/4.0 KiB, 512.0 B/s, 0:00:06 left', str(self.progress))
+
+    def test_report_interval(self):
+        self.now = 0.5
+        self.progress.advance(1024)
+        self.assertEqual('', self.output.getvalue())
+        self.now = 1.0
+        self.progress.advance(1024)
+        self.now = 1.5
+        self.progress.advance(1024)
+        self.assertEqual(1, self.output.getvalue().count('\n'))
+        self.progress.finish()
+        self.assertTrue(self.output.getvalue().endswith('3/4 files, 3.0 KiB/4.0 KiB, 2.0 KiB/s, 0:00:00 left\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
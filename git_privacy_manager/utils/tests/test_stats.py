@@ -0,0 +1,72 @@
+from ..stats import Stats, format_report
+
+import json
+from pathlib import Path
+import tempfile
+import threading
+import unittest
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.events = []
+        self.stats = Stats(slowest=2, hooks=[self.events.append], clock=lambda: self.now)
+
+    def run_phase(self, name, seconds, **kwargs):
+        with self.stats.phase(name, **kwargs):
+            self.now += seconds
+
+    def test_phases(self):
+        file = Path(tempfile.mkdtemp()) / 'file'
+        file.write_bytes(b'x' * 100)
+        self.run_phase('hash', 1.0, file=file)
+        self.run_phase('hash', 2.0, file=file)
+        self.run_phase('manifest', 0.5, file=file, files=0)
+        self.stats.add('walk', files=3)
+        phases = self.stats.to_dict()['phases']
+        self.assertEqual({'seconds': 3.0, 'calls': 2, 'files': 2, 'bytes': 200}, phases['hash'])
+        self.assertEqual({'seconds': 0.5, 'calls': 1, 'files': 0, 'bytes': 100}, phases['manifest'])
+        self.assertEqual({'seconds': 0.0, 'calls': 0, 'files': 3, 'bytes': 0}, phases['walk'])
+        self.assertEqual(3.5, self.stats.elapsed())
+        self.assertEqual(['hash', 'hash', 'manifest', 'walk'], [event.phase for event in self.events])
+        self.assertEqual((str(file), 100), (self.events[0].file, self.events[0].size))
+        self.assertIsNone(self.events[2].file)
+
+    def test_slowest(self):
+        for i, seconds in enumerate([3.0, 1.0, 4.0, 2.0]):
+            self.run_phase('encrypt', seconds, file=Path(f'f{i}'))
+        self.assertEqual([('f2', 4.0), ('f0', 3.0)],
+                         [(file['file'], file['seconds']) for file in self.stats.to_dict()['slowest']])
+
+    def test_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.stats.phase('decrypt', size=10):
+                self.now += 1.0
+                raise RuntimeError
+        self.assertEqual(10, self.stats.to_dict()['phases']['decrypt']['bytes'])
+
+    def test_threads(self):
+        stats = Stats()
+
+        def count():
+            for _ in range(1000):
+                stats.add('hash', files=1)
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4000, stats.to_dict()['phases']['hash']['files'])
+
+    def test_report(self):
+        self.run_phase('walk', 1.0)
+        self.run_phase('encrypt', 2.0, file=Path('f'), size=2048)
+        data = json.loads(json.dumps(self.stats.to_dict()))
+        lines = format_report(data).splitlines()
+        self.assertTrue(lines[1].startswith('encrypt'))
+        self.assertIn('2.0 KiB', lines[1])
+        self.assertTrue(lines[2].startswith('walk'))
+        self.assertTrue(lines[3].startswith('total'))
+        self.assertEqual('Slowest files:', lines[4])
+        self.assertEqual(str(self.stats), format_report(self.stats.to_dict()))
@@ -0,0 +1,154 @@
+from ..walk import IgnoreRules, PathFilter, escape, walk
+
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+
+class TestIgnoreRules(unittest.TestCase):
+    def _ignored(self, rules, path, is_dir=False):
+        return bool(IgnoreRules.parse(rules.splitlines()).match(path, is_dir))
+
+    def test_name(self):
+        self.assertTrue(self._ignored('*.log', 'a.log'))
+        self.assertTrue(self._ignored('*.log', 'a/b/c.log'))
+        self.assertFalse(self._ignored('*.log', 'a.log/b'))
+        self.assertFalse(self._ignored('# *.log\n', 'a.log'))
+
+    def test_anchored(self):
+        self.assertTrue(self._ignored('/build', 'build', True))
+        self.assertFalse(self._ignored('/build', 'src/build', True))
+        self.assertTrue(self._ignored('doc/*.txt', 'doc/a.txt'))
+        self.assertFalse(self._ignored('doc/*.txt', 'doc/a/b.txt'))
+
+    def test_directory_only(self):
+        self.assertTrue(self._ignored('node_modules/', 'a/node_modules', True))
+        self.assertFalse(self._ignored('node_modules/', 'node_modules'))
+
+    def test_double_star(self):
+        self.assertTrue(self._ignored('**/foo', 'a/b/foo'))
+        self.assertTrue(self._ignored('a/**/b', 'a/b'))
+        self.assertTrue(self._ignored('a/**/b', 'a/x/y/b'))
+        self.assertTrue(self._ignored('a/**', 'a/x/y'))
+        self.assertFalse(self._ignored('a/**', 'a', True))
+
+    def test_negate(self):
+        self.assertFalse(self._ignored('*.log\n!keep.log', 'keep.log'))
+        self.assertTrue(self._ignored('*.log\n!keep.log', 'drop.log'))
+
+    def test_class_and_escape(self):
+        self.assertTrue(self._ignored('file[0-9]', 'file5'))
+        self.assertFalse(self._ignored('file[!0-9]', 'file5'))
+        self.assertTrue(self._ignored('\\#secret', '#secret'))
+
+
+class TestPathFilter(unittest.TestCase):
+    def test_match(self):
+        f = PathFilter(['config/prod', 'docs/*.md'])
+        self.assertTrue(f.match('config/prod'))
+        self.assertTrue(f.match('config/prod/a/b'))
+        self.assertFalse(f.match('config/production'))
+        self.assertFalse(f.match('prod'))
+        self.assertTrue(f.match('docs/a.md'))
+        self.assertFalse(f.match('docs/a/b.md'))
+
+    def test_anchored(self):
+        f = PathFilter(['*.yml', '/config/**'])
+        self.assertTrue(f.match('a.yml'))
+        self.assertFalse(f.match('a/b.yml'))
+        self.assertTrue(f.match('config/a/b'))
+        self.assertTrue(PathFilter(['**/*.yml']).match('a/b.yml'))
+
+    def test_all(self):
+        self.assertTrue(PathFilter(['.']).match('a/b'))
+        self.assertTrue(PathFilter(['.']).may_contain(''))
+        self.assertFalse(PathFilter([]).match('a'))
+
+    def test_may_contain(self):
+        f = PathFilter(['config/prod/**'])
+        self.assertTrue(f.may_contain('config/prod'))
+        self.assertTrue(f.may_contain('config/prod/a'))
+        self.assertFalse(f.may_contain('config'))
+        self.assertFalse(f.may_contain(''))
+        self.assertFalse(f.may_contain('data'))
+
+        f = PathFilter(['config/prod', 'a*/b'])
+        self.assertTrue(f.may_contain('config'))
+        self.assertTrue(f.may_contain('config/prod/x'))
+        self.assertFalse(f.may_contain('config/dev'))
+        self.assertTrue(f.may_contain('abc'))
+        self.assertTrue(PathFilter(['*.yml']).may_contain('a/b'))
+
+    def test_may_enter(self):
+        f = PathFilter(['config/prod/a'])
+        self.assertTrue(f.may_enter('config'))
+        self.assertTrue(f.may_enter('config/prod'))
+        self.assertFalse(f.may_enter('config/dev'))
+        self.assertFalse(f.may_enter('data'))
+
+    def test_escape(self):
+        f = PathFilter([escape('a/[b]*?.txt')])
+        self.assertTrue(f.match('a/[b]*?.txt'))
+        self.assertFalse(f.match('a/b1x.txt'))
+
+
+class TestWalk(unittest.TestCase):
+    def setUp(self):
+        self._dir = TemporaryDirectory()
+        self.top = Path(self._dir.name)
+        for name in ['a', 'b/c', 'b/d.log', 'node_modules/x/y', 'e/node_modules/z',
+                     '.gpm/metafile', 'e/keep.log']:
+            path = self.top / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _walk(self):
+        return [key.replace(os.sep, '/') for key, _ in walk(self.top, [self.top / '.gpm'])]
+
+    def test_walk(self):
+        self.assertEqual(
+            ['a', 'b/c', 'b/d.log', 'e/keep.log', 'e/node_modules/z', 'node_modules/x/y'],
+            self._walk())
+
+    def test_ignore_file(self):
+        (self.top / '.gpmignore').write_text('node_modules/\n*.log\n')
+        (self.top / 'e' / '.gpmignore').write_text('!keep.log\n')
+        self.assertEqual(
+            ['.gpmignore', 'a', 'b/c', 'e/.gpmignore', 'e/keep.log'], self._walk())
+
+    def test_ignored_directories_are_not_scanned(self):
+        (self.top / '.gpmignore').write_text('node_modules\n')
+        scanned = []
+        scandir = os.scandir
+
+        def tracked(path):
+            scanned.append(os.path.relpath(path, self.top))
+            return scandir(path)
+
+        with patch('os.scandir', tracked):
+            self._walk()
+        self.assertEqual(['.', 'b', 'e'], scanned)
+
+    def test_path_filter(self):
+        (self.top / '.gpmignore').write_text('*.log\n')
+        scanned = []
+        scandir = os.scandir
+
+        def tracked(path):
+            scanned.append(os.path.relpath(path, self.top))
+            return scandir(path)
+
+        with patch('os.scandir', tracked):
+            keys = [key for key, _ in walk(self.top, path_filter=PathFilter(['b', 'e/keep.log']))]
+        # Ignore rules of parent directories apply
+        self.assertEqual([os.path.join('b', 'c')], keys)
+        self.assertEqual(['.', 'b', 'e'], scanned)
+
+    def test_stat(self):
+        stats = dict(walk(self.top))
+        self.assertEqual(os.stat(self.top / 'a').st_ino, stats['a'].st_ino)
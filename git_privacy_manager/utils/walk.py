@@ -0,0 +1,288 @@
+"""
+Walk working directory in a single pass.
+
+Directories are read with :func:`os.scandir` so file types come for free
+and every file is stat'ed once. Excluded and ignored directories are
+pruned instead of being walked.
+
+Files are ignored with *.gpmignore* files which follow gitignore ([1]_)
+syntax. Rules of a *.gpmignore* apply to its directory and below and
+override the rules from parent directories.
+
+References
+----------
+
+.. [1] https://git-scm.com/docs/gitignore
+"""
+
+import os
+from pathlib import Path
+import re
+from typing import Iterable, Iterator, List, Optional, Pattern, Tuple
+
+IGNORE_FILE = '.gpmignore'
+
+
+class IgnoreRules:
+    """
+    Rules of a single ignore file.
+    """
+
+    def __init__(self, base: str = ''):
+        """
+        Parameters
+        ----------
+
+        base : str
+            Path of the ignore file directory relative to the top
+            directory. Ends with slash unless empty.
+        """
+        self._base = base
+        self._rules: List[Tuple[Pattern, bool, bool]] = []
+
+    @classmethod
+    def parse(cls, lines: Iterable[str], base: str = '') -> 'IgnoreRules':
+        rules = cls(base)
+        for line in lines:
+            line = line.rstrip('\r\n')
+            # Trailing spaces are ignored unless escaped
+            line = re.sub(r'(?<!\\) +$', '', line)
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            # A slash at the beginning or middle anchors pattern to base
+            anchored = '/' in line
+            if line.startswith('/'):
+                line = line[1:]
+            if line:
+                rules._rules.append((_translate(line, anchored), negate, dir_only))
+        return rules
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def match(self, path: str, is_dir: bool) -> Optional[bool]:
+        """
+        Check a path against the rules
+
+        Parameters
+        ----------
+        path : str
+            Path relative to the top directory with slashes.
+        is_dir : bool
+            The path is a directory.
+
+        Returns
+        -------
+        bool or None
+            Whether the path is ignored by the last matching rule or None
+            if no rule matches.
+        """
+        if not path.startswith(self._base):
+            return None
+        path = path[len(self._base):]
+        result = None
+        for pattern, negate, dir_only in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if pattern.match(path):
+                result = not negate
+        return result
+
+
+class PathFilter:
+    """
+    Select paths by patterns.
+
+    Patterns follow gitignore syntax, but are always anchored to the top
+    directory. A pattern which matches a directory selects everything
+    below it.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        # Regular expression and literal prefix of every pattern
+        self._patterns: List[Tuple[Pattern, str]] = []
+        for pattern in patterns:
+            pattern = pattern.replace(os.sep, '/').strip('/')
+            if pattern in ('', '.'):
+                pattern = '**'
+            self._patterns.append(
+                (_translate(pattern, True, contents=True), _literal(pattern)))
+
+    def match(self, path: str) -> bool:
+        """
+        Check if a path relative to the top directory is selected.
+        """
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        return any(pattern.match(path) for pattern, _ in self._patterns)
+
+    def may_contain(self, directory: str) -> bool:
+        """
+        Check if files of a directory could be selected.
+
+        Parameters
+        ----------
+        directory : str
+            Path relative to the top directory. Empty for the top one.
+
+        Returns
+        -------
+        bool
+            False if no file right in the directory is selected.
+        """
+        if os.sep != '/':
+            directory = directory.replace(os.sep, '/')
+        prefix = directory + '/' if directory else ''
+        for _, literal in self._patterns:
+            # A selected path starts with the literal part of pattern
+            if prefix.startswith(literal):
+                return True
+            if literal.startswith(prefix) and '/' not in literal[len(prefix):]:
+                return True
+        return False
+
+    def may_enter(self, directory: str) -> bool:
+        """
+        Check if files of a directory or of its subdirectories could be
+        selected.
+
+        Parameters
+        ----------
+        directory : str
+            Path relative to the top directory.
+        """
+        if os.sep != '/':
+            directory = directory.replace(os.sep, '/')
+        prefix = directory + '/'
+        return any(prefix.startswith(literal) or literal.startswith(prefix)
+                   for _, literal in self._patterns)
+
+
+def escape(path: str) -> str:
+    """
+    Make a pattern which matches a path literally.
+    """
+    return re.sub(r'([*?[\\])', r'\\\1', path)
+
+
+def _literal(pattern: str) -> str:
+    # Part of pattern before the first special character
+    match = re.search(r'[*?[\\]', pattern)
+    return pattern[:match.start()] if match else pattern
+
+
+def _translate(pattern: str, anchored: bool, contents: bool = False) -> Pattern:
+    """
+    Translate gitignore pattern into regular expression.
+
+    If contents is set the expression also matches everything below the
+    matching path.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i) and (i == 0 or pattern[i - 1] == '/'):
+                if i + 2 == n:
+                    # Trailing "/**" matches everything inside
+                    res.append('.*')
+                    i += 2
+                    continue
+                if pattern[i + 2] == '/':
+                    # Leading "**/" or "/**/" matches zero or more directories
+                    res.append('(?:.*/)?')
+                    i += 3
+                    continue
+            while i < n and pattern[i] == '*':
+                i += 1
+            res.append('[^/]*')
+            continue
+        if c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j < 0:
+                res.append(re.escape(c))
+            else:
+                chars = pattern[i + 1:j].replace('\\', '\\\\')
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                res.append(f'[{chars}]')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    prefix = '' if anchored else '(?:.*/)?'
+    suffix = '(?:/.*)?' if contents else ''
+    return re.compile(prefix + ''.join(res) + suffix + r'\Z', re.DOTALL)
+
+
+def walk(top: Path, exclude: Iterable[Path] = (), ignore_file: str = IGNORE_FILE,
+         path_filter: Optional[PathFilter] = None) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Get files in all subfolders of a directory
+
+    Parameters
+    ----------
+    top : Path
+        Directory to walk.
+    exclude : list
+        Directories to skip.
+    ignore_file : str
+        Name of files with ignore rules.
+    path_filter : PathFilter
+        Get only the selected files. Directories which could not contain
+        them are not walked.
+
+    Returns
+    -------
+    iterator
+        Paths relative to the top directory in sorted order and their
+        stats. Symbolic links to files are followed, symbolic links to
+        directories are not.
+    """
+    excluded = {os.path.abspath(path) for path in exclude}
+
+    def ignored(rules: List[IgnoreRules], path: str, is_dir: bool) -> bool:
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        result = False
+        # Rules of deeper directories are the last ones and override
+        for r in rules:
+            match = r.match(path, is_dir)
+            if match is not None:
+                result = match
+        return result
+
+    def scan(directory: str, prefix: str, rules: List[IgnoreRules]) -> Iterator[Tuple[str, os.stat_result]]:
+        ignore_path = os.path.join(directory, ignore_file)
+        if os.path.isfile(ignore_path):
+            with open(ignore_path, 'r') as f:
+                local_rules = IgnoreRules.parse(f, prefix.replace(os.sep, '/'))
+            if local_rules:
+                rules = rules + [local_rules]
+
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            path = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path in excluded or ignored(rules, path, True):
+                    continue
+                if path_filter is not None and not path_filter.may_enter(path):
+                    continue
+                yield from scan(entry.path, path + os.sep, rules)
+            elif entry.is_file() and not ignored(rules, path, False) \
+                    and (path_filter is None or path_filter.match(path)):
+                yield path, entry.stat()
+
+    return scan(os.path.abspath(top), '', [])
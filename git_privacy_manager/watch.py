@@ -0,0 +1,266 @@
+"""
+Continuous incremental encryption of working directory.
+
+``gpm watch`` keeps a :class:`GPM` with its metadata and master key in
+memory and encrypts files as they change. Changes come from inotify on
+Linux. Elsewhere, or if inotify runs out of watches, the tree is walked
+every few seconds and file stats are compared instead.
+
+Changes are collected into batches. A batch is encrypted once no change
+has come for a debounce window, or once it is old enough anyway. Only the
+touched paths are walked and hashed, and the encrypted manifest is
+written at most once per batch.
+"""
+
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple, Union
+
+from .gpm import GPM
+from .utils.inotify import IN_CREATE, IN_IGNORED, IN_ISDIR, IN_MOVED_TO, IN_Q_OVERFLOW, Inotify
+from .utils.walk import IGNORE_FILE, escape, walk
+
+# Seconds without changes before a batch is encrypted
+DEBOUNCE = 1.0
+# Seconds after the first change of a batch it is encrypted anyway
+MAX_DELAY = 30.0
+# Seconds between walks of the polling fallback
+POLL_INTERVAL = 5.0
+# Seconds to wait for changes when there are none, so a stop is seen
+_IDLE = 1.0
+
+# Paths relative to working directory touched by changes, or None if
+# anything could have changed
+Changes = Optional[Set[str]]
+
+
+class InotifyWatcher:
+    """
+    Changes of a tree from inotify.
+    """
+
+    def __init__(self, top: Path, exclude: Iterable[Path] = ()):
+        """
+        Raises
+        ------
+        OSError
+            If inotify is not available or runs out of watches.
+        """
+        self._top = os.path.abspath(top)
+        self._exclude = {os.path.abspath(path) for path in exclude}
+        self._inotify = Inotify()
+        # Directories relative to the top one by watch descriptor
+        self._dirs: Dict[int, str] = {}
+        try:
+            self._watch('')
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, timeout: float) -> Changes:
+        """
+        Wait for changes
+
+        Returns
+        -------
+        set or None
+            Touched paths, nothing if no change came in time or None if
+            events are lost.
+
+        Raises
+        ------
+        OSError
+            If inotify runs out of watches for new directories.
+        """
+        changes: Set[str] = set()
+        for event in self._inotify.read(timeout):
+            if event.mask & IN_Q_OVERFLOW:
+                logging.warning('Too many changes at once, encrypt everything')
+                return None
+            if event.mask & IN_IGNORED:
+                # Directory is gone
+                self._dirs.pop(event.wd, None)
+                continue
+            directory = self._dirs.get(event.wd)
+            if directory is None:
+                continue
+            if not event.name:
+                # The directory itself is removed or moved
+                if not directory:
+                    return None
+                changes.add(directory)
+                continue
+            path = os.path.join(directory, event.name)
+            if os.path.join(self._top, path) in self._exclude:
+                continue
+            if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch(path)
+            changes.add(path)
+        return changes
+
+    def close(self):
+        self._inotify.close()
+
+    def _watch(self, directory: str):
+        # Watch a directory and its subdirectories
+        path = os.path.join(self._top, directory)
+        if path in self._exclude:
+            return
+        try:
+            self._dirs[self._inotify.add_watch(path)] = directory
+            with os.scandir(path) as it:
+                subdirs = [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed before it is watched
+            return
+        for name in subdirs:
+            self._watch(os.path.join(directory, name))
+
+
+class PollingWatcher:
+    """
+    Changes of a tree from walks of it.
+    """
+
+    def __init__(self, top: Path, exclude: Iterable[Path] = (), interval: float = POLL_INTERVAL):
+        self._top = top
+        self._exclude = list(exclude)
+        self._interval = interval
+        self._stats = self._scan()
+        self._next = time.monotonic() + interval
+
+    def read(self, timeout: float) -> Changes:
+        """
+        Wait for the next walk and compare stats with the previous one
+
+        Returns
+        -------
+        set
+            Paths of added, modified and removed files or nothing if it
+            is not time to walk yet.
+        """
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self._next = time.monotonic() + self._interval
+        stats = self._scan()
+        changes = {key for key in stats.keys() | self._stats.keys()
+                   if stats.get(key) != self._stats.get(key)}
+        self._stats = stats
+        return changes
+
+    def close(self):
+        pass
+
+    def _scan(self) -> Dict[str, Tuple[int, ...]]:
+        return {key: (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+                for key, st in walk(self._top, self._exclude)}
+
+
+Watcher = Union[InotifyWatcher, PollingWatcher]
+
+
+def watch(gpm: GPM, debounce: float = DEBOUNCE, poll: bool = False,
+          stop: Optional[threading.Event] = None, max_delay: float = MAX_DELAY,
+          poll_interval: float = POLL_INTERVAL):
+    """
+    Encrypt changes of working directory until stopped
+
+    Changes made before the watch are encrypted first. A batch which fails
+    to encrypt is encrypted again with the next one.
+
+    Parameters
+    ----------
+    gpm : GPM
+        Instance to encrypt with. It must not be used by others meanwhile.
+    debounce : float
+        Seconds without changes before a batch is encrypted.
+    poll : bool
+        Walk the tree instead of using inotify.
+    stop : threading.Event
+        Stop watching once set. Otherwise watch forever.
+    max_delay : float
+        Seconds after the first change of a batch it is encrypted anyway.
+    poll_interval : float
+        Seconds between walks if the tree is polled.
+    """
+    stop = stop or threading.Event()
+    exclude = [gpm.metadata_dir, gpm.output_dir]
+    watcher: Watcher
+    if poll:
+        watcher = PollingWatcher(gpm.working_dir, exclude, poll_interval)
+    else:
+        try:
+            watcher = InotifyWatcher(gpm.working_dir, exclude)
+        except OSError as e:
+            logging.warning('Failed to watch "%s", fall back to polling: %s', gpm.working_dir, e)
+            watcher = PollingWatcher(gpm.working_dir, exclude, poll_interval)
+    try:
+        # Watch is set, so nothing is missed between the two
+        batch = _encrypt(gpm, None)
+        started = None
+        while not stop.is_set():
+            try:
+                changes = watcher.read(debounce if started is not None else _IDLE)
+            except OSError as e:
+                logging.warning('Failed to watch "%s", fall back to polling: %s', gpm.working_dir, e)
+                watcher.close()
+                watcher = PollingWatcher(gpm.working_dir, exclude, poll_interval)
+                changes = None
+            if changes is None or changes:
+                batch = _merge(batch, _normalize(changes))
+                if started is None:
+                    started = time.monotonic()
+                if time.monotonic() - started < max_delay:
+                    continue
+            if started is not None:
+                batch = _encrypt(gpm, batch)
+                # Failed batch waits for the next change
+                started = None
+    finally:
+        watcher.close()
+
+
+def _normalize(changes: Changes) -> Changes:
+    if changes is None:
+        return None
+    normalized = set()
+    for path in changes:
+        if os.path.basename(path) == IGNORE_FILE:
+            # Rules change for the whole directory
+            path = os.path.dirname(path)
+            if not path:
+                return None
+        normalized.add(path)
+    return normalized
+
+
+def _merge(batch: Changes, changes: Changes) -> Changes:
+    if batch is None or changes is None:
+        return None
+    return batch | changes
+
+
+def _encrypt(gpm: GPM, batch: Changes) -> Changes:
+    """
+    Returns
+    -------
+    set or None
+        Nothing if the batch is encrypted or the batch itself if it fails.
+    """
+    try:
+        if batch is None:
+            gpm.encrypt()
+        else:
+            logging.info('Encrypt %d changed paths', len(batch))
+            gpm.encrypt(paths=sorted(escape(path) for path in batch))
+    except (RuntimeError, OSError) as e:
+        # E.g. a file deleted while the batch is encrypted: retry it
+        logging.error('Failed to encrypt "%s": %s', gpm.working_dir, e)
+        return batch
+    return set()
@@ -33,6 +33,10 @@ setuptools.setup(
     ],
     python_requires='~=3.7',
     install_requires=['cryptography >= 2.7, < 3.0', 'click >= 7.0, < 8.0'],
+    extras_require={
+        'zstd': ['zstandard'],
+        'blake3': ['blake3'],
+    },
     entry_points={
         'console_scripts': ['gpm=git_privacy_manager.command_line:main'],
     },